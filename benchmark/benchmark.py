@@ -0,0 +1,283 @@
+# server.py를 띄우고 여러 합성 클라이언트로 Predict 요청을 보내 처리량과 지연 시간을 측정한다.
+#
+# batch 크기 x 동시 클라이언트 수 x smashed data 인코딩 조합마다
+#   - 처리량 (요청/초, 샘플/초)
+#   - 전체 지연 시간과 구간별 지연 시간의 p50/p95/p99
+#       client: 클라이언트 모델 실행
+#       serialize: smashed data 인코딩 + 응답 디코딩
+#       server: 서버에서 smashed data 디코딩 + 대기열 + 서버 모델 실행 (FLAG_TIMING으로 받은 값)
+#       network: 나머지 (전송, 커널, 응답 인코딩)
+# 을 출력하고, --json으로 저장해 버전 사이에 비교할 수 있다.
+#
+#   python benchmark.py --batch-sizes 1,32,256 --concurrency 1,4,16 --encodings raw,fp16,int8 --json result.json
+import os
+import sys
+import json
+import math
+import time
+import socket
+import platform
+import argparse
+import threading
+import subprocess
+import itertools
+
+import torch
+
+current_script_path = os.path.abspath(__file__)
+current_directory = os.path.dirname(current_script_path)
+parent_directory = os.path.dirname(current_directory)
+server_directory = os.path.join(parent_directory, 'server')
+
+sys.path.append(parent_directory)
+
+from models.splitter import load_half
+from common import protocol, tensor_codec, encoding
+
+
+HOST = '127.0.0.1'
+PORT = 12399
+STARTUP_TIMEOUT = 60.0
+PERCENTILES = (50, 95, 99)
+COMPONENTS = ('total', 'client', 'serialize', 'network', 'server')
+
+
+def start_server(port, engine, extra_args):
+    command = [sys.executable, os.path.join(server_directory, 'server.py'), '--engine', engine,
+               '--host', HOST, '--port', str(port), *extra_args]
+    # 스레드 엔진은 요청마다 print하므로 출력은 버린다
+    process = subprocess.Popen(command, cwd=server_directory, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server.py exited with code {process.returncode}")
+        try:
+            server_capabilities(HOST, port)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"server.py did not start within {STARTUP_TIMEOUT}s")
+
+
+def server_capabilities(host, port):
+    with socket.create_connection((host, port), timeout=5) as sock:
+        protocol.send_frame(sock, protocol.OP_CAPABILITIES, 1)
+        frame = protocol.recv_frame(sock)
+    if frame is None:
+        raise ConnectionError("Server closed the connection")
+    return json.loads(frame.payload)
+
+
+def load_inputs(path, count):
+    # 입력 파일이 없으면 None: 요청마다 새 난수 입력을 만들어 서버 결과 캐시에 걸리지 않게 한다
+    if path is None:
+        return None
+    data, _ = torch.load(path)
+    return data[:count].unsqueeze(1).float()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    # nearest-rank
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_client(host, port, model, inputs, batch_size, requests, smashed_encoding, model_ref, start, records, errors,
+               busy):
+    request_ids = itertools.count(1)
+    ref = protocol.pack_model_ref(model_ref)
+    try:
+        with socket.create_connection((host, port)) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            start.wait()
+            for index in range(requests):
+                if inputs is None:
+                    data = torch.randn(batch_size, 1, 28, 28)
+                else:
+                    offset = (index * batch_size) % max(1, len(inputs) - batch_size + 1)
+                    data = inputs[offset:offset + batch_size]
+
+                began = time.perf_counter()
+                with torch.inference_mode():
+                    smashed_data = model(data)
+                computed = time.perf_counter()
+                parts = encoding.encode_smashed(smashed_data, smashed_encoding, 'none')
+                encoded = time.perf_counter()
+                while True:
+                    protocol.send_frame(sock, protocol.OP_PREDICT, next(request_ids), ref, *parts,
+                                        flags=protocol.FLAG_TIMING)
+                    frame = protocol.recv_frame(sock)
+                    if frame is None:
+                        raise ConnectionError("Server closed the connection")
+                    delay = protocol.retry_after(frame)
+                    if delay is None:
+                        break
+                    # 서버의 admission control에 거절된 요청. 지연 시간에는 기다린 시간도 포함된다
+                    busy.append(delay)
+                    time.sleep(delay)
+                received = time.perf_counter()
+                if frame.opcode == protocol.OP_ERROR:
+                    raise RuntimeError(protocol.error_message(frame))
+                tensor_codec.decode(frame.payload)
+                decoded = time.perf_counter()
+
+                server_decode, server_inference = protocol.unpack_timing(frame.payload)
+                server_seconds = server_decode + server_inference
+                records.append({
+                    'total': decoded - began,
+                    'client': computed - began,
+                    'serialize': (encoded - computed) + (decoded - received),
+                    'network': max(0.0, (received - encoded) - server_seconds),
+                    'server': server_seconds,
+                    'samples': data.shape[0],
+                    'request_bytes': sum(memoryview(part).nbytes for part in parts),
+                })
+    except Exception as e:
+        errors.append(e)
+
+
+def run_case(host, port, model, inputs, batch_size, concurrency, smashed_encoding, requests, warmup, model_ref):
+    if warmup:
+        run_client(host, port, model, inputs, batch_size, warmup, smashed_encoding, model_ref,
+                   _set_event(), [], [], [])
+
+    start = threading.Event()
+    records = []
+    errors = []
+    busy = []
+    clients = [threading.Thread(target=run_client,
+                                args=(host, port, model, inputs, batch_size, requests, smashed_encoding, model_ref,
+                                      start, records, errors, busy))
+               for _ in range(concurrency)]
+    for client in clients:
+        client.start()
+    # 모든 클라이언트가 연결된 뒤에 동시에 시작한다
+    time.sleep(0.1)
+    began = time.perf_counter()
+    start.set()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - began
+
+    result = {
+        'batch_size': batch_size,
+        'concurrency': concurrency,
+        'encoding': smashed_encoding,
+        'requests': len(records),
+        'errors': [str(error) for error in errors],
+        'busy_rejections': len(busy),
+        'seconds': elapsed,
+        'requests_per_second': len(records) / elapsed if elapsed else 0.0,
+        'samples_per_second': sum(record['samples'] for record in records) / elapsed if elapsed else 0.0,
+        'request_bytes': sum(record['request_bytes'] for record in records) / len(records) if records else 0,
+        'latency_ms': {},
+    }
+    for component in COMPONENTS:
+        values = [record[component] for record in records]
+        result['latency_ms'][component] = {f"p{q}": percentile(values, q) * 1000 for q in PERCENTILES}
+    return result
+
+
+def _set_event():
+    event = threading.Event()
+    event.set()
+    return event
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=parent_directory,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result):
+    latency = result['latency_ms']
+    breakdown = ' '.join(f"{component}={latency[component]['p50']:.2f}" for component in COMPONENTS[1:])
+    print(f"batch={result['batch_size']:<4} clients={result['concurrency']:<3} {result['encoding']:<12} "
+          f"{result['requests_per_second']:>8.1f} req/s {result['samples_per_second']:>9.0f} samples/s  "
+          f"p50/p95/p99={latency['total']['p50']:.2f}/{latency['total']['p95']:.2f}/{latency['total']['p99']:.2f} ms  "
+          f"(p50 {breakdown})")
+    if result['busy_rejections']:
+        print(f"  {result['busy_rejections']} requests rejected as busy and retried")
+    for error in result['errors']:
+        print(f"  error: {error}")
+
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-sizes', default='1,32,256')
+    parser.add_argument('--concurrency', default='1,4,16')
+    parser.add_argument('--encodings', default='raw,fp16')
+    parser.add_argument('--requests', type=int, default=100, help='requests per client for each case')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--data', help='MNIST file such as ../server/test.pt; repeated samples may hit the '
+                                       'server result cache (default: fresh random inputs)')
+    parser.add_argument('--client-model', default=os.path.join(server_directory, 'client_model.pt'))
+    parser.add_argument('--model', default='', help='model reference (default: the server default)')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='asyncio')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--server-arg', action='append', default=[], help='extra argument for server.py')
+    parser.add_argument('--connect', help='host:port of a running server instead of starting one')
+    parser.add_argument('--json', help='save results to this file')
+    args = parser.parse_args()
+
+    batch_sizes = parse_list(args.batch_sizes, int)
+    concurrencies = parse_list(args.concurrency, int)
+    encodings = parse_list(args.encodings)
+
+    server = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(':')
+        port = int(port)
+    else:
+        host, port = HOST, args.port
+        server = start_server(port, args.engine, args.server_arg)
+
+    try:
+        supported = server_capabilities(host, port)['encodings']
+        model = load_half(args.client_model, 'client').eval()
+        inputs = load_inputs(args.data, max(batch_sizes) * 4)
+
+        results = []
+        for smashed_encoding in encodings:
+            if smashed_encoding not in supported:
+                print(f"Skipping {smashed_encoding}: not supported by the server")
+                continue
+            for batch_size in batch_sizes:
+                for concurrency in concurrencies:
+                    result = run_case(host, port, model, inputs, batch_size, concurrency, smashed_encoding,
+                                      args.requests, args.warmup, args.model)
+                    print_result(result)
+                    results.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        report = {
+            'revision': revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'engine': None if args.connect else args.engine,
+            'server_args': args.server_arg,
+            'data': args.data or 'random',
+            'results': results,
+        }
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved results to {args.json}")
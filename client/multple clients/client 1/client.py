@@ -3,7 +3,8 @@ import logging
 import torch
 import sys
 import os
-import io
+import json
+import itertools
 
 
 current_script_path = os.path.abspath(__file__)
@@ -13,7 +14,11 @@ grand_parent_directory = os.path.dirname(parent_directory)
 
 sys.path.append(grand_parent_directory)
 
-from models.resnet import ResNetClient
+from models.splitter import load_half, save_half, DEFAULT_ARCH, DEFAULT_SPLIT_POINT
+from common import protocol, tensor_codec, encoding
+from pipelined_trainer import PipelinedTrainer
+from split_client import download_model, federated_average
+from inference_engine import InferenceEngine, load_dataset
 
 
 # 로깅 설정
@@ -23,48 +28,148 @@ logging.basicConfig(filename='log_client.log', level=logging.INFO, format='%(asc
 HOST = '127.0.0.1'
 PORT = 12345
 
+# 사용할 모델 ('' 이면 서버의 기본 모델). 모델마다 클라이언트 측 모델 파일을 따로 둔다
+model_ref = ''
+model_arch, model_split_point = DEFAULT_ARCH, DEFAULT_SPLIT_POINT
 client_model_name = 'client_model.pt'
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-    client_socket.connect((HOST, PORT))
+request_ids = itertools.count(1)
+
+# smashed data 인코딩 선호 순서. 서버가 지원하는 첫 번째 항목을 사용한다
+# (raw, fp16, bf16, int8, sparse, sparse-fp16 / none, zlib, zstd, lz4)
+ENCODING_PREFERENCE = ['fp16', 'raw']
+COMPRESSION_PREFERENCE = ['none']
+
+
+def select_model(ref, info, default):
+    global model_ref, model_arch, model_split_point, client_model_name
+    model_ref = ref
+    model_arch, model_split_point = info['arch'], info['split_point']
+    key = f"{info['name']}@{info['version']}"
+    client_model_name = 'client_model.pt' if key == default else f"client_model_{key.replace('@', '_')}.pt"
+
+
+def fetch_catalog(sock):
+    protocol.send_frame(sock, protocol.OP_CATALOG, next(request_ids))
+    frame = protocol.recv_frame(sock)
+    if frame is None:
+        raise ConnectionError("Server closed the connection")
+    if frame.opcode != protocol.OP_CATALOG:
+        return None
+    return json.loads(frame.payload)
+
+
+def download_client_model(sock):
+    return download_model(sock, client_model_name, model_ref, next(request_ids))
+
+
+# 클라이언트 측 모델은 한 번 로드해 두고 파일이 바뀔 때만 다시 로드한다
+COMPILE_MODE = None  # None, 'compile', 'script'
+CHANNELS_LAST = False
+engine = None
+
+
+def get_engine():
+    global engine
+    if engine is None:
+        engine = InferenceEngine(client_model_name, compile_mode=COMPILE_MODE, channels_last=CHANNELS_LAST)
+    else:
+        engine.load(client_model_name)
+    return engine
+
+
+# split learning 학습: 클라이언트 forward -> 서버 forward/backward -> 받은 gradient로 클라이언트 backward.
+# PIPELINE_DEPTH개의 batch를 동시에 보내 두어 클라이언트 계산, 네트워크, 서버 계산이 겹치게 한다
+PIPELINE_DEPTH = 2
+
+
+def train_split(sock, model, data, labels, batch_size, epochs, smashed_encoding, smashed_compression, lr=0.001,
+                federated=False):
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    trainer = PipelinedTrainer(sock, model, optimizer, request_ids, max_in_flight=PIPELINE_DEPTH,
+                               smashed_encoding=smashed_encoding, smashed_compression=smashed_compression,
+                               model_ref=model_ref)
+    for epoch in range(epochs):
+        permutation = torch.randperm(len(data))
+        batches = ((data[index], labels[index]) for index in permutation.split(batch_size))
+        losses = trainer.train(batches)
+        if not losses:
+            raise ValueError("No training data")
+        print(f"Epoch [{epoch + 1}/{epochs}], Loss: {sum(losses) / len(losses):.4f}")
+        if federated:
+            # 다른 클라이언트들도 epoch을 마칠 때까지 기다렸다가 클라이언트 측 모델을 평균한다
+            print("Waiting for other clients to average client-side weights...")
+            federated_average(sock, model, len(data), model_ref, next(request_ids))
+            logging.info(f"Client-side weights averaged after epoch {epoch + 1}")
+
+
+def connect():
+    return socket.create_connection((HOST, PORT))
+
+
+client_socket = connect()
+try:
+    protocol.send_frame(client_socket, protocol.OP_CAPABILITIES, next(request_ids))
+    frame = protocol.recv_frame(client_socket)
+    if frame is None:
+        sys.exit("Server closed the connection.")
+    if frame.opcode == protocol.OP_CAPABILITIES:
+        smashed_encoding, smashed_compression = encoding.negotiate(json.loads(frame.payload), ENCODING_PREFERENCE,
+                                                                   COMPRESSION_PREFERENCE)
+    else:
+        smashed_encoding, smashed_compression = 'raw', 'none'
+    print(f"Smashed data encoding: {smashed_encoding}, compression: {smashed_compression}")
+    logging.info(f"Smashed data encoding: {smashed_encoding}, compression: {smashed_compression}")
+
+    catalog = fetch_catalog(client_socket)
+    if catalog:
+        default_model = catalog['default']
+        for info in catalog['models']:
+            if f"{info['name']}@{info['version']}" == default_model:
+                select_model('', info, default_model)
+        print(f"Using model {default_model}")
 
     while True:
-        choice = input("1: Download client-side ResNet\n2: Make prediction\n3: Exit\nEnter your choice: ")
+        choice = input("1: Download client-side ResNet\n2: Make prediction\n3: Exit\n"
+                       "4: Make streamed prediction\n5: Train with split learning\n6: Select model\n"
+                       "Enter your choice: ")
+        # 메뉴에서 오래 기다리는 동안 서버가 idle timeout으로 연결을 닫았으면 다시 연결한다
+        if choice in ('1', '2', '4', '5') and protocol.peer_closed(client_socket):
+            client_socket.close()
+            print("Connection closed by the server. Reconnecting...")
+            logging.info("Connection closed by the server. Reconnecting")
+            client_socket = connect()
 
         if choice == '1':
             request = 'Download'
 
-            client_socket.sendall(request.encode())
-            bytes_read = client_socket.recv(1024)
+            try:
+                updated = download_client_model(client_socket)
+            except (FileNotFoundError, ValueError) as e:
+                print(f"{request} failed: {e}")
+                logging.error(f"{request} failed: {e}")
+                continue
+            except ConnectionError as e:
+                print(f"{request} interrupted: {e}")
+                logging.error(f"{request} interrupted: {e}")
+                break
 
-            if bytes_read == "File not found".encode():
-                print(f"{request} failed: file not found on server.")
-                logging.error(f"{request} failed: file not found on server.")
-            elif bytes_read == "Invalid request".encode():
-                print("Invalid request.")
-                logging.warning("Invalid request sent")
-            else:
-                with open(client_model_name, 'wb') as file:
-                    while not bytes_read == 'Finish'.encode():
-                        file.write(bytes_read)
-                        bytes_read = client_socket.recv(1024)
-                        
-                    
+            if updated:
                 print(f"{client_model_name} downloaded successfully.")
                 logging.info(f"{client_model_name} downloaded successfully")
+            else:
+                print(f"{client_model_name} is already up to date.")
+                logging.info(f"{client_model_name} is already up to date")
 
 
         elif choice == '2':
             request = 'Predict'
-            client_socket.sendall(request.encode())
             print('Make sure that you have downloaded the client-side Model first.')
             path = input("Enter the input data path (diffault: ./test.pt): ")
             if path == '':
                 path = './test.pt'
             try:
-                data = torch.load(path)[0].unsqueeze(1).float()
-                test_label = torch.load(path)[1]
-
+                data, test_label = load_dataset(path)
             except FileNotFoundError:
                 print("File not found.")
                 logging.error("File not found")
@@ -76,67 +181,128 @@ with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
             print("File loaded successfully.")
             logging.info("File loaded successfully")
 
-            print("Loading clinet-side model...")
-            logging.info("Loading client-side model")
-            
-
-            print('Original data: ', data)
-
-            model = ResNetClient()
-            model.load_state_dict(torch.load(client_model_name))
-            model.eval()
-            print("Model loaded successfully.")
-            logging.info("Model loaded successfully")
-
-            print(data.shape)
-            smashed_data = model(data).cpu().detach()
-            print(smashed_data.shape)
-            print(smashed_data.dtype)
-            buff = io.BytesIO()
-            torch.save(smashed_data, buff)
-            buff.seek(0)
-            
-            restored = torch.load(buff)
+            try:
+                smashed_data = get_engine().forward_all(data)
+            except FileNotFoundError:
+                print(f"{client_model_name} not found. Download the client-side model first.")
+                continue
+            logging.debug(f"Input {tuple(data.shape)} -> smashed data {tuple(smashed_data.shape)} {smashed_data.dtype}")
+            request_id = next(request_ids)
+            parts = encoding.encode_smashed(smashed_data, smashed_encoding, smashed_compression)
+            protocol.send_frame(client_socket, protocol.OP_PREDICT, request_id, protocol.pack_model_ref(model_ref),
+                                *parts)
+            print("Model fed successfully. Smashed data sent.")
+            logging.info("Model fed successfully. Smashed data sent.")
 
+            print("Waiting for prediction result...")
+            logging.info("Waiting for prediction result...")
 
+            frame = protocol.recv_frame(client_socket)
+            if frame is None:
+                print(f"{request} failed: server closed the connection")
+                logging.error(f"{request} failed: server closed the connection")
+                continue
+            if frame.opcode == protocol.OP_ERROR:
+                print(f"{request} failed: {protocol.error_message(frame)}")
+                logging.error(f"{request} failed: {protocol.error_message(frame)}")
+                continue
 
-            data_size = len(buff.getvalue())
+            output, _ = tensor_codec.decode(frame.payload)
+            prediction = output.argmax(dim=1)
 
-            client_socket.sendall(data_size.to_bytes(8, 'big'))
-            client_socket.sendall(buff.getvalue())
-            # assert False
+            print("Prediction received successfully.")
 
-            # client_socket.sendall(smashed_data.cpu().detach().numpy().tobytes())
-            # client_socket.sendall('Finish'.encode())
-            print("Model fed successfully. Smashed data sent.")
-            logging.info("Model fed successfully. Smashed data sent.")
 
-            print("Waiting for prediction result...")
-            logging.info("Waiting for prediction result...")
+            print("Prediction accuracy:", end=' ')
+            print((prediction == test_label).sum().item() / len(prediction))
+            print()
 
-            data_size = int.from_bytes(client_socket.recv(8), 'big')
-            print('size', data_size)
 
-            received_bytes = 0
-            received_prediction = bytearray()
-            while received_bytes < data_size:
-                chunk = client_socket.recv(1024*10)
-                if not chunk:
-                    raise Exception("Connection lost while receiving data")
-                received_prediction.extend(chunk)
-                received_bytes += len(chunk)
 
-            buffer = io.BytesIO(received_prediction)
-            prediction = torch.load(buffer).argmax(dim=1)
+        elif choice == '4':
+            request = 'PredictStream'
+            path = input("Enter the input data path (diffault: ./test.pt): ")
+            if path == '':
+                path = './test.pt'
+            micro_batch_size = input("Enter the micro-batch size (default: 256): ")
+            micro_batch_size = int(micro_batch_size) if micro_batch_size else 256
+            try:
+                data, test_label = load_dataset(path)
+                stream_engine = get_engine()
+            except FileNotFoundError as e:
+                print(f"File not found: {e.filename}")
+                logging.error(f"File not found: {e.filename}")
+                continue
 
+            try:
+                prediction = stream_engine.stream_predict(client_socket, next(request_ids), data, micro_batch_size,
+                                                          smashed_encoding, smashed_compression, model_ref)
+            except ValueError as e:
+                print(f"{request} failed: {e}")
+                logging.error(f"{request} failed: {e}")
+                continue
             print("Prediction received successfully.")
-
+            logging.info("Streamed prediction finished")
 
             print("Prediction accuracy:", end=' ')
             print((prediction == test_label).sum().item() / len(prediction))
             print()
 
+        elif choice == '5':
+            request = 'Train'
+            path = input("Enter the training data path (diffault: ./training.pt): ")
+            if path == '':
+                path = './training.pt'
+            epochs = input("Enter the number of epochs (default: 1): ")
+            epochs = int(epochs) if epochs else 1
+            federated = input("Average client-side weights with other clients after each epoch? (y/N): ")
+            federated = federated.lower() == 'y'
+            try:
+                data, train_label = torch.load(path)
+            except FileNotFoundError:
+                print("File not found.")
+                logging.error("File not found")
+                continue
+            data = data.unsqueeze(1).float()
+
+            try:
+                model = load_half(client_model_name, 'client')
+            except FileNotFoundError:
+                print(f"{client_model_name} not found. Download the client-side model first.")
+                continue
 
+            try:
+                train_split(client_socket, model, data, train_label, 128, epochs, smashed_encoding, smashed_compression,
+                            federated=federated)
+            except ValueError as e:
+                print(f"{request} failed: {e}")
+                logging.error(f"{request} failed: {e}")
+                continue
+            except (ConnectionError, socket.timeout) as e:
+                print(f"{request} interrupted: {e}")
+                logging.error(f"{request} interrupted: {e}")
+                break
+
+            # 학습된 클라이언트 측 모델은 서버에서 학습된 모델과 짝을 이룬다
+            save_half(client_model_name, model.state_dict(), 'client', model_arch, model_split_point)
+            print(f"Training finished. {client_model_name} updated.")
+            logging.info(f"Training finished. {client_model_name} updated")
+
+        elif choice == '6':
+            if not catalog:
+                print("Server does not provide a model catalog.")
+                continue
+            for index, info in enumerate(catalog['models'], 1):
+                print(f"{index}: {info['name']}@{info['version']} ({info['arch']}, split at {info['split_point']})")
+            index = input("Enter the model number: ")
+            try:
+                info = catalog['models'][int(index) - 1]
+            except (ValueError, IndexError):
+                print("Invalid model number.")
+                continue
+            select_model(f"{info['name']}@{info['version']}", info, catalog['default'])
+            print(f"Using model {model_ref}. Download the client-side model before predicting.")
+            logging.info(f"Selected model {model_ref}")
 
         elif choice == '3':
             print("Exiting.")
@@ -148,4 +314,6 @@ with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
             continue
 
 
-        
\ No newline at end of file
+        
+finally:
+    client_socket.close()
@@ -0,0 +1,138 @@
+import os
+import queue
+import logging
+import threading
+
+import torch
+
+from models.splitter import load_half
+from common import protocol, tensor_codec, encoding
+
+
+# 계산이 끝나 전송을 기다리는 micro-batch 수. 계산과 전송이 이만큼 앞서거나 뒤처질 수 있다
+PREFETCH = 2
+
+
+def load_dataset(path):
+    # 파일 전체를 메모리로 읽지 않고 mmap으로 열어 batch를 꺼낼 때 필요한 부분만 읽는다
+    try:
+        return torch.load(path, mmap=True)
+    except (TypeError, RuntimeError):
+        # mmap을 지원하지 않는 torch 버전이거나 이전 형식(zip이 아닌)으로 저장된 파일
+        return torch.load(path)
+
+
+def iter_batches(data, batch_size):
+    for start in range(0, len(data), batch_size):
+        yield data[start:start + batch_size]
+
+
+# 클라이언트 측 모델을 메모리에 올려 두고 재사용하는 추론 엔진.
+# 모델 파일이 바뀌었을 때(다운로드, 학습 후 저장)만 다시 로드한다.
+#   compile_mode: None | 'compile' (torch.compile) | 'script' (TorchScript, 첫 batch로 trace)
+class InferenceEngine:
+    def __init__(self, model_path, compile_mode=None, channels_last=False, prefetch=PREFETCH):
+        if compile_mode not in (None, 'compile', 'script'):
+            raise ValueError(f"Unknown compile mode {compile_mode}")
+        self.compile_mode = compile_mode
+        self.channels_last = channels_last
+        self.prefetch = prefetch
+        self.model = None
+        self._runner = None
+        self._loaded = None
+        self._lock = threading.Lock()
+        self.load(model_path)
+
+    def load(self, model_path):
+        stamp = (model_path, os.stat(model_path).st_mtime)
+        with self._lock:
+            if stamp == self._loaded:
+                return self.model
+            model = load_half(model_path, 'client').eval()
+            if self.channels_last:
+                model = model.to(memory_format=torch.channels_last)
+            self.model = model
+            self._runner = torch.compile(model) if self.compile_mode == 'compile' else None
+            self._loaded = stamp
+        logging.info(f"Loaded client-side model {model_path}")
+        return self.model
+
+    def _prepare(self, batch):
+        # (N, H, W) uint8 이미지도 그대로 받아 (N, 1, H, W) float로 바꾼다
+        if batch.dim() == 3:
+            batch = batch.unsqueeze(1)
+        batch = batch.float()
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def forward(self, batch):
+        batch = self._prepare(batch)
+        with torch.inference_mode():
+            if self._runner is None and self.compile_mode == 'script':
+                with self._lock:
+                    if self._runner is None:
+                        self._runner = torch.jit.freeze(torch.jit.trace(self.model, batch))
+            smashed_data = (self._runner or self.model)(batch)
+        return smashed_data.contiguous() if self.channels_last else smashed_data
+
+    def forward_all(self, data, batch_size=1024):
+        return torch.cat([self.forward(batch) for batch in iter_batches(data, batch_size)])
+
+    def stream_predict(self, sock, request_id, data, micro_batch_size, smashed_encoding, smashed_compression,
+                       model_ref=''):
+        # micro-batch i를 전송하는 동안 i+1을 계산하고, 그동안 먼저 끝난 결과를 받는다
+        ref = protocol.pack_model_ref(model_ref)
+        ready = queue.Queue(maxsize=self.prefetch)
+        errors = []
+
+        def compute():
+            try:
+                for batch in iter_batches(data, micro_batch_size):
+                    ready.put(encoding.encode_smashed(self.forward(batch), smashed_encoding, smashed_compression))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                ready.put(None)
+
+        def send():
+            sending = True
+            try:
+                while True:
+                    parts = ready.get()
+                    if parts is None:
+                        sending = False
+                        break
+                    protocol.send_frame(sock, protocol.OP_PREDICT_STREAM, request_id, ref, *parts,
+                                        flags=protocol.FLAG_MORE)
+                # 계산이 실패해도 마지막 프레임은 보내서 서버가 스트림을 닫게 한다
+                protocol.send_frame(sock, protocol.OP_PREDICT_STREAM, request_id, ref)
+            except Exception as e:
+                errors.append(e)
+                # 계산 스레드가 큐에서 막히지 않도록 남은 micro-batch를 버린다
+                while sending and ready.get() is not None:
+                    pass
+
+        workers = [threading.Thread(target=compute), threading.Thread(target=send)]
+        for worker in workers:
+            worker.start()
+
+        predictions = []
+        try:
+            while True:
+                frame = protocol.recv_frame(sock)
+                if frame is None:
+                    raise ConnectionError("Server closed the connection")
+                if frame.opcode == protocol.OP_ERROR:
+                    raise ValueError(protocol.error_message(frame))
+                if frame.payload:
+                    output, _ = tensor_codec.decode(frame.payload)
+                    predictions.append(output.argmax(dim=1))
+                if not frame.flags & protocol.FLAG_MORE:
+                    break
+        finally:
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise errors[0]
+        return torch.cat(predictions) if predictions else torch.empty(0, dtype=torch.int64)
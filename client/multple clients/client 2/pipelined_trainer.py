@@ -0,0 +1,101 @@
+import queue
+import threading
+from collections import deque
+
+from torch.func import functional_call
+
+from common import protocol, tensor_codec, encoding
+
+
+# 여러 micro-batch를 동시에 보내 두고, 서버가 batch i를 처리하는 동안 batch i+1의 forward를 계산하는 split 학습.
+#
+# batch i의 gradient가 돌아왔을 때 클라이언트 가중치는 이미 앞선 batch들로 갱신되어 있으므로,
+# forward에 쓴 가중치를 복사해 두고(weight stashing) 그 가중치로 backward를 계산한다.
+# 한 batch가 보지 못한 갱신은 최대 max_in_flight - 1번이다 (staleness 상한).
+class PipelinedTrainer:
+    def __init__(self, sock, model, optimizer, request_ids, max_in_flight=2,
+                 smashed_encoding='raw', smashed_compression='none', model_ref=''):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.sock = sock
+        self.model = model
+        self.optimizer = optimizer
+        self.request_ids = request_ids
+        self.max_in_flight = max_in_flight
+        self.smashed_encoding = smashed_encoding
+        self.smashed_compression = smashed_compression
+        self.model_ref = protocol.pack_model_ref(model_ref)
+        self.steps = 0
+
+    def _receive(self, expected, responses):
+        # 응답을 계속 읽어 두어야 서버가 큰 gradient를 보내다 막히지 않는다
+        while True:
+            request_id = expected.get()
+            if request_id is None:
+                break
+            try:
+                frame = protocol.recv_frame(self.sock)
+                if frame is None:
+                    raise ConnectionError("Server closed the connection")
+            except Exception as e:
+                responses.put(e)
+                break
+            responses.put(frame)
+
+    def _forward(self, data):
+        stashed = {name: param.detach().clone().requires_grad_()
+                   for name, param in self.model.named_parameters()}
+        smashed_data = functional_call(self.model, stashed, (data,))
+        return stashed, smashed_data
+
+    def _complete(self, in_flight, responses):
+        request_id, stashed, smashed_data = in_flight.popleft()
+        frame = responses.get()
+        if isinstance(frame, Exception):
+            raise frame
+        if frame.opcode == protocol.OP_ERROR:
+            raise ValueError(protocol.error_message(frame))
+        if frame.request_id != request_id:
+            raise protocol.ProtocolError(f"Expected response {request_id}, got {frame.request_id}")
+        (loss, grad), _ = tensor_codec.decode_many(frame.payload, 2)
+
+        smashed_data.backward(grad)
+        for name, param in self.model.named_parameters():
+            param.grad = stashed[name].grad
+        self.optimizer.step()
+        self.steps += 1
+        return loss.item()
+
+    def train(self, batches, log_every=100):
+        self.model.train()
+        expected = queue.Queue()
+        responses = queue.Queue()
+        receiver = threading.Thread(target=self._receive, args=(expected, responses), daemon=True)
+        receiver.start()
+
+        in_flight = deque()
+        losses = []
+        try:
+            for data, labels in batches:
+                if len(in_flight) >= self.max_in_flight:
+                    losses.append(self._complete(in_flight, responses))
+                    if log_every and self.steps % log_every == 0:
+                        print(f"Step [{self.steps}], Loss: {losses[-1]:.4f}")
+
+                stashed, smashed_data = self._forward(data)
+                request_id = next(self.request_ids)
+                parts = encoding.encode_smashed(smashed_data, self.smashed_encoding, self.smashed_compression)
+                expected.put(request_id)
+                protocol.send_frame(self.sock, protocol.OP_TRAIN, request_id, self.model_ref,
+                                    *tensor_codec.encode(labels), *parts)
+                in_flight.append((request_id, stashed, smashed_data))
+
+            while in_flight:
+                losses.append(self._complete(in_flight, responses))
+        finally:
+            # 실패해도 이미 보낸 요청의 응답을 receiver가 모두 읽은 뒤에 돌아가야
+            # 다음 요청이 같은 소켓에서 앞선 응답을 받지 않는다
+            expected.put(None)
+            receiver.join()
+        self.model.eval()
+        return losses
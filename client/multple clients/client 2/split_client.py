@@ -0,0 +1,291 @@
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import socket
+import logging
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))  # 상위 경로 import 가능
+
+from common import protocol, tensor_codec, encoding, download
+from inference_engine import InferenceEngine
+
+
+# smashed data 인코딩 선호 순서. 서버가 지원하는 첫 번째 항목을 사용한다
+ENCODING_PREFERENCE = ['fp16', 'raw']
+COMPRESSION_PREFERENCE = ['none']
+
+
+class ServerError(ValueError):
+    pass
+
+
+class ServerBusyError(ServerError):
+    def __init__(self, message, retry_after):
+        super(ServerBusyError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+# 받다가 끊긴 파일은 '<모델 이름>.<sha256>.part'로 남겨 두고 다음 다운로드에서 이어받는다
+def find_partial_download(path):
+    for partial_path in glob.glob(f"{glob.escape(path)}.*.part"):
+        try:
+            return partial_path, bytes.fromhex(partial_path[len(path) + 1:-len('.part')])
+        except ValueError:
+            continue
+    return None, download.NO_HASH
+
+
+def download_model(sock, path, model_ref='', request_id=1):
+    # 받은 파일이 최신이면 False, 새로 받았으면 True
+    have_hash = download.sha256_path(path) if os.path.exists(path) else download.NO_HASH
+    partial_path, resume_hash = find_partial_download(path)
+    offset = os.path.getsize(partial_path) if partial_path else 0
+
+    protocol.send_frame(sock, protocol.OP_DOWNLOAD, request_id, protocol.pack_model_ref(model_ref),
+                        download.pack_request(have_hash, offset, resume_hash))
+    header = protocol.recv_header(sock)
+    if header is None:
+        raise ConnectionError("Server closed the connection")
+    opcode, flags, _, length = header
+    if opcode == protocol.OP_ERROR:
+        frame = protocol.Frame(opcode, flags, 0, protocol.recv_into_exact(sock, bytearray(length)))
+        delay = protocol.retry_after(frame)
+        if delay is not None:
+            raise ServerBusyError(protocol.error_message(frame), delay)
+        raise FileNotFoundError(protocol.error_message(frame))
+
+    response = protocol.recv_into_exact(sock, bytearray(download.DOWNLOAD_RESPONSE.size))
+    size, offset, digest = download.DOWNLOAD_RESPONSE.unpack(response)
+    if flags & protocol.FLAG_NOT_MODIFIED:
+        return False
+
+    target_path = f"{path}.{digest.hex()}.part"
+    if partial_path and partial_path != target_path:
+        os.remove(partial_path)
+    with open(target_path, 'r+b' if offset and os.path.exists(target_path) else 'wb') as file:
+        file.seek(offset)
+        file.truncate()
+        remaining = length - len(response)
+        buffer = bytearray(1024 * 1024)
+        view = memoryview(buffer)
+        while remaining:
+            received = sock.recv_into(view[:min(remaining, len(buffer))])
+            if not received:
+                raise ConnectionError(f"Connection lost; {size - file.tell()} bytes left, run Download again to resume")
+            file.write(view[:received])
+            remaining -= received
+
+    if download.sha256_path(target_path) != digest:
+        os.remove(target_path)
+        raise ValueError("Checksum mismatch, downloaded file discarded")
+    os.replace(target_path, path)
+    return True
+
+
+def federated_average(sock, model, samples, model_ref='', request_id=1):
+    # SplitFed: 클라이언트 측 가중치와 학습한 샘플 수를 보내고, 같은 라운드에 참여한
+    # 클라이언트들의 가중 평균(FedAvg)으로 모델을 바꾼다. 다른 클라이언트들을 기다리는 동안 블록된다
+    state_dict = model.state_dict()
+    tensors = [tensor.detach().contiguous() for tensor in state_dict.values()]
+    protocol.send_frame(sock, protocol.OP_FEDAVG, request_id, protocol.pack_model_ref(model_ref),
+                        protocol.FEDAVG.pack(samples, len(tensors)), *tensor_codec.encode_many(tensors))
+    frame = protocol.recv_frame(sock)
+    if frame is None:
+        raise ConnectionError("Server closed the connection")
+    if frame.opcode == protocol.OP_ERROR:
+        raise ValueError(protocol.error_message(frame))
+    averaged, _ = tensor_codec.decode_many(frame.payload, len(tensors))
+    model.load_state_dict(dict(zip(state_dict.keys(), averaged)))
+
+
+class _Connection:
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # 풀에서 쉬는 동안 서버 호스트가 사라진 연결을 keepalive로 찾아낸다
+        protocol.enable_keepalive(self.sock)
+
+    def request(self, opcode, request_id, parts):
+        protocol.send_frame(self.sock, opcode, request_id, *parts)
+        frame = protocol.recv_frame(self.sock)
+        if frame is None:
+            raise ConnectionError("Server closed the connection")
+        if frame.request_id != request_id and frame.request_id != 0:
+            raise protocol.ProtocolError(f"Expected response {request_id}, got {frame.request_id}")
+        delay = protocol.retry_after(frame)
+        if delay is not None:
+            if frame.request_id == 0:
+                # 연결 수 제한으로 거절된 연결은 서버가 닫는다
+                raise ConnectionError(protocol.error_message(frame))
+            raise ServerBusyError(protocol.error_message(frame), delay)
+        return frame
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# 대화형 client.py 없이 다른 프로그램에서 split 추론을 쓰기 위한 클라이언트.
+#
+#     with SplitClient('127.0.0.1', 12345) as client:
+#         output = client.predict(images).result()
+#         outputs = [future.result() for future in client.predict_many(loader)]
+#
+# 클라이언트 측 모델은 한 번만 로드하고, 요청은 pool_size개의 연결에 나누어 동시에 보낸다.
+# 연결이 끊기면 다시 연결해서 retries번까지 재시도한다 (대기 시간은 backoff부터 두 배씩).
+class SplitClient:
+    def __init__(self, host='127.0.0.1', port=12345, pool_size=4, model_ref='', client_model_path='client_model.pt',
+                 retries=3, backoff=0.1, timeout=30.0, compile_mode=None, channels_last=False,
+                 encoding_preference=ENCODING_PREFERENCE, compression_preference=COMPRESSION_PREFERENCE):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.model_ref = model_ref
+        self.client_model_path = client_model_path
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.encoding_preference = encoding_preference
+        self.compression_preference = compression_preference
+        self.compile_mode = compile_mode
+        self.channels_last = channels_last
+        self.smashed_encoding = None
+        self.smashed_compression = None
+        self.engine = None
+
+        self._model_ref = protocol.pack_model_ref(model_ref)
+        self._request_ids = itertools.count(1)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='split-client')
+        self._closed = False
+
+        if not os.path.exists(client_model_path):
+            self.download()
+        self.load_model()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connect(self):
+        connection = _Connection(self.host, self.port, self.timeout)
+        if self.smashed_encoding is None:
+            # 같은 서버에 연결하므로 인코딩은 첫 연결에서 한 번만 정한다
+            try:
+                frame = connection.request(protocol.OP_CAPABILITIES, next(self._request_ids), [])
+            except BaseException:
+                # 아직 풀에 들어가지 않은 연결이므로 여기서 닫지 않으면 소켓이 남는다
+                connection.close()
+                raise
+            with self._lock:
+                if frame.opcode == protocol.OP_CAPABILITIES:
+                    self.smashed_encoding, self.smashed_compression = encoding.negotiate(
+                        json.loads(frame.payload), self.encoding_preference, self.compression_preference)
+                else:
+                    self.smashed_encoding, self.smashed_compression = 'raw', 'none'
+            logging.info(f"Smashed data encoding: {self.smashed_encoding}, compression: {self.smashed_compression}")
+        return connection
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _checkin(self, connection):
+        if self._closed:
+            connection.close()
+        else:
+            self._idle.put(connection)
+
+    def _with_retry(self, call):
+        # call(connection)이 연결 문제로 실패하면 그 연결을 버리고 새 연결로 다시 시도한다.
+        # 서버가 바빠서 거절하면(FLAG_RETRY) 연결은 그대로 두고 서버가 알려 준 시간만큼 기다렸다 다시 보낸다
+        for attempt in range(self.retries + 1):
+            connection = None
+            try:
+                connection = self._checkout()
+                result = call(connection)
+            except ServerBusyError as e:
+                # _connect 중에 거절되면 connection은 None이고 그 연결은 _connect가 이미 닫았다
+                if connection is not None:
+                    self._checkin(connection)
+                if attempt == self.retries or self._closed:
+                    raise
+                logging.warning(f"Server busy ({e}), retrying in {e.retry_after:.2f}s")
+                time.sleep(e.retry_after)
+                continue
+            except (ConnectionError, socket.timeout, protocol.ProtocolError) as e:
+                if connection is not None:
+                    connection.close()
+                if attempt == self.retries or self._closed:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logging.warning(f"Request failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            self._checkin(connection)
+            return result
+
+    def _check(self, frame):
+        if frame.opcode == protocol.OP_ERROR:
+            raise ServerError(protocol.error_message(frame))
+        return frame
+
+    def _request(self, opcode, *parts):
+        return self._check(self._with_retry(
+            lambda connection: connection.request(opcode, next(self._request_ids), parts)))
+
+    def download(self):
+        return self._with_retry(lambda connection: download_model(connection.sock, self.client_model_path,
+                                                                  self.model_ref, next(self._request_ids)))
+
+    def load_model(self):
+        if self.engine is None:
+            self.engine = InferenceEngine(self.client_model_path, self.compile_mode, self.channels_last)
+        return self.engine.load(self.client_model_path)
+
+    def catalog(self):
+        return json.loads(self._request(protocol.OP_CATALOG).payload)
+
+    def _predict(self, data):
+        smashed_data = self.engine.forward(data)
+
+        def send(connection):
+            # 인코딩은 첫 연결을 만든 뒤에 정해지므로 연결을 얻은 다음에 인코딩한다
+            parts = encoding.encode_smashed(smashed_data, self.smashed_encoding, self.smashed_compression)
+            return connection.request(protocol.OP_PREDICT, next(self._request_ids), [self._model_ref, *parts])
+
+        frame = self._check(self._with_retry(send))
+        output, _ = tensor_codec.decode(frame.payload)
+        return output
+
+    def predict(self, data):
+        # 서버 모델의 출력(logit)을 돌려주는 Future
+        return self._executor.submit(self._predict, data)
+
+    def predict_many(self, batches, batch_size=None):
+        # batches: batch들의 iterable, 또는 batch_size와 함께 주는 하나의 큰 텐서
+        if batch_size is not None:
+            batches = batches.split(batch_size)
+        return [self.predict(batch) for batch in batches]
+
+    def close(self):
+        self._closed = True
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -1,2 +1,8 @@
 copy /Y C:\Users\admin\repository\cloudification\client\client.py ".\multple clients\client 1"
-copy /Y C:\Users\admin\repository\cloudification\client\client.py ".\multple clients\client 2"
\ No newline at end of file
+copy /Y C:\Users\admin\repository\cloudification\client\client.py ".\multple clients\client 2"
+copy /Y C:\Users\admin\repository\cloudification\client\pipelined_trainer.py ".\multple clients\client 1"
+copy /Y C:\Users\admin\repository\cloudification\client\pipelined_trainer.py ".\multple clients\client 2"
+copy /Y C:\Users\admin\repository\cloudification\client\split_client.py ".\multple clients\client 1"
+copy /Y C:\Users\admin\repository\cloudification\client\split_client.py ".\multple clients\client 2"
+copy /Y C:\Users\admin\repository\cloudification\client\inference_engine.py ".\multple clients\client 1"
+copy /Y C:\Users\admin\repository\cloudification\client\inference_engine.py ".\multple clients\client 2"
\ No newline at end of file
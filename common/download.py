@@ -0,0 +1,74 @@
+# 클라이언트 모델 다운로드 요청/응답 형식과 해시 계산
+#
+# 요청 payload:  have hash(32) | resume offset(8) | resume hash(32)
+# 응답 payload:  total size(8) | offset(8) | sha256(32) | offset부터의 파일 내용
+# 클라이언트가 가진 파일의 해시가 같으면 FLAG_NOT_MODIFIED와 함께 파일 내용 없이 응답한다.
+import os
+import struct
+import hashlib
+import threading
+
+
+DOWNLOAD_REQUEST = struct.Struct('!32sQ32s')
+DOWNLOAD_RESPONSE = struct.Struct('!QQ32s')
+
+NO_HASH = bytes(32)
+
+
+def pack_request(have_hash=NO_HASH, offset=0, resume_hash=NO_HASH):
+    return DOWNLOAD_REQUEST.pack(have_hash, offset, resume_hash)
+
+
+def unpack_request(payload, offset=0):
+    # 요청 내용이 없으면 처음부터 전체를 받는다
+    if len(payload) < offset + DOWNLOAD_REQUEST.size:
+        return NO_HASH, 0, NO_HASH
+    return DOWNLOAD_REQUEST.unpack_from(payload, offset)
+
+
+def sha256_file(file, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    file.seek(0)
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    file.seek(0)
+    return digest.digest()
+
+
+def sha256_path(path):
+    with open(path, 'rb') as file:
+        return sha256_file(file)
+
+
+# 파일이 바뀌지 않았다면 해시를 다시 계산하지 않는다
+class DigestCache:
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def digest(self, file):
+        stat = os.fstat(file.fileno())
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            cached = self._cache.get(file.name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        digest = sha256_file(file)
+        with self._lock:
+            self._cache[file.name] = (key, digest)
+        return digest
+
+
+# 서버 측: 요청을 보고 (응답 헤더 payload, 보낼 시작 위치, 보낼 바이트 수)를 정한다
+def plan_response(file, payload, digest_cache, payload_offset=0):
+    have_hash, offset, resume_hash = unpack_request(payload, payload_offset)
+    size = os.fstat(file.fileno()).st_size
+    digest = digest_cache.digest(file)
+    if have_hash == digest:
+        return DOWNLOAD_RESPONSE.pack(size, size, digest), size, 0, True
+    if resume_hash != digest or offset > size:
+        offset = 0
+    return DOWNLOAD_RESPONSE.pack(size, offset, digest), offset, size - offset, False
@@ -0,0 +1,266 @@
+# smashed data 전송량을 줄이기 위한 인코딩(정밀도 축소, 양자화, 희소 표현)과 압축
+#
+#   encoding(1) | compression(1) | reserved(6) | body
+# body는 tensor_codec 텐서들의 나열이며, 압축을 쓰면 body 전체를 한 번에 압축한다.
+# envelope가 payload의 끝까지 이어지므로 다른 데이터와 함께 보낼 때는 항상 마지막에 둔다.
+import struct
+import zlib
+
+import torch
+
+from common import tensor_codec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+ENVELOPE = struct.Struct('!BB6x')
+
+ENCODINGS = {
+    'raw': 0,
+    'fp16': 1,
+    'bf16': 2,
+    'int8': 3,
+    'sparse': 4,
+    'sparse-fp16': 5,
+}
+ENCODING_NAMES = {code: name for name, code in ENCODINGS.items()}
+
+COMPRESSIONS = {
+    'none': 0,
+    'zlib': 1,
+    'zstd': 2,
+    'lz4': 3,
+}
+COMPRESSION_NAMES = {code: name for name, code in COMPRESSIONS.items()}
+
+# 복원한 smashed 텐서(float32)와 압축을 푼 body의 최대 크기.
+# 압축과 희소 표현은 작은 payload로 큰 텐서를 만들 수 있으므로 payload 크기 제한만으로는 부족하다
+MAX_DECODED_BYTES = 256 * 1024 * 1024
+
+_BIT_WEIGHTS = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+_BIT_SHIFTS = torch.tensor([7, 6, 5, 4, 3, 2, 1, 0], dtype=torch.uint8)
+
+
+class EncodingError(Exception):
+    pass
+
+
+def supported_compressions():
+    names = ['none', 'zlib']
+    if zstandard is not None:
+        names.append('zstd')
+    if lz4 is not None:
+        names.append('lz4')
+    return names
+
+
+def capabilities():
+    return {'encodings': list(ENCODINGS), 'compressions': supported_compressions()}
+
+
+# 클라이언트 선호 순서대로 서버가 지원하는 첫 번째 항목을 고른다
+def negotiate(server_capabilities, encoding_preference, compression_preference=('none',)):
+    encoding = next((name for name in encoding_preference if name in server_capabilities['encodings']), 'raw')
+    available = set(server_capabilities['compressions']) & set(supported_compressions())
+    compression = next((name for name in compression_preference if name in available), 'none')
+    return encoding, compression
+
+
+def _pack_bits(mask):
+    flat = mask.reshape(-1).to(torch.uint8)
+    padding = -flat.numel() % 8
+    if padding:
+        flat = torch.cat([flat, flat.new_zeros(padding)])
+    return (flat.view(-1, 8) * _BIT_WEIGHTS).sum(dim=1, dtype=torch.uint8)
+
+
+def _unpack_bits(packed, numel):
+    bits = (packed.unsqueeze(1) >> _BIT_SHIFTS) & 1
+    return bits.reshape(-1)[:numel].bool()
+
+
+def _quantize_int8(tensor):
+    # 채널(dim 1)별 대칭 양자화. 1차원 이하 텐서는 텐서 전체에 하나의 scale을 쓴다
+    if tensor.dim() >= 2:
+        reduce_dims = [d for d in range(tensor.dim()) if d != 1]
+        amax = tensor.abs().amax(dim=reduce_dims)
+        view_shape = [1] * tensor.dim()
+        view_shape[1] = -1
+    else:
+        amax = tensor.abs().amax().reshape(1)
+        view_shape = [1] * max(tensor.dim(), 1)
+    scale = (amax / 127).clamp(min=1e-12).float()
+    quantized = torch.round(tensor / scale.view(view_shape)).clamp(-127, 127).to(torch.int8)
+    return quantized, scale
+
+
+def _dequantize_int8(quantized, scale):
+    view_shape = [1] * max(quantized.dim(), 1)
+    if quantized.dim() >= 2:
+        view_shape[1] = -1
+    return quantized.float() * scale.view(view_shape)
+
+
+def _encode_tensors(tensor, encoding):
+    tensor = tensor.detach().cpu()
+    if encoding == 'raw':
+        return [tensor]
+    if encoding == 'fp16':
+        return [tensor.half()]
+    if encoding == 'bf16':
+        return [tensor.bfloat16()]
+    if encoding == 'int8':
+        quantized, scale = _quantize_int8(tensor.float())
+        return [scale, quantized]
+    if encoding in ('sparse', 'sparse-fp16'):
+        # ReLU 뒤의 0을 비트마스크로 표현하고 0이 아닌 값만 보낸다
+        mask = tensor != 0
+        values = tensor[mask]
+        if encoding == 'sparse-fp16':
+            values = values.half()
+        shape = torch.tensor(tensor.shape, dtype=torch.int64)
+        return [shape, _pack_bits(mask), values]
+    raise EncodingError(f"Unknown encoding {encoding}")
+
+
+def _check_size(numel, max_bytes):
+    # float32로 복원했을 때의 크기를 메모리를 잡기 전에 확인한다
+    if numel * 4 > max_bytes:
+        raise EncodingError(f"Decoded smashed data would exceed {max_bytes} bytes")
+
+
+def _decode_tensors(encoding, body, max_bytes):
+    if encoding in ('raw', 'fp16', 'bf16'):
+        (tensor,), _ = tensor_codec.decode_many(body, 1)
+        _check_size(tensor.numel(), max_bytes)
+        return tensor.float()
+    if encoding == 'int8':
+        (scale, quantized), _ = tensor_codec.decode_many(body, 2)
+        _check_size(quantized.numel(), max_bytes)
+        return _dequantize_int8(quantized, scale)
+    if encoding in ('sparse', 'sparse-fp16'):
+        (shape, packed, values), _ = tensor_codec.decode_many(body, 3)
+        if shape.dim() != 1 or shape.dtype != torch.int64 or shape.numel() > tensor_codec.MAX_NDIM:
+            raise EncodingError("Sparse shape must be an int64 vector")
+        shape = [int(size) for size in shape]
+        if any(size < 0 for size in shape):
+            raise EncodingError("Negative size in sparse shape")
+        numel = 1
+        for size in shape:
+            numel *= size
+        _check_size(numel, max_bytes)
+        if packed.numel() * 8 < numel:
+            raise EncodingError("Sparse mask is too short")
+        mask = _unpack_bits(packed, numel)
+        if int(mask.sum()) != values.numel():
+            raise EncodingError("Sparse mask does not match values")
+        tensor = torch.zeros(numel, dtype=torch.float32)
+        tensor[mask] = values.float()
+        return tensor.view(shape)
+    raise EncodingError(f"Unknown encoding {encoding}")
+
+
+def _compress(data, compression):
+    if compression == 'zlib':
+        return zlib.compress(data, 1)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise EncodingError("zstandard is not installed")
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if compression == 'lz4':
+        if lz4 is None:
+            raise EncodingError("lz4 is not installed")
+        return lz4.frame.compress(data)
+    raise EncodingError(f"Unknown compression {compression}")
+
+
+def _decompress(data, compression, max_bytes):
+    # 압축을 다 풀기 전에는 크기를 알 수 없으므로 max_bytes를 넘는 순간 멈춘다
+    if compression == 'zlib':
+        decompressor = zlib.decompressobj()
+        output = decompressor.decompress(data, max_bytes + 1)
+        complete = decompressor.eof
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise EncodingError("zstandard is not installed")
+        # frame 헤더의 content size는 클라이언트가 정한 값이므로 믿지 않고 조금씩 읽는다
+        chunks = []
+        size = 0
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            while size <= max_bytes:
+                chunk = reader.read(min(1024 * 1024, max_bytes + 1 - size))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+        output = b''.join(chunks)
+        complete = True
+    elif compression == 'lz4':
+        if lz4 is None:
+            raise EncodingError("lz4 is not installed")
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        output = decompressor.decompress(data, max_length=max_bytes + 1)
+        complete = decompressor.eof
+    else:
+        raise EncodingError(f"Unknown compression {compression}")
+    if len(output) > max_bytes:
+        raise EncodingError(f"Decompressed smashed data exceeds {max_bytes} bytes")
+    if not complete:
+        raise EncodingError("Truncated compressed data")
+    return output
+
+
+# smashed 텐서를 envelope와 body 조각들의 리스트로 만든다
+def encode_smashed(tensor, encoding='raw', compression='none'):
+    if encoding not in ENCODINGS:
+        raise EncodingError(f"Unknown encoding {encoding}")
+    if compression not in COMPRESSIONS:
+        raise EncodingError(f"Unknown compression {compression}")
+    parts = tensor_codec.encode_many(_encode_tensors(tensor, encoding))
+    if compression != 'none':
+        parts = [_compress(b''.join(parts), compression)]
+    return [ENVELOPE.pack(ENCODINGS[encoding], COMPRESSIONS[compression]), *parts]
+
+
+def read_envelope(buffer, offset=0):
+    view = memoryview(buffer)
+    if len(view) < offset + ENVELOPE.size:
+        raise EncodingError("Truncated smashed data envelope")
+    encoding_code, compression_code = ENVELOPE.unpack_from(view, offset)
+    if encoding_code not in ENCODING_NAMES:
+        raise EncodingError(f"Unknown encoding code {encoding_code}")
+    if compression_code not in COMPRESSION_NAMES:
+        raise EncodingError(f"Unknown compression code {compression_code}")
+    return ENCODING_NAMES[encoding_code], COMPRESSION_NAMES[compression_code]
+
+
+# buffer[offset:] 끝까지를 smashed 텐서(float32)로 복원한다.
+# 압축을 푼 body나 복원한 텐서가 max_bytes보다 크면 EncodingError
+def decode_smashed(buffer, offset=0, max_bytes=MAX_DECODED_BYTES):
+    view = memoryview(buffer)
+    encoding, compression = read_envelope(view, offset)
+
+    body = view[offset + ENVELOPE.size:]
+    if compression != 'none':
+        try:
+            body = bytearray(_decompress(body, compression, max_bytes))
+        except EncodingError:
+            raise
+        except Exception as e:
+            raise EncodingError(f"Failed to decompress smashed data: {e}")
+    try:
+        return _decode_tensors(encoding, body, max_bytes)
+    except (tensor_codec.CodecError, RuntimeError, TypeError, ValueError) as e:
+        raise EncodingError(str(e))
+
+
+def encoded_size(parts):
+    return sum(memoryview(part).nbytes for part in parts)
@@ -0,0 +1,282 @@
+# 서버와 클라이언트가 공유하는 길이 기반(length-prefixed) 프레임 프로토콜
+#
+# 모든 메시지는 고정 크기 헤더 뒤에 payload가 오는 프레임이다.
+#   magic(2) | version(1) | opcode(1) | flags(2) | request id(4) | payload length(8)
+# 응답은 요청과 같은 request id를 사용하므로 한 연결에서 여러 요청을 파이프라이닝할 수 있다.
+import time
+import socket
+import select
+import struct
+import asyncio
+from collections import namedtuple
+
+
+MAGIC = b'SL'
+VERSION = 1
+
+HEADER = struct.Struct('!2sBBHIQ')
+HEADER_SIZE = HEADER.size
+
+# opcodes
+OP_DOWNLOAD = 1
+OP_PREDICT = 2
+OP_CAPABILITIES = 3
+OP_PREDICT_STREAM = 4
+OP_TRAIN = 5
+OP_CATALOG = 6
+OP_FEDAVG = 7
+OP_ERROR = 0x7F
+
+OPCODE_NAMES = {
+    OP_DOWNLOAD: 'Download',
+    OP_PREDICT: 'Predict',
+    OP_CAPABILITIES: 'Capabilities',
+    OP_PREDICT_STREAM: 'PredictStream',
+    OP_TRAIN: 'Train',
+    OP_CATALOG: 'Catalog',
+    OP_FEDAVG: 'FedAvg',
+    OP_ERROR: 'Error',
+}
+
+# flags
+FLAG_RESPONSE = 0x0001
+FLAG_NOT_MODIFIED = 0x0002
+# 같은 request id로 프레임이 더 이어진다 (스트리밍 요청/응답). 마지막 프레임에는 붙지 않는다
+FLAG_MORE = 0x0004
+# 요청에 붙이면 Predict 응답 payload 끝에 서버 측 처리 시간(TIMING)을 덧붙인다
+FLAG_TIMING = 0x0008
+# Error 응답에 붙으면 서버가 바빠서 처리하지 않은 요청이다. payload 앞에 RETRY_AFTER가 오므로 그만큼 기다렸다 다시 보내면 된다
+FLAG_RETRY = 0x0010
+
+# 이보다 작은 프레임은 헤더와 합쳐 한 번에 보내서 Nagle 지연을 피한다
+COALESCE_LIMIT = 64 * 1024
+
+# Download, Predict, PredictStream, Train payload 앞에 붙는 모델 지정자 ('name', 'name@version', 빈 문자열은 기본 모델)
+#   length(2) | utf-8 name | padding (뒤따르는 텐서가 8바이트 경계에서 시작하도록)
+MODEL_REF = struct.Struct('!H')
+
+# 서버 측 처리 시간 (초): smashed data 디코딩 | 대기열 + 서버 모델 실행
+TIMING = struct.Struct('!dd')
+
+# 다시 보내기 전에 기다릴 시간 (초)
+RETRY_AFTER = struct.Struct('!d')
+
+# FedAvg 요청: 모델 지정자 | 학습한 샘플 수 | 텐서 수 | 클라이언트 측 state dict 텐서들 (state_dict 순서).
+# 응답은 같은 순서의 평균 텐서들
+FEDAVG = struct.Struct('!QQ')
+
+Frame = namedtuple('Frame', ['opcode', 'flags', 'request_id', 'payload'])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(opcode, request_id, length, flags=0):
+    return HEADER.pack(MAGIC, VERSION, opcode, flags, request_id, length)
+
+
+def unpack_header(header):
+    magic, version, opcode, flags, request_id, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad magic {magic!r}")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    return opcode, flags, request_id, length
+
+
+def pack_model_ref(ref=''):
+    data = ref.encode()
+    packed = MODEL_REF.pack(len(data)) + data
+    return packed + bytes(-len(packed) % 8)
+
+
+def unpack_model_ref(payload):
+    # 프레임 경계는 그대로이므로 요청 하나의 오류(ValueError)로 보고 연결은 유지한다
+    if len(payload) < MODEL_REF.size:
+        raise ValueError("Missing model reference")
+    (length,) = MODEL_REF.unpack_from(payload)
+    end = MODEL_REF.size + length
+    if len(payload) < end:
+        raise ValueError("Truncated model reference")
+    try:
+        ref = bytes(payload[MODEL_REF.size:end]).decode()
+    except UnicodeDecodeError:
+        raise ValueError("Model reference is not valid utf-8")
+    return ref, end + (-end % 8)
+
+
+def pack_timing(decode_seconds, inference_seconds):
+    return TIMING.pack(decode_seconds, inference_seconds)
+
+
+def unpack_timing(payload):
+    # 텐서 뒤에 붙은 TIMING을 payload 끝에서 읽는다
+    if len(payload) < TIMING.size:
+        raise ProtocolError("Missing timing trailer")
+    return TIMING.unpack_from(payload, len(payload) - TIMING.size)
+
+
+def pack_busy(retry_after, message):
+    return RETRY_AFTER.pack(retry_after) + message.encode()
+
+
+def retry_after(frame):
+    # 바빠서 거절된 요청이면 기다릴 시간, 아니면 None
+    if frame.opcode != OP_ERROR or not frame.flags & FLAG_RETRY or len(frame.payload) < RETRY_AFTER.size:
+        return None
+    return RETRY_AFTER.unpack_from(frame.payload)[0]
+
+
+def error_message(frame):
+    payload = frame.payload
+    if frame.flags & FLAG_RETRY:
+        payload = payload[RETRY_AFTER.size:]
+    return bytes(payload).decode(errors='replace')
+
+
+def opcode_name(opcode):
+    return OPCODE_NAMES.get(opcode, f"Unknown({opcode})")
+
+
+def set_deadline(sock, deadline):
+    # settimeout은 recv/send 한 번마다 적용되므로, 여러 번에 나누어 주고받는 전체가 deadline(time.monotonic() 기준)
+    # 안에 끝나도록 매번 남은 시간으로 줄인다. deadline이 None이면 소켓의 timeout을 그대로 쓴다
+    if deadline is None:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("Deadline exceeded")
+    sock.settimeout(remaining)
+
+
+def recv_into_exact(sock, buffer, deadline=None):
+    view = memoryview(buffer)
+    while len(view):
+        set_deadline(sock, deadline)
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("Connection lost while receiving data")
+        view = view[received:]
+    return buffer
+
+
+def enable_keepalive(sock, idle=60, interval=10, count=5):
+    # 상대 호스트가 사라져도(전원 꺼짐, 네트워크 끊김) idle + interval * count초 안에 연결 오류로 알 수 있게 한다
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    if hasattr(socket, 'SIO_KEEPALIVE_VALS') and hasattr(sock, 'ioctl'):
+        # Windows
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+
+
+def peer_closed(sock):
+    # 읽을 수 있는데 읽을 데이터가 없으면(EOF) 상대가 연결을 닫은 것이다. 데이터는 들여다보기만 하고 읽지 않는다
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+def discard_exact(sock, length, chunk_size=64 * 1024, deadline=None):
+    # 거절한 요청의 payload를 작은 버퍼로 읽어 버려서 다음 프레임 경계를 맞춘다
+    buffer = bytearray(min(length, chunk_size))
+    view = memoryview(buffer)
+    while length:
+        set_deadline(sock, deadline)
+        received = sock.recv_into(view[:min(length, len(buffer))])
+        if not received:
+            raise ConnectionError("Connection lost while receiving data")
+        length -= received
+
+
+def recv_header(sock):
+    # 프레임 경계에서 연결이 닫히면 None을 반환
+    header = bytearray(HEADER_SIZE)
+    view = memoryview(header)
+    received = 0
+    while received < HEADER_SIZE:
+        count = sock.recv_into(view[received:])
+        if not count:
+            if received == 0:
+                return None
+            raise ConnectionError("Connection lost while receiving header")
+        received += count
+    return unpack_header(header)
+
+
+def recv_frame(sock):
+    header = recv_header(sock)
+    if header is None:
+        return None
+    opcode, flags, request_id, length = header
+    payload = recv_into_exact(sock, bytearray(length))
+    return Frame(opcode, flags, request_id, payload)
+
+
+def send_frame(sock, opcode, request_id, *parts, flags=0, deadline=None):
+    length = sum(memoryview(part).nbytes for part in parts)
+    header = pack_header(opcode, request_id, length, flags)
+    if length <= COALESCE_LIMIT:
+        set_deadline(sock, deadline)
+        sock.sendall(b''.join([header, *parts]))
+        return HEADER_SIZE + length
+    for part in (header, *parts):
+        set_deadline(sock, deadline)
+        sock.sendall(part)
+    return HEADER_SIZE + length
+
+
+def sendfile_exact(sock, file, offset, count, deadline=None, chunk_size=1024 * 1024):
+    # sendfile은 전송이 진행되는 동안 timeout을 다시 세므로 조각마다 deadline을 확인한다
+    while count:
+        set_deadline(sock, deadline)
+        sent = sock.sendfile(file, offset, min(count, chunk_size))
+        if not sent:
+            raise ConnectionError("File ended before all data was sent")
+        offset += sent
+        count -= sent
+
+
+def send_error(sock, request_id, message):
+    return send_frame(sock, OP_ERROR, request_id, message.encode(), flags=FLAG_RESPONSE)
+
+
+async def read_frame(reader):
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    opcode, flags, request_id, length = unpack_header(header)
+    payload = bytearray(await reader.readexactly(length))
+    return Frame(opcode, flags, request_id, payload)
+
+
+async def discard(reader, length, chunk_size=64 * 1024):
+    while length:
+        length -= len(await reader.readexactly(min(length, chunk_size)))
+
+
+async def write_frame(writer, opcode, request_id, *parts, flags=0, timeout=None):
+    # timeout: 상대가 응답을 읽지 않아 전송 버퍼가 비지 않을 때 기다리는 최대 시간 (asyncio.TimeoutError)
+    length = sum(memoryview(part).nbytes for part in parts)
+    writer.write(pack_header(opcode, request_id, length, flags))
+    for part in parts:
+        writer.write(part)
+    await asyncio.wait_for(writer.drain(), timeout)
+    return HEADER_SIZE + length
+
+
+async def write_error(writer, request_id, message):
+    return await write_frame(writer, OP_ERROR, request_id, message.encode(), flags=FLAG_RESPONSE)
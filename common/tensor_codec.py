@@ -0,0 +1,113 @@
+# pickle(torch.save) 없이 텐서를 주고받기 위한 raw 텐서 포맷
+#
+#   dtype(1) | ndim(1) | shape(8 * ndim) | strides(8 * ndim) | padding | storage bytes
+# 헤더는 8바이트 단위로 맞춰서, 받은 버퍼 위에 torch.frombuffer로 바로 텐서를 만들 수 있게 한다.
+import struct
+
+import torch
+
+
+DTYPES = {
+    1: torch.float32,
+    2: torch.float64,
+    3: torch.float16,
+    4: torch.bfloat16,
+    5: torch.int64,
+    6: torch.int32,
+    7: torch.int16,
+    8: torch.int8,
+    9: torch.uint8,
+    10: torch.bool,
+}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+PREFIX = struct.Struct('!BB')
+MAX_NDIM = 16
+ALIGNMENT = 8
+
+
+class CodecError(Exception):
+    pass
+
+
+def _dense(tensor):
+    # 메모리상에서 빈틈없이 연속된 텐서(contiguous, channels_last 등)는 복사 없이 그대로 보낸다
+    order = sorted(range(tensor.dim()), key=lambda d: tensor.stride(d), reverse=True)
+    if tensor.permute(order).is_contiguous():
+        return tensor, tensor.permute(order).reshape(-1)
+    tensor = tensor.contiguous()
+    return tensor, tensor.reshape(-1)
+
+
+def _header(tensor):
+    ndim = tensor.dim()
+    header = PREFIX.pack(DTYPE_CODES[tensor.dtype], ndim)
+    header += struct.pack(f'!{ndim}q{ndim}q', *tensor.shape, *tensor.stride())
+    padding = -len(header) % ALIGNMENT
+    return header + bytes(padding)
+
+
+# 텐서를 (header, data) 두 부분으로 나눈다. data는 텐서 메모리를 가리키는 memoryview다.
+def encode(tensor):
+    tensor = tensor.detach().cpu()
+    if tensor.dtype not in DTYPE_CODES:
+        raise CodecError(f"Unsupported dtype {tensor.dtype}")
+    tensor, flat = _dense(tensor)
+    if flat.numel() == 0:
+        return _header(tensor), memoryview(b'')
+    return _header(tensor), memoryview(flat.view(torch.uint8).numpy())
+
+
+def encode_many(tensors):
+    parts = []
+    for tensor in tensors:
+        parts.extend(encode(tensor))
+    return parts
+
+
+# buffer[offset:]의 텐서를 복사 없이 복원하고 (tensor, 다음 offset)을 반환한다.
+def decode(buffer, offset=0):
+    view = memoryview(buffer)
+    if len(view) < offset + PREFIX.size:
+        raise CodecError("Truncated tensor header")
+    code, ndim = PREFIX.unpack_from(view, offset)
+    if code not in DTYPES:
+        raise CodecError(f"Unknown dtype code {code}")
+    if ndim > MAX_NDIM:
+        raise CodecError(f"Too many dimensions: {ndim}")
+
+    dims_offset = offset + PREFIX.size
+    if len(view) < dims_offset + 16 * ndim:
+        raise CodecError("Truncated tensor header")
+    dims = struct.unpack_from(f'!{ndim}q{ndim}q', view, dims_offset)
+    shape, strides = dims[:ndim], dims[ndim:]
+    if any(size < 0 for size in shape) or any(stride < 0 for stride in strides):
+        raise CodecError("Negative size or stride")
+
+    header_size = PREFIX.size + 16 * ndim
+    data_offset = offset + header_size + (-header_size % ALIGNMENT)
+    dtype = DTYPES[code]
+    numel = 1
+    for size in shape:
+        numel *= size
+    nbytes = numel * torch.empty((), dtype=dtype).element_size()
+    if len(view) < data_offset + nbytes:
+        raise CodecError("Truncated tensor data")
+
+    if numel == 0:
+        return torch.empty(shape, dtype=dtype), data_offset
+    flat = torch.frombuffer(view, dtype=dtype, count=numel, offset=data_offset)
+    # as_strided는 스토리지 범위를 벗어나는 stride를 거부한다
+    try:
+        tensor = flat.as_strided(shape, strides)
+    except RuntimeError as e:
+        raise CodecError(f"Invalid strides: {e}")
+    return tensor, data_offset + nbytes
+
+
+def decode_many(buffer, count, offset=0):
+    tensors = []
+    for _ in range(count):
+        tensor, offset = decode(buffer, offset)
+        tensors.append(tensor)
+    return tensors, offset
@@ -0,0 +1,196 @@
+# 서버 측 모델을 CPU 추론용으로 변환한다.
+#
+#   1. BatchNorm을 앞의 conv 가중치에 접어 넣는다 (torch.fx)
+#   2. 선택한 모듈(기본 layer1, layer2, fc)을 int8로 양자화한다
+#        dynamic: Linear만 (가중치 int8, 활성값은 실행 중에 양자화)
+#        static:  conv+bn+relu를 묶은 뒤 MNIST 데이터로 보정(calibration)해서 conv까지 int8로
+#   3. TorchScript로 trace한 뒤 freeze해서 저장한다. 서버는 이 파일을 state dict 대신 그대로 로드한다
+#   4. 같은 MNIST 데이터에서 원래 모델과 정확도, 예측 일치율, 실행 시간을 비교하고
+#      정확도가 --max-accuracy-drop(%p)보다 많이 떨어지면 저장하지 않는다
+#
+#   python export.py --data ../server/test.pt --quantize static --output ../server/server_model.ts
+#   (catalog.json의 모델 항목에 "optimized_model": "server_model.ts" 추가)
+import os
+import sys
+import copy
+import time
+import zipfile
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.fx.experimental.optimization import fuse
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))  # 상위 경로 import 가능
+
+from models.splitter import load_half
+
+
+DEFAULT_MODULES = ['layer1', 'layer2', 'fc']
+
+
+def is_torchscript(path):
+    # torch.save 파일도 zip이지만 TorchScript 파일에만 constants.pkl이 들어 있다
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith('/constants.pkl') for name in archive.namelist())
+
+
+def load_server_model(path, map_location='cpu'):
+    if is_torchscript(path):
+        return torch.jit.load(path, map_location=map_location)
+    return load_half(path, 'server', map_location)
+
+
+def fold_batchnorm(model):
+    # eval 모드의 BatchNorm은 고정된 affine 변환이므로 conv의 weight/bias에 합칠 수 있다 (shortcut 포함)
+    return fuse(model.eval())
+
+
+def _selected(name, modules):
+    return any(name == module or name.startswith(module + '.') for module in modules)
+
+
+def quantize_dynamic(model, modules):
+    qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig
+                    for name, module in model.named_modules()
+                    if isinstance(module, nn.Linear) and _selected(name, modules)}
+    if not qconfig_spec:
+        print("No Linear layer to quantize in the selected modules")
+        return model
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+def quantization_engine():
+    supported = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in supported:
+            return engine
+    raise RuntimeError(f"No quantized engine available (supported: {supported})")
+
+
+def quantize_static(model, modules, calibration_batches):
+    from torch.ao.quantization import QConfigMapping, get_default_qconfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = quantization_engine()
+    torch.backends.quantized.engine = engine
+    qconfig = get_default_qconfig(engine)
+    mapping = QConfigMapping()
+    for module in modules:
+        mapping.set_module_name(module, qconfig)
+
+    # prepare_fx가 conv+bn+relu를 하나로 묶고 선택한 모듈 앞뒤에 observer를 넣는다
+    prepared = prepare_fx(copy.deepcopy(model).eval(), mapping, example_inputs=(calibration_batches[0],))
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def to_torchscript(model, example, optimize=True):
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+        if optimize:
+            # conv+relu 결합, 가중치 미리 변환(prepacking) 등 CPU 추론용 그래프 최적화
+            scripted = torch.jit.optimize_for_inference(scripted)
+    return scripted
+
+
+def load_mnist(path, count=None):
+    data, labels = torch.load(path)
+    if count:
+        data, labels = data[:count], labels[:count]
+    return data.unsqueeze(1).float(), labels
+
+
+def smash(client, data, batch_size):
+    with torch.inference_mode():
+        return [client(data[start:start + batch_size]) for start in range(0, len(data), batch_size)]
+
+
+def evaluate(model, smashed_batches, labels, repeats=1):
+    outputs = []
+    seconds = 0.0
+    with torch.inference_mode():
+        for _ in range(repeats):
+            outputs = []
+            started = time.perf_counter()
+            for batch in smashed_batches:
+                outputs.append(model(batch))
+            seconds += time.perf_counter() - started
+    output = torch.cat(outputs)
+    return {
+        'output': output,
+        'accuracy': (output.argmax(dim=1) == labels).float().mean().item() * 100,
+        'ms_per_batch': seconds / repeats / len(smashed_batches) * 1000,
+    }
+
+
+def check_accuracy(eager, exported, smashed_batches, labels, repeats=3):
+    # 첫 실행은 TorchScript 최적화가 일어나므로 한 번 돌린 뒤에 잰다
+    evaluate(exported, smashed_batches[:1], labels[:len(smashed_batches[0])])
+    reference = evaluate(eager, smashed_batches, labels, repeats)
+    result = evaluate(exported, smashed_batches, labels, repeats)
+    return {
+        'eager_accuracy': reference['accuracy'],
+        'exported_accuracy': result['accuracy'],
+        'agreement': (reference['output'].argmax(dim=1) == result['output'].argmax(dim=1)).float().mean().item() * 100,
+        'max_abs_diff': (reference['output'] - result['output']).abs().max().item(),
+        'eager_ms': reference['ms_per_batch'],
+        'exported_ms': result['ms_per_batch'],
+    }
+
+
+def export(client, server, data, labels, quantize='none', modules=DEFAULT_MODULES, batch_size=256,
+           calibration_batches=32):
+    eager = server.eval()
+    smashed_batches = smash(client.eval(), data, batch_size)
+
+    model = fold_batchnorm(eager)
+    modules = [module for module in modules if module in dict(model.named_modules())]
+    if quantize == 'dynamic':
+        model = quantize_dynamic(model, modules)
+    elif quantize == 'static':
+        model = quantize_static(model, modules, smashed_batches[:calibration_batches])
+
+    # 양자화된 그래프는 optimize_for_inference의 mkldnn 변환 대상이 아니므로 freeze만 한다
+    exported = to_torchscript(model, smashed_batches[0], optimize=quantize == 'none')
+    return exported, check_accuracy(eager, exported, smashed_batches, labels)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--client-model', default='../server/client_model.pt')
+    parser.add_argument('--server-model', default='../server/server_model.pt')
+    parser.add_argument('--data', default='../server/test.pt', help='MNIST test data for calibration and the check')
+    parser.add_argument('--count', type=int, default=None, help='use only the first COUNT samples')
+    parser.add_argument('--quantize', choices=['none', 'dynamic', 'static'], default='none')
+    parser.add_argument('--modules', default=','.join(DEFAULT_MODULES), help='modules to quantize')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--calibration-batches', type=int, default=32)
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.5, help='percentage points')
+    parser.add_argument('--output', default='../server/server_model.ts')
+    args = parser.parse_args()
+
+    client = load_half(args.client_model, 'client')
+    server = load_half(args.server_model, 'server')
+    data, labels = load_mnist(args.data, args.count)
+    modules = [module for module in args.modules.split(',') if module]
+
+    exported, report = export(client, server, data, labels, args.quantize, modules, args.batch_size,
+                              args.calibration_batches)
+
+    print(f"accuracy: eager {report['eager_accuracy']:.2f}% -> exported {report['exported_accuracy']:.2f}% "
+          f"(agreement {report['agreement']:.2f}%, max |diff| {report['max_abs_diff']:.4f})")
+    print(f"server model time per batch of {args.batch_size}: eager {report['eager_ms']:.2f} ms -> "
+          f"exported {report['exported_ms']:.2f} ms ({report['eager_ms'] / report['exported_ms']:.2f}x)")
+
+    drop = report['eager_accuracy'] - report['exported_accuracy']
+    if drop > args.max_accuracy_drop:
+        print(f"Accuracy dropped by {drop:.2f}%p (limit {args.max_accuracy_drop}%p), {args.output} not written")
+        sys.exit(1)
+
+    torch.jit.save(exported, args.output)
+    print(f"Saved {args.output}; set \"optimized_model\": \"{os.path.basename(args.output)}\" in catalog.json to serve it")
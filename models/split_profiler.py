@@ -0,0 +1,132 @@
+# 레이어별 실행 시간과 출력 크기를 측정해서, 주어진 클라이언트 성능/네트워크 조건에서
+# end-to-end 지연 시간이 가장 짧거나 처리량이 가장 높은 분할 지점을 고른다
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+import torch.fx as fx
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))  # 상위 경로 import 가능
+
+from models.splitter import Splitter, ARCHITECTURES, DEFAULT_ARCH, split_checkpoint
+
+
+INPUT_SHAPES = {
+    'resnet': (1, 28, 28),
+}
+
+
+class _TimingInterpreter(fx.Interpreter):
+    def __init__(self, module):
+        super(_TimingInterpreter, self).__init__(module)
+        self.latency = {}
+        self.output_bytes = {}
+
+    def run_node(self, n):
+        started = time.perf_counter()
+        result = super(_TimingInterpreter, self).run_node(n)
+        self.latency[n.name] = self.latency.get(n.name, 0.0) + time.perf_counter() - started
+        if isinstance(result, torch.Tensor):
+            self.output_bytes[n.name] = result.numel() * result.element_size()
+        return result
+
+
+def profile_layers(model, sample_input, repeats=20, warmup=3):
+    model.eval()
+    graph_module = fx.GraphModule(model, Splitter(model).trace())
+    interpreter = _TimingInterpreter(graph_module)
+    with torch.inference_mode():
+        for _ in range(warmup):
+            interpreter.run(sample_input)
+        interpreter.latency.clear()
+        for _ in range(repeats):
+            interpreter.run(sample_input)
+
+    layers = []
+    for node in graph_module.graph.nodes:
+        if node.op in ('placeholder', 'output'):
+            continue
+        layers.append({
+            'name': node.name,
+            'seconds': interpreter.latency.get(node.name, 0.0) / repeats,
+            'output_bytes': interpreter.output_bytes.get(node.name, 0),
+        })
+    return layers
+
+
+# 분할 지점마다 클라이언트 계산, 전송, 서버 계산 시간을 추정한다
+def estimate(layers, split_points, client_slowdown, server_slowdown, bandwidth, rtt):
+    output_bytes = layers[-1]['output_bytes']
+    estimates = []
+    for point in split_points:
+        index = next(i for i, layer in enumerate(layers) if layer['name'] == point)
+        client_seconds = sum(layer['seconds'] for layer in layers[:index + 1]) * client_slowdown
+        server_seconds = sum(layer['seconds'] for layer in layers[index + 1:]) * server_slowdown
+        smashed_bytes = layers[index]['output_bytes']
+        network_seconds = rtt + (smashed_bytes + output_bytes) / bandwidth
+        estimates.append({
+            'split_point': point,
+            'client_seconds': client_seconds,
+            'network_seconds': network_seconds,
+            'server_seconds': server_seconds,
+            'smashed_bytes': smashed_bytes,
+            'latency_seconds': client_seconds + network_seconds + server_seconds,
+            # 파이프라인으로 겹쳐 실행하면 가장 느린 단계가 처리량을 결정한다
+            'bottleneck_seconds': max(client_seconds, network_seconds, server_seconds),
+        })
+    return estimates
+
+
+def choose(estimates, objective='latency'):
+    key = 'latency_seconds' if objective == 'latency' else 'bottleneck_seconds'
+    return min(estimates, key=lambda estimate: estimate[key])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', default=DEFAULT_ARCH, choices=list(ARCHITECTURES))
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--client-slowdown', type=float, default=4.0,
+                        help='how many times slower the client is than this machine')
+    parser.add_argument('--server-slowdown', type=float, default=1.0,
+                        help='how many times slower the server is than this machine')
+    parser.add_argument('--bandwidth-mbps', type=float, default=100.0)
+    parser.add_argument('--rtt-ms', type=float, default=20.0)
+    parser.add_argument('--objective', choices=['latency', 'throughput'], default='latency')
+    parser.add_argument('--weights', help='split this checkpoint at the chosen point')
+    parser.add_argument('--client-out', default='../server/client_model.pt')
+    parser.add_argument('--server-out', default='../server/server_model.pt')
+    parser.add_argument('--json', help='save the profile and estimates to this file')
+    args = parser.parse_args()
+
+    model = ARCHITECTURES[args.arch]()
+    sample_input = torch.randn(args.batch_size, *INPUT_SHAPES[args.arch])
+    layers = profile_layers(model, sample_input, args.repeats)
+    estimates = estimate(layers, Splitter(model).split_points(), args.client_slowdown, args.server_slowdown,
+                         args.bandwidth_mbps * 1e6 / 8, args.rtt_ms / 1000)
+    best = choose(estimates, args.objective)
+
+    print(f"{'layer':<16} {'ms':>8} {'output KB':>10}")
+    for layer in layers:
+        print(f"{layer['name']:<16} {layer['seconds'] * 1000:>8.3f} {layer['output_bytes'] / 1024:>10.1f}")
+    print()
+    print(f"{'split point':<16} {'client ms':>10} {'network ms':>11} {'server ms':>10} {'latency ms':>11} "
+          f"{'samples/s':>10}")
+    for item in estimates:
+        marker = ' *' if item is best else ''
+        print(f"{item['split_point']:<16} {item['client_seconds'] * 1000:>10.2f} {item['network_seconds'] * 1000:>11.2f} "
+              f"{item['server_seconds'] * 1000:>10.2f} {item['latency_seconds'] * 1000:>11.2f} "
+              f"{args.batch_size / item['bottleneck_seconds']:>10.0f}{marker}")
+    print(f"\nBest split point for {args.objective}: {best['split_point']}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'layers': layers, 'estimates': estimates, 'best': best['split_point']}, file, indent=2)
+
+    if args.weights:
+        split_checkpoint(args.weights, args.client_out, args.server_out, args.arch, best['split_point'])
+        print(f"Split {args.weights} at {best['split_point']} into {args.client_out} and {args.server_out}")
@@ -0,0 +1,175 @@
+# Functions for splitting Pytorch model
+#
+# torch.fx로 모델을 추적한 뒤 지정한 노드(레이어)를 기준으로 그래프를 둘로 나눈다.
+# 분할 지점까지가 클라이언트 측 모델, 그 이후가 서버 측 모델이 된다.
+# 두 모델의 파라미터 이름은 원래 모델과 같으므로 학습된 state dict를 그대로 나눌 수 있다.
+import os
+import sys
+import argparse
+
+import torch
+import torch.fx as fx
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))  # 상위 경로 import 가능
+
+from models.resnet import ResNet, ResNetClient, ResNetServer
+
+
+ARCHITECTURES = {
+    'resnet': ResNet,
+}
+
+# ResNetClient / ResNetServer와 같은 분할 지점
+DEFAULT_ARCH = 'resnet'
+DEFAULT_SPLIT_POINT = 'relu'
+
+# 분할 지점이 기본값이면 기존 클래스로 불러올 수 있도록 일반 state dict로 저장한다
+LEGACY_CLASSES = {
+    'client': ResNetClient,
+    'server': ResNetServer,
+}
+
+
+class _SplitTracer(fx.Tracer):
+    def __init__(self, leaves):
+        super(_SplitTracer, self).__init__()
+        self.leaves = leaves
+
+    def is_leaf_module(self, m, module_qualified_name):
+        return module_qualified_name in self.leaves
+
+
+class Splitter:
+    def __init__(self, model):
+        self.model = model
+
+    def _leaves(self, split_point=None):
+        # 기본적으로 최상위 레이어 단위로 추적하고, 하위 모듈에서 나누는 경우에만 그 경로를 펼친다
+        leaves = set(name for name, _ in self.model.named_children())
+        modules = dict(self.model.named_modules())
+        if split_point in modules and split_point not in leaves:
+            parts = split_point.split('.')
+            for i in range(1, len(parts)):
+                prefix = '.'.join(parts[:i])
+                leaves.discard(prefix)
+                leaves.update(f"{prefix}.{name}" for name, _ in modules[prefix].named_children())
+        return leaves
+
+    def trace(self, split_point=None):
+        return _SplitTracer(self._leaves(split_point)).trace(self.model)
+
+    def split_points(self):
+        # 그래프를 한 점에서 자를 수 있는(이후 노드가 그 노드의 출력만 쓰는) 후보들
+        graph = self.trace()
+        nodes = list(graph.nodes)
+        points = []
+        for index, node in enumerate(nodes):
+            if node.op in ('placeholder', 'output', 'get_attr'):
+                continue
+            if self._crossing_inputs(nodes, index) == {node}:
+                points.append(node.name)
+        return points
+
+    def _crossing_inputs(self, nodes, index):
+        client_nodes = set(nodes[:index + 1])
+        crossing = set()
+        for node in nodes[index + 1:]:
+            for input_node in node.all_input_nodes:
+                if input_node in client_nodes and input_node.op != 'get_attr':
+                    crossing.add(input_node)
+        return crossing
+
+    def _find(self, graph, split_point):
+        nodes = list(graph.nodes)
+        for index, node in enumerate(nodes):
+            if node.name == split_point:
+                return nodes, index
+        matches = [index for index, node in enumerate(nodes)
+                   if node.op == 'call_module' and node.target == split_point]
+        if len(matches) > 1:
+            raise ValueError(f"{split_point} is called more than once; split at a node name instead")
+        if not matches:
+            raise ValueError(f"Split point {split_point} not found")
+        return nodes, matches[0]
+
+    def split(self, split_point=DEFAULT_SPLIT_POINT):
+        graph = self.trace(split_point)
+        nodes, index = self._find(graph, split_point)
+        split_node = nodes[index]
+        if split_node.op in ('placeholder', 'output', 'get_attr'):
+            raise ValueError(f"Cannot split at {split_node.op} node {split_point}")
+        crossing = self._crossing_inputs(nodes, index)
+        if crossing != {split_node}:
+            others = sorted(node.name for node in crossing if node is not split_node)
+            raise ValueError(f"{split_point} is not a valid split point: server side also uses {others}")
+
+        client_graph = fx.Graph()
+        env = {}
+        for node in nodes[:index + 1]:
+            env[node] = client_graph.node_copy(node, lambda n: env[n])
+        client_graph.output(env[split_node])
+
+        server_graph = fx.Graph()
+        env = {split_node: server_graph.placeholder('smashed_x')}
+        for node in nodes[:index + 1]:
+            if node.op == 'get_attr':
+                env[node] = server_graph.node_copy(node, lambda n: env[n])
+        for node in nodes[index + 1:]:
+            env[node] = server_graph.node_copy(node, lambda n: env[n])
+
+        client = fx.GraphModule(self.model, client_graph, class_name='ClientModel')
+        server = fx.GraphModule(self.model, server_graph, class_name='ServerModel')
+        return client, server
+
+    def split_state_dict(self, state_dict, split_point=DEFAULT_SPLIT_POINT):
+        self.model.load_state_dict(state_dict)
+        client, server = self.split(split_point)
+        return client.state_dict(), server.state_dict()
+
+
+def build_half(arch, split_point, side):
+    client, server = Splitter(ARCHITECTURES[arch]()).split(split_point)
+    return client if side == 'client' else server
+
+
+def save_half(path, state_dict, side, arch=DEFAULT_ARCH, split_point=DEFAULT_SPLIT_POINT):
+    if arch == DEFAULT_ARCH and split_point == DEFAULT_SPLIT_POINT:
+        torch.save(state_dict, path)
+    else:
+        torch.save({'arch': arch, 'split_point': split_point, 'side': side, 'state_dict': state_dict}, path)
+
+
+def load_half(path, side, map_location='cpu'):
+    checkpoint = torch.load(path, map_location=map_location)
+    if isinstance(checkpoint, dict) and 'split_point' in checkpoint:
+        model = build_half(checkpoint['arch'], checkpoint['split_point'], side)
+        model.load_state_dict(checkpoint['state_dict'])
+    else:
+        model = LEGACY_CLASSES[side]()
+        model.load_state_dict(checkpoint)
+    return model
+
+
+def split_checkpoint(weights_path, client_path, server_path, arch=DEFAULT_ARCH, split_point=DEFAULT_SPLIT_POINT):
+    splitter = Splitter(ARCHITECTURES[arch]())
+    client_state, server_state = splitter.split_state_dict(torch.load(weights_path, map_location='cpu'), split_point)
+    save_half(client_path, client_state, 'client', arch, split_point)
+    save_half(server_path, server_state, 'server', arch, split_point)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', default=DEFAULT_ARCH, choices=list(ARCHITECTURES))
+    parser.add_argument('--weights', default='mnist-resnet.pt')
+    parser.add_argument('--split-at', default=DEFAULT_SPLIT_POINT)
+    parser.add_argument('--client-out', default='../server/client_model.pt')
+    parser.add_argument('--server-out', default='../server/server_model.pt')
+    parser.add_argument('--list', action='store_true', help='list valid split points and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for point in Splitter(ARCHITECTURES[args.arch]()).split_points():
+            print(point)
+    else:
+        split_checkpoint(args.weights, args.client_out, args.server_out, args.arch, args.split_at)
+        print(f"Split {args.weights} at {args.split_at} into {args.client_out} and {args.server_out}")
@@ -0,0 +1,151 @@
+# MNIST 학습용 데이터 파이프라인과 학습/평가 루프.
+#
+# - 데이터셋은 uint8 그대로 .npy로 한 번 변환해 두고 np.load(mmap_mode='r')로 연다.
+#   전체를 float로 미리 바꾸지 않고, batch를 꺼낼 때마다 uint8 -> float로 바꾼다 (메모리 1/4).
+# - DataLoader는 샘플 하나씩이 아니라 batch 단위로 인덱싱하고(BatchSampler),
+#   여러 워커 프로세스, pinned memory, prefetch로 학습과 데이터 준비를 겹친다.
+# - channels_last와 bf16 autocast(CPU/GPU)를 선택할 수 있고, epoch마다 처리량(samples/s)을 잰다.
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+
+
+def memmap_paths(prefix):
+    return f"{prefix}-images.npy", f"{prefix}-labels.npy"
+
+
+def convert_dataset(pt_path, prefix=None):
+    # torch.save로 저장된 (images, labels)를 mmap으로 열 수 있는 .npy 두 개로 변환한다
+    prefix = prefix or os.path.splitext(pt_path)[0]
+    images_path, labels_path = memmap_paths(prefix)
+    images, labels = torch.load(pt_path)
+    np.save(images_path, images.to(torch.uint8).numpy())
+    np.save(labels_path, labels.to(torch.int64).numpy())
+    return prefix
+
+
+def ensure_memmap(pt_path):
+    # 변환한 파일이 없거나 원본보다 오래되었으면 다시 변환한다
+    prefix = os.path.splitext(pt_path)[0]
+    images_path, labels_path = memmap_paths(prefix)
+    source_mtime = os.stat(pt_path).st_mtime
+    if not all(os.path.exists(path) and os.stat(path).st_mtime >= source_mtime for path in (images_path, labels_path)):
+        print(f"Converting {pt_path} to memory-mapped uint8 files...")
+        convert_dataset(pt_path, prefix)
+    return prefix
+
+
+class MemmapDataset(Dataset):
+    # 인덱스 목록을 받아 batch 하나를 돌려준다: (N, 1, H, W) uint8 이미지, (N,) int64 레이블
+    def __init__(self, prefix):
+        self.images_path, self.labels_path = memmap_paths(prefix)
+        self.length = len(np.load(self.labels_path, mmap_mode='r'))
+        self._images = None
+        self._labels = None
+
+    def __getstate__(self):
+        # 워커 프로세스에는 경로만 보내고, 워커가 각자 파일을 mmap으로 연다 (데이터 복사 없음)
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_labels'] = None
+        return state
+
+    def _open(self):
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode='r')
+            self._labels = np.load(self.labels_path, mmap_mode='r')
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, indices):
+        self._open()
+        # mmap에서 연속으로 읽도록 정렬한다 (batch 안의 순서는 학습에 영향 없음)
+        indices = np.sort(np.asarray(indices))
+        images = torch.from_numpy(np.ascontiguousarray(self._images[indices]))
+        labels = torch.from_numpy(np.ascontiguousarray(self._labels[indices]))
+        return images.unsqueeze(1), labels
+
+
+def make_loader(dataset, batch_size, shuffle=False, workers=0, pin_memory=False, prefetch=2):
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    options = {}
+    if workers > 0:
+        options = {'prefetch_factor': prefetch, 'persistent_workers': True}
+    # batch_size=None: Dataset이 이미 batch를 만들어 주므로 DataLoader는 다시 묶지 않는다
+    return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last=False),
+                      num_workers=workers, pin_memory=pin_memory, **options)
+
+
+class Trainer:
+    def __init__(self, model, optimizer, criterion, device, channels_last=False, bf16=False):
+        self.device = device
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        self.model = model.to(device)
+        self.optimizer = optimizer
+        self.criterion = criterion
+
+    def _input(self, images):
+        # uint8로 전송한 뒤 장치에서 float로 바꾼다
+        images = images.to(self.device, non_blocking=True).float()
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images
+
+    def _autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.bf16)
+
+    def train_epoch(self, loader, log_every=100, epoch=None):
+        self.model.train()
+        total_loss = 0.0
+        samples = 0
+        started = time.perf_counter()
+        for i, (images, labels) in enumerate(loader):
+            data = self._input(images)
+            labels = labels.to(self.device, non_blocking=True)
+            self.optimizer.zero_grad(set_to_none=True)
+            with self._autocast():
+                outputs = self.model(data)
+                loss = self.criterion(outputs, labels)
+            loss.backward()
+            self.optimizer.step()
+
+            total_loss += loss.item() * labels.size(0)
+            samples += labels.size(0)
+            if log_every and (i + 1) % log_every == 0:
+                print(f"Epoch [{epoch}], Step [{i + 1}/{len(loader)}], Loss: {loss.item():.4f}")
+        seconds = time.perf_counter() - started
+        return {
+            'loss': total_loss / samples if samples else 0.0,
+            'samples': samples,
+            'seconds': seconds,
+            'samples_per_second': samples / seconds if seconds else 0.0,
+        }
+
+    def evaluate(self, loader):
+        self.model.eval()
+        correct = 0
+        samples = 0
+        started = time.perf_counter()
+        with torch.inference_mode(), self._autocast():
+            for images, labels in loader:
+                outputs = self.model(self._input(images))
+                correct += (outputs.argmax(dim=1).cpu() == labels).sum().item()
+                samples += labels.size(0)
+        seconds = time.perf_counter() - started
+        return {
+            'accuracy': 100 * correct / samples if samples else 0.0,
+            'samples': samples,
+            'seconds': seconds,
+            'samples_per_second': samples / seconds if seconds else 0.0,
+        }
+
+    def state_dict(self):
+        # channels_last로 바꾼 가중치도 일반 텐서처럼 저장되도록 contiguous로 만든다
+        return {key: value.contiguous() for key, value in self.model.state_dict().items()}
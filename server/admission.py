@@ -0,0 +1,126 @@
+import time
+import threading
+
+from metrics import Counter
+
+
+class PayloadTooLargeError(Exception):
+    pass
+
+
+class ServerBusyError(Exception):
+    def __init__(self, message, retry_after):
+        super(ServerBusyError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        # 토큰을 하나 쓰면 0, 부족하면 다음 토큰까지 기다릴 시간
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Client:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.in_flight = 0
+
+
+class Ticket:
+    def __init__(self, client, nbytes):
+        self.client = client
+        self.nbytes = nbytes
+
+
+# 요청 payload를 읽기 전에 헤더만 보고 받아들일지 정한다 (admission control).
+#
+# - max_payload보다 큰 요청은 받지 않는다 (PayloadTooLargeError, 연결을 닫는다).
+#   서버는 압축을 풀거나 복원한 smashed data의 크기에도 같은 한도를 적용한다
+# - 클라이언트(IP 주소)마다 token bucket으로 초당 rate개, 순간적으로 burst개까지만 받는다
+# - 클라이언트마다 처리 중인 요청은 max_in_flight개까지
+# - 모든 클라이언트의 처리 중인 payload 합은 max_queued_bytes까지
+# 한도를 넘으면 payload를 메모리에 쌓지 않고 버린 뒤 "busy, retry after" 응답(FLAG_RETRY)을 보낸다.
+# 거절은 대기열에 들어가기 전에 일어나므로 과부하에서도 받아들인 요청의 지연 시간이 늘어나지 않는다.
+class AdmissionController:
+    # 0 또는 None인 한도는 적용하지 않는다
+    def __init__(self, max_payload=256 * 1024 * 1024, max_in_flight=16, max_queued_bytes=1024 * 1024 * 1024,
+                 rate=200.0, burst=400, busy_retry_after=0.05, idle_seconds=300.0):
+        self.max_payload = max_payload
+        self.max_in_flight = max_in_flight
+        self.max_queued_bytes = max_queued_bytes
+        self.rate = rate
+        self.burst = burst
+        self.busy_retry_after = busy_retry_after
+        self.idle_seconds = idle_seconds
+        self.queued_bytes = 0
+        self.rejected = Counter('admission_rejected_total', 'Requests rejected before reading the payload',
+                                ('reason',))
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+    def admit(self, identity, nbytes):
+        if self.max_payload and nbytes > self.max_payload:
+            self.rejected.inc(reason='payload')
+            raise PayloadTooLargeError(f"Payload of {nbytes} bytes exceeds the limit of {self.max_payload} bytes")
+        if self.max_queued_bytes and nbytes > self.max_queued_bytes:
+            # 대기열이 비어도 들어갈 수 없는 요청은 다시 보내도 소용없으므로 busy가 아니라 거절한다
+            self.rejected.inc(reason='payload')
+            raise PayloadTooLargeError(f"Payload of {nbytes} bytes exceeds the queue limit of "
+                                       f"{self.max_queued_bytes} bytes")
+
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            client = self._clients.get(identity)
+            if client is None:
+                client = self._clients[identity] = _Client(TokenBucket(self.rate, self.burst) if self.rate else None)
+
+            if self.max_in_flight and client.in_flight >= self.max_in_flight:
+                self.rejected.inc(reason='in_flight')
+                raise ServerBusyError("Too many requests in flight", self.busy_retry_after)
+            if self.max_queued_bytes and self.queued_bytes + nbytes > self.max_queued_bytes:
+                self.rejected.inc(reason='queued_bytes')
+                raise ServerBusyError("Server busy", self.busy_retry_after)
+            if client.bucket is not None:
+                wait = client.bucket.take(now)
+                if wait:
+                    self.rejected.inc(reason='rate')
+                    raise ServerBusyError("Rate limit exceeded", wait)
+
+            client.in_flight += 1
+            self.queued_bytes += nbytes
+        return Ticket(client, nbytes)
+
+    def release(self, ticket):
+        with self._lock:
+            ticket.client.in_flight -= 1
+            self.queued_bytes -= ticket.nbytes
+
+    def _prune(self, now):
+        # 오래 요청이 없던 클라이언트의 상태는 지운다 (bucket은 그동안 가득 찼을 것이므로 새로 만든 것과 같다)
+        if now - self._last_prune < self.idle_seconds:
+            return
+        self._last_prune = now
+        for identity, client in list(self._clients.items()):
+            if client.in_flight == 0 and (client.bucket is None or now - client.bucket.updated > self.idle_seconds):
+                del self._clients[identity]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._clients),
+                'in_flight': sum(client.in_flight for client in self._clients.values()),
+                'queued_bytes': self.queued_bytes,
+            }
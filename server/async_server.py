@@ -0,0 +1,432 @@
+import json
+import signal
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from common import protocol, tensor_codec, encoding, download
+from split_trainer import decode_train_request
+from federation import decode_fedavg_request
+from model_catalog import UnknownModelError
+from metrics import ServerMetrics
+from admission import PayloadTooLargeError, ServerBusyError
+
+# 모델을 지정하는 요청들 (payload 앞에 모델 지정자가 붙는다)
+MODEL_OPCODES = (protocol.OP_DOWNLOAD, protocol.OP_PREDICT, protocol.OP_PREDICT_STREAM, protocol.OP_TRAIN,
+                 protocol.OP_FEDAVG)
+
+
+class ClientDisconnected(ConnectionError):
+    pass
+
+
+# 연결 자체가 끊어졌거나 프레임 경계를 잃은 경우. 이때는 응답하지 않고 연결을 닫는다
+CONNECTION_ERRORS = (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, protocol.ProtocolError)
+
+
+# 스레드 대신 asyncio 스트림으로 연결을 처리하는 서버 엔진.
+# model_loader(key)를 주면 추론 전에 모델을 불러 두어 로드 시간이 forward와 따로 기록된다.
+# admission(AdmissionController)을 주면 payload를 읽기 전에 요청 크기와 클라이언트별 한도를 확인한다.
+# 요청 사이에 idle_timeout초 동안 조용한 연결은 닫는다. 헤더를 받은 뒤 payload 전체를, 응답 하나를 보내기 시작한 뒤
+# 응답 전체를 io_timeout초 안에 주고받아야 한다 (0이면 제한 없음).
+# 결과를 기다리는 동안 클라이언트가 끊어지면 아직 실행되지 않은 추론을 취소한다
+class AsyncServer:
+    def __init__(self, batcher, catalog, compression_stats, get_trainer,
+                 max_connections=10000, inference_workers=4, stream_window=4, metrics=None, model_loader=None,
+                 federation=None, admission=None, idle_timeout=900.0, io_timeout=60.0, disconnect_poll=0.1,
+                 keepalive=(60, 10, 5)):
+        self.batcher = batcher
+        self.catalog = catalog
+        self.compression_stats = compression_stats
+        self.get_trainer = get_trainer
+        self.digest_cache = download.DigestCache()
+        self.max_connections = max_connections
+        self.stream_window = stream_window
+        self.metrics = metrics or ServerMetrics()
+        self.model_loader = model_loader
+        self.federation = federation
+        self.admission = admission
+        self.idle_timeout = idle_timeout or None
+        self.io_timeout = io_timeout or None
+        self.disconnect_poll = disconnect_poll
+        self.keepalive = keepalive
+        self._readers = {}
+        self.executor = ThreadPoolExecutor(max_workers=inference_workers, thread_name_prefix='inference')
+        self.active_connections = 0
+        self._tasks = set()
+        self._stop_event = None
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        if self.active_connections >= self.max_connections:
+            logging.warning(f"Rejected {addr}: connection limit {self.max_connections} reached")
+            try:
+                await protocol.write_frame(writer, protocol.OP_ERROR, 0, protocol.pack_busy(1.0, "Server busy"),
+                                           flags=protocol.FLAG_RESPONSE | protocol.FLAG_RETRY,
+                                           timeout=self.io_timeout)
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+            await self._close(writer)
+            return
+
+        sock = writer.get_extra_info('socket')
+        if sock is not None and self.keepalive:
+            protocol.enable_keepalive(sock, *self.keepalive)
+
+        self.active_connections += 1
+        self.metrics.active_connections.inc()
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self._readers[writer] = reader
+        logging.info(f"Connected by {addr}")
+        print(f"Connected by {addr}")
+        streams = {}
+        try:
+            while True:
+                try:
+                    header = await asyncio.wait_for(reader.readexactly(protocol.HEADER_SIZE), self.idle_timeout)
+                except asyncio.IncompleteReadError as e:
+                    if not e.partial:
+                        break
+                    raise
+                except asyncio.TimeoutError:
+                    logging.info(f"Closing idle connection {addr}")
+                    break
+                opcode, flags, request_id, length = protocol.unpack_header(header)
+                if opcode == protocol.OP_PREDICT_STREAM and request_id in streams and streams[request_id] is None:
+                    # 이미 실패를 알린 스트림의 나머지 프레임은 admission 없이 읽어서 버린다
+                    await asyncio.wait_for(protocol.discard(reader, length), self.io_timeout)
+                    if not flags & protocol.FLAG_MORE:
+                        del streams[request_id]
+                    continue
+                trace = self.metrics.trace(protocol.opcode_name(opcode), request_id, protocol.HEADER_SIZE + length)
+                try:
+                    ticket = self.admission.admit(addr[0], length) if self.admission else None
+                except PayloadTooLargeError as e:
+                    # payload를 읽지 않으면 다음 프레임 경계를 알 수 없으므로 오류를 보내고 연결을 닫는다
+                    logging.warning(f"{e} from {addr}")
+                    await self._write_error(writer, trace, request_id, str(e))
+                    trace.finish()
+                    break
+                except ServerBusyError as e:
+                    await asyncio.wait_for(protocol.discard(reader, length), self.io_timeout)
+                    if opcode == protocol.OP_PREDICT_STREAM:
+                        # 중간의 micro-batch 하나만 빠지면 클라이언트와 결과 순서가 어긋나므로 스트림 전체를 실패시킨다
+                        self._fail_stream(streams, request_id, flags)
+                    await self._write_busy(writer, trace, request_id, e)
+                    trace.finish()
+                    continue
+
+                try:
+                    with trace.span('recv'):
+                        payload = bytearray(await asyncio.wait_for(reader.readexactly(length), self.io_timeout))
+                    frame = protocol.Frame(opcode, flags, request_id, payload)
+                    try:
+                        await self._dispatch(writer, addr, frame, trace, streams)
+                    except CONNECTION_ERRORS:
+                        raise
+                    except Exception as e:
+                        await self._fail_request(writer, addr, frame, trace, streams, e)
+                finally:
+                    if ticket is not None:
+                        self.admission.release(ticket)
+                    trace.finish()
+        except asyncio.TimeoutError:
+            logging.warning(f"Connection with {addr} timed out after {self.io_timeout}s")
+        except ClientDisconnected as e:
+            logging.info(f"{addr}: {e}")
+        except (ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError) as e:
+            logging.error(f"Connection with {addr} lost: {e}")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._abandon_streams(streams)
+            del self._readers[writer]
+            self.active_connections -= 1
+            self.metrics.active_connections.dec()
+            self._tasks.discard(task)
+            await self._close(writer)
+
+    async def _fail_request(self, writer, addr, frame, trace, streams, error):
+        # 요청 하나의 실패(모델 오류, 잘못된 입력)는 그 요청 id로 오류를 보내고 연결은 유지한다
+        logging.exception(f"{trace.op} (id {frame.request_id}) from {addr} failed: {error}")
+        if frame.opcode == protocol.OP_PREDICT_STREAM:
+            self._fail_stream(streams, frame.request_id, frame.flags)
+        await self._write_error(writer, trace, frame.request_id, f"{trace.op} failed: {error}")
+
+    def _fail_stream(self, streams, request_id, flags):
+        # 실패한 스트림의 나머지 프레임은 마지막 프레임까지 버린다
+        if streams.get(request_id) is not None:
+            self._abandon_streams({request_id: streams[request_id]})
+        if flags & protocol.FLAG_MORE:
+            streams[request_id] = None
+        else:
+            streams.pop(request_id, None)
+
+    async def _dispatch(self, writer, addr, frame, trace, streams):
+        if frame.opcode in MODEL_OPCODES:
+            ref, offset = protocol.unpack_model_ref(frame.payload)
+            try:
+                model = self.catalog.resolve(ref)
+            except UnknownModelError as e:
+                if frame.opcode == protocol.OP_PREDICT_STREAM:
+                    self._fail_stream(streams, frame.request_id, frame.flags)
+                await self._write_error(writer, trace, frame.request_id, str(e))
+                logging.warning(f"{e} requested by {addr}")
+                return
+
+        if frame.opcode == protocol.OP_PREDICT_STREAM:
+            await self._predict_stream(writer, addr, frame, trace, model, offset, streams)
+            return
+
+        logging.info(f"Received request for {trace.op} (id {frame.request_id})")
+
+        if frame.opcode == protocol.OP_DOWNLOAD:
+            await self._download(writer, addr, frame, trace, model, offset)
+        elif frame.opcode == protocol.OP_PREDICT:
+            await self._predict(writer, addr, frame, trace, model, offset)
+        elif frame.opcode == protocol.OP_TRAIN:
+            await self._train(writer, addr, frame, trace, model, offset)
+        elif frame.opcode == protocol.OP_FEDAVG:
+            await self._fedavg(writer, addr, frame, trace, model, offset)
+        elif frame.opcode == protocol.OP_CAPABILITIES:
+            await self._write(writer, trace, protocol.OP_CAPABILITIES, frame.request_id,
+                              json.dumps(encoding.capabilities()).encode())
+        elif frame.opcode == protocol.OP_CATALOG:
+            await self._write(writer, trace, protocol.OP_CATALOG, frame.request_id,
+                              json.dumps(self.catalog.describe()).encode())
+        else:
+            await self._write_error(writer, trace, frame.request_id, "Invalid request")
+            logging.warning(f"Invalid request {trace.op} from {addr}")
+
+    async def _write(self, writer, trace, opcode, request_id, *parts, flags=protocol.FLAG_RESPONSE):
+        with trace.span('send'):
+            trace.sent_bytes += await protocol.write_frame(writer, opcode, request_id, *parts, flags=flags,
+                                                           timeout=self.io_timeout)
+
+    async def _write_error(self, writer, trace, request_id, message):
+        trace.error = True
+        await self._write(writer, trace, protocol.OP_ERROR, request_id, message.encode())
+
+    async def _write_busy(self, writer, trace, request_id, error):
+        trace.error = True
+        await self._write(writer, trace, protocol.OP_ERROR, request_id, protocol.pack_busy(error.retry_after, str(error)),
+                          flags=protocol.FLAG_RESPONSE | protocol.FLAG_RETRY)
+
+    def _abandon_streams(self, streams):
+        # 끝나지 않은 스트림의 micro-batch는 받을 클라이언트가 없으므로 취소한다
+        for pending in streams.values():
+            for future in pending or ():
+                future.cancel()
+
+    def _disconnected(self, writer):
+        reader = self._readers.get(writer)
+        return writer.transport.is_closing() or reader is None or reader.at_eof()
+
+    async def _result(self, writer, future, cancel=True):
+        # 결과를 기다리다가 클라이언트가 연결을 끊으면 더 기다리지 않는다.
+        # cancel이면 아직 batch에 들어가지 않은 요청을 취소해서 다른 클라이언트의 batch 자리를 비운다
+        future = asyncio.wrap_future(future)
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=self.disconnect_poll)
+            if done:
+                return future.result()
+            if self._disconnected(writer):
+                if cancel:
+                    future.cancel()
+                raise ClientDisconnected("Client disconnected while waiting for the result")
+
+    async def _load_model(self, trace, model):
+        if self.model_loader is not None:
+            with trace.span('model_load'):
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.model_loader, model.key)
+
+    async def _close(self, writer):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def _download(self, writer, addr, frame, trace, model, offset):
+        loop = asyncio.get_running_loop()
+        try:
+            file = open(model.client_model, 'rb')
+        except FileNotFoundError:
+            await self._write_error(writer, trace, frame.request_id, "File not found")
+            logging.error(f"{model.client_model} not found")
+            return
+
+        with file:
+            # 해시 계산은 파일 크기에 비례하는 작업이므로 executor에서 실행
+            response, file_offset, count, not_modified = await loop.run_in_executor(
+                self.executor, download.plan_response, file, frame.payload, self.digest_cache, offset)
+            if not_modified:
+                await self._write(writer, trace, protocol.OP_DOWNLOAD, frame.request_id, response,
+                                  flags=protocol.FLAG_RESPONSE | protocol.FLAG_NOT_MODIFIED)
+                return
+            async def send():
+                writer.write(protocol.pack_header(protocol.OP_DOWNLOAD, frame.request_id, len(response) + count,
+                                                  protocol.FLAG_RESPONSE) + response)
+                await writer.drain()
+                if count:
+                    await loop.sendfile(writer.transport, file, file_offset, count)
+
+            with trace.span('send'):
+                # 헤더와 파일 내용을 합쳐 응답 전체가 io_timeout초 안에 전송되어야 한다
+                await asyncio.wait_for(send(), self.io_timeout)
+            trace.sent_bytes += protocol.HEADER_SIZE + len(response) + count
+        logging.info(f"Sent {model.client_model} to {addr} (offset {file_offset})")
+
+    async def _decode(self, function, *args):
+        # 압축 해제, 역양자화, float 변환은 payload 크기에 비례하므로 이벤트 루프를 막지 않도록 executor에서 한다
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _decoded_limit(self):
+        # 압축이나 희소 표현을 풀면 payload보다 커지므로 복원한 크기에도 payload 한도를 적용한다
+        if self.admission is not None and self.admission.max_payload:
+            return self.admission.max_payload
+        return encoding.MAX_DECODED_BYTES
+
+    def _decode_smashed(self, payload, offset):
+        encoding_name, compression_name = encoding.read_envelope(payload, offset)
+        smashed_data = encoding.decode_smashed(payload, offset, self._decoded_limit())
+        self.compression_stats.observe(encoding_name, compression_name, smashed_data.numel() * 4,
+                                       len(payload) - offset)
+        return smashed_data
+
+    async def _predict(self, writer, addr, frame, trace, model, offset):
+        try:
+            with trace.span('deserialize'):
+                smashed_data = await self._decode(self._decode_smashed, frame.payload, offset)
+        except encoding.EncodingError as e:
+            await self._write_error(writer, trace, frame.request_id, "Invalid smashed data")
+            logging.error(f"Invalid smashed data from {addr}: {e}")
+            return
+        logging.info("Smashed data received successfully")
+
+        await self._load_model(trace, model)
+        with trace.span('forward'):
+            output = await self._result(writer, self.batcher.submit(model.key, smashed_data))
+        logging.info("Prediction finished")
+
+        with trace.span('serialize'):
+            parts = tensor_codec.encode(output)
+            if frame.flags & protocol.FLAG_TIMING:
+                inference_seconds = trace.spans.get('model_load', 0.0) + trace.spans['forward']
+                parts = [*parts, protocol.pack_timing(trace.spans['deserialize'], inference_seconds)]
+        await self._write(writer, trace, protocol.OP_PREDICT, frame.request_id, *parts)
+
+    async def _train(self, writer, addr, frame, trace, model, offset):
+        loop = asyncio.get_running_loop()
+        try:
+            with trace.span('deserialize'):
+                smashed_data, labels = await self._decode(decode_train_request, frame.payload, offset,
+                                                          self._decoded_limit())
+        except ValueError as e:
+            await self._write_error(writer, trace, frame.request_id, str(e))
+            logging.error(f"{e} from {addr}")
+            return
+
+        try:
+            # 처음 학습하는 모델이면 학습용 복사본을 만드는 데 시간이 걸리므로 trainer 생성도 executor에서 한다
+            with trace.span('model_load'):
+                trainer = await loop.run_in_executor(self.executor, self.get_trainer, model)
+            with trace.span('forward'):
+                # 학습 스레드가 여러 연결의 요청을 묶어 처리하므로 executor 스레드를 잡아 두지 않고 기다린다
+                grad, loss = await self._result(writer, trainer.submit(smashed_data, labels))
+        except (RuntimeError, ValueError, IndexError) as e:
+            await self._write_error(writer, trace, frame.request_id, f"Training step failed: {e}")
+            logging.error(f"Training step failed for {addr}: {e}")
+            return
+        with trace.span('serialize'):
+            parts = tensor_codec.encode_many([loss, grad])
+        await self._write(writer, trace, protocol.OP_TRAIN, frame.request_id, *parts)
+
+    async def _fedavg(self, writer, addr, frame, trace, model, offset):
+        if self.federation is None:
+            await self._write_error(writer, trace, frame.request_id, "FedAvg is not enabled")
+            return
+        try:
+            with trace.span('deserialize'):
+                samples, tensors = await self._decode(decode_fedavg_request, frame.payload, offset)
+            future = self.federation.submit(model.key, samples, tensors)
+        except ValueError as e:
+            await self._write_error(writer, trace, frame.request_id, str(e))
+            logging.error(f"{e} from {addr}")
+            return
+        logging.info(f"{addr} joined FedAvg round for {model.key} with {samples} samples")
+        # 라운드의 Future는 다른 클라이언트들과 공유하므로 끊어져도 취소하지 않는다
+        with trace.span('forward'):
+            averaged = await self._result(writer, future, cancel=False)
+        with trace.span('serialize'):
+            parts = tensor_codec.encode_many(averaged)
+        await self._write(writer, trace, protocol.OP_FEDAVG, frame.request_id, *parts)
+
+    async def _predict_stream(self, writer, addr, frame, trace, model, offset, streams):
+        if frame.request_id not in streams:
+            logging.info(f"Started prediction stream {frame.request_id} from {addr}")
+            streams[frame.request_id] = deque()
+        pending = streams[frame.request_id]
+
+        if pending is not None and len(frame.payload) > offset:
+            try:
+                with trace.span('deserialize'):
+                    smashed_data = await self._decode(self._decode_smashed, frame.payload, offset)
+            except encoding.EncodingError as e:
+                await self._write_error(writer, trace, frame.request_id, "Invalid smashed data")
+                logging.error(f"Invalid smashed data from {addr}: {e}")
+                for future in pending:
+                    future.cancel()
+                pending = streams[frame.request_id] = None
+            else:
+                await self._load_model(trace, model)
+                pending.append(asyncio.wrap_future(self.batcher.submit(model.key, smashed_data)))
+
+        last = not frame.flags & protocol.FLAG_MORE
+        if pending is not None:
+            while pending and (last or len(pending) > self.stream_window or pending[0].done()):
+                with trace.span('forward'):
+                    output = await self._result(writer, pending[0])
+                    pending.popleft()
+                with trace.span('serialize'):
+                    parts = tensor_codec.encode(output)
+                await self._write(writer, trace, protocol.OP_PREDICT_STREAM, frame.request_id, *parts,
+                                  flags=protocol.FLAG_RESPONSE | protocol.FLAG_MORE)
+            if last:
+                await self._write(writer, trace, protocol.OP_PREDICT_STREAM, frame.request_id)
+                logging.info(f"Finished prediction stream {frame.request_id} from {addr}")
+        if last:
+            del streams[frame.request_id]
+
+    def _request_stop(self):
+        print("Shutting down server...")
+        self._stop_event.set()
+
+    async def serve(self, host, port):
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._request_stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows 이벤트 루프는 add_signal_handler를 지원하지 않는다
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(self._request_stop))
+
+        server = await asyncio.start_server(self.handle_client, host, port, backlog=1024)
+        logging.info(f"Server started at {host}:{port} (asyncio)")
+        print(f"Server started at {host}:{port} (asyncio)")
+
+        async with server:
+            await self._stop_event.wait()
+            server.close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        self.executor.shutdown(wait=False)
+
+    def run(self, host, port):
+        asyncio.run(self.serve(host, port))
+
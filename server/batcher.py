@@ -0,0 +1,164 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+import torch
+
+from metrics import Histogram
+
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+QUEUE_WAIT_BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5, 1.0]
+
+
+class _Request:
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+        self.size = data.shape[0]
+        # 배치 차원을 제외한 모양과 dtype이 같아야 하나로 합칠 수 있다
+        self.group = (key, tuple(data.shape[1:]), data.dtype)
+
+
+# 여러 클라이언트 스레드의 smashed data를 모아서 한 번의 forward로 처리.
+# 기본적으로 한 스레드가 batch를 모으고 실행한다. runner가 다른 프로세스에서 실행되는 경우처럼
+# 여러 batch를 동시에 실행할 수 있으면 workers를 늘려, 한 스레드가 batch를 모으는 동안
+# 다른 스레드들이 앞서 모은 batch를 실행하게 한다.
+class DynamicBatcher:
+    def __init__(self, runner, max_batch_size=256, max_wait=0.005, workers=1):
+        self.runner = runner
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_size_histogram = Histogram('batch_size', BATCH_SIZE_BUCKETS)
+        self.queue_wait_histogram = Histogram('queue_wait_seconds', QUEUE_WAIT_BUCKETS)
+        self._queue = queue.Queue()
+        self._pending = []
+        self._stopped = False
+        self._collect_lock = threading.Lock()
+        self._workers = []
+        self.start_workers(workers)
+
+    def start_workers(self, count):
+        while len(self._workers) < count:
+            worker = threading.Thread(target=self._run, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, key, data):
+        # 잘못된 요청은 worker까지 가지 않고 그 요청의 Future만 실패한다
+        if data.dim() < 1:
+            future = Future()
+            future.set_exception(ValueError("Smashed data must have a batch dimension"))
+            return future
+        request = _Request(key, data)
+        if self._stopped:
+            request.future.set_exception(RuntimeError("Batcher is stopped"))
+            return request.future
+        self._queue.put(request)
+        return request.future
+
+    def queue_depth(self):
+        # 아직 batch로 실행되지 않은 요청 수
+        return self._queue.qsize() + len(self._pending)
+
+    def stop(self):
+        self._stopped = True
+        for _ in self._workers:
+            self._queue.put(None)
+
+    def _collect(self):
+        # 첫 요청이 들어온 뒤 max_wait 동안, 또는 max_batch_size가 찰 때까지 모은다
+        if not self._pending:
+            if self._stopped:
+                return None
+            request = self._queue.get()
+            if request is None:
+                return None
+            self._pending.append(request)
+
+        first = self._pending[0]
+        group = first.group
+        batch = [request for request in self._pending if request.group == group]
+        self._pending = [request for request in self._pending if request.group != group]
+        size = sum(request.size for request in batch)
+
+        deadline = first.enqueued_at + self.max_wait
+        while size < self.max_batch_size and not self._stopped:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            if request.group != group:
+                self._pending.append(request)
+                continue
+            if size + request.size > self.max_batch_size:
+                self._pending.append(request)
+                break
+            batch.append(request)
+            size += request.size
+        return batch
+
+    def _run(self):
+        while True:
+            with self._collect_lock:
+                try:
+                    batch = self._collect()
+                except Exception as e:
+                    # worker가 죽으면 이후의 모든 요청이 멈추므로 로그만 남기고 계속 실행한다
+                    logging.exception(f"Collecting a batch failed: {e}")
+                    continue
+            if batch is None:
+                break
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for request in batch:
+                self.queue_wait_histogram.observe(started - request.enqueued_at)
+
+            try:
+                if len(batch) == 1:
+                    outputs = [self.runner(batch[0].key, batch[0].data)]
+                else:
+                    sizes = [request.size for request in batch]
+                    stacked = torch.cat([request.data for request in batch], dim=0)
+                    outputs = torch.split(self.runner(batch[0].key, stacked), sizes, dim=0)
+            except Exception as e:
+                logging.error(f"Batched inference failed: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            self.batch_size_histogram.observe(sum(request.size for request in batch))
+            for request, output in zip(batch, outputs):
+                request.future.set_result(output)
+
+        with self._collect_lock:
+            leftover = self._pending
+            self._pending = []
+            while True:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    leftover.append(request)
+        for request in leftover:
+            # 클라이언트가 끊어져 이미 취소된 요청은 건너뛴다
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(RuntimeError("Batcher is stopped"))
+
+    def stats(self):
+        return {
+            'batch_size': self.batch_size_histogram.snapshot(),
+            'queue_wait_seconds': self.queue_wait_histogram.snapshot(),
+        }
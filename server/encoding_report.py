@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+
+current_script_path = os.path.abspath(__file__)
+current_directory = os.path.dirname(current_script_path)
+parent_directory = os.path.dirname(current_directory)
+
+sys.path.append(parent_directory)
+
+from models.splitter import load_half
+from common import encoding
+
+
+# smashed data 인코딩/압축 조합별 압축률과 정확도 변화를 비교한다
+def evaluate(client_model, server_model, data, labels, batch_size=500):
+    smashed_batches = []
+    with torch.inference_mode():
+        for start in range(0, len(data), batch_size):
+            smashed_batches.append(client_model(data[start:start + batch_size]))
+        baseline = [server_model(smashed).argmax(dim=1) for smashed in smashed_batches]
+
+    results = []
+    for encoding_name in encoding.ENCODINGS:
+        for compression_name in encoding.supported_compressions():
+            raw_bytes = wire_bytes = correct = agree = 0
+            encode_time = decode_time = 0.0
+            max_error = 0.0
+            with torch.inference_mode():
+                for index, smashed in enumerate(smashed_batches):
+                    started = time.perf_counter()
+                    parts = encoding.encode_smashed(smashed, encoding_name, compression_name)
+                    payload = bytearray(b''.join(parts))
+                    encoded = time.perf_counter()
+                    restored = encoding.decode_smashed(payload)
+                    decode_time += time.perf_counter() - encoded
+                    encode_time += encoded - started
+
+                    raw_bytes += smashed.numel() * 4
+                    wire_bytes += len(payload)
+                    max_error = max(max_error, (restored - smashed).abs().max().item())
+
+                    prediction = server_model(restored).argmax(dim=1)
+                    batch_labels = labels[index * batch_size:(index + 1) * batch_size]
+                    correct += (prediction == batch_labels).sum().item()
+                    agree += (prediction == baseline[index]).sum().item()
+
+            results.append({
+                'encoding': encoding_name,
+                'compression': compression_name,
+                'ratio': raw_bytes / wire_bytes,
+                'bytes_per_sample': wire_bytes / len(data),
+                'accuracy': correct / len(data),
+                'agreement_with_raw': agree / len(data),
+                'max_abs_error': max_error,
+                'encode_seconds': encode_time,
+                'decode_seconds': decode_time,
+            })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default='test.pt')
+    parser.add_argument('--client-model', default='client_model.pt')
+    parser.add_argument('--server-model', default='server_model.pt')
+    parser.add_argument('--limit', type=int, default=2000)
+    parser.add_argument('--json', help='save results to this file')
+    args = parser.parse_args()
+
+    test_data, test_labels = torch.load(args.data)
+    data = test_data[:args.limit].unsqueeze(1).float()
+    labels = test_labels[:args.limit]
+
+    client_model = load_half(args.client_model, 'client').eval()
+    server_model = load_half(args.server_model, 'server').eval()
+
+    results = evaluate(client_model, server_model, data, labels)
+
+    print(f"{'encoding':<12} {'compression':<12} {'ratio':>7} {'bytes/img':>10} {'accuracy':>9} {'agree':>7} {'max err':>9}")
+    for result in results:
+        print(f"{result['encoding']:<12} {result['compression']:<12} {result['ratio']:>6.2f}x "
+              f"{result['bytes_per_sample']:>10.0f} {result['accuracy']:>9.4f} "
+              f"{result['agreement_with_raw']:>7.4f} {result['max_abs_error']:>9.2e}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
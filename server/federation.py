@@ -0,0 +1,89 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from common import protocol, tensor_codec
+
+
+# SplitFed에서 클라이언트 측 모델을 평균하는 FedAvg 집계기.
+#
+# 클라이언트들은 각자 클라이언트 측 모델을 병렬로 학습하고, 한 라운드(보통 epoch)가 끝나면
+# 가중치와 학습한 샘플 수를 보낸다. clients명이 모두 보내거나, 첫 참여 후 timeout초가 지나면
+# 그때까지 모인 가중치를 샘플 수로 가중 평균해서 라운드에 참여한 모든 클라이언트에게 돌려준다.
+class _Round:
+    def __init__(self):
+        self.contributions = []
+        self.future = Future()
+        self.timer = None
+
+
+def fedavg(contributions):
+    # contributions: [(샘플 수, [tensor, ...]), ...]
+    total = sum(samples for samples, _ in contributions)
+    weights = [samples / total if total else 1 / len(contributions) for samples, _ in contributions]
+    averaged = []
+    for tensors in zip(*(tensors for _, tensors in contributions)):
+        mean = sum(tensor.double() * weight for tensor, weight in zip(tensors, weights))
+        if not tensors[0].is_floating_point():
+            # num_batches_tracked 같은 정수 buffer
+            mean = mean.round()
+        averaged.append(mean.to(tensors[0].dtype))
+    return averaged
+
+
+def decode_fedavg_request(payload, offset=0):
+    if len(payload) < offset + protocol.FEDAVG.size:
+        raise ValueError("Missing FedAvg header")
+    samples, count = protocol.FEDAVG.unpack_from(payload, offset)
+    try:
+        tensors, _ = tensor_codec.decode_many(payload, count, offset + protocol.FEDAVG.size)
+    except tensor_codec.CodecError as e:
+        raise ValueError(f"Invalid FedAvg weights: {e}")
+    return samples, tensors
+
+
+class FedAvgAggregator:
+    def __init__(self, clients=2, timeout=60.0):
+        self.clients = clients
+        self.timeout = timeout
+        self.rounds = 0
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, samples, tensors):
+        # 라운드가 끝나면 평균 텐서 목록을 결과로 갖는 Future
+        with self._lock:
+            current = self._open.get(key)
+            if current is None:
+                current = self._open[key] = _Round()
+                current.timer = threading.Timer(self.timeout, self._close, (key, current))
+                current.timer.daemon = True
+                current.timer.start()
+            elif not self._compatible(current.contributions[0][1], tensors):
+                raise ValueError("Weights do not match the other clients' model")
+            current.contributions.append((samples, tensors))
+            full = len(current.contributions) >= self.clients
+        if full:
+            self._close(key, current)
+        return current.future
+
+    def _compatible(self, reference, tensors):
+        return len(reference) == len(tensors) and all(
+            a.shape == b.shape and a.dtype == b.dtype for a, b in zip(reference, tensors))
+
+    def _close(self, key, current):
+        with self._lock:
+            if self._open.get(key) is not current:
+                return
+            del self._open[key]
+            self.rounds += 1
+        current.timer.cancel()
+        try:
+            averaged = fedavg(current.contributions)
+        except Exception as e:
+            logging.error(f"FedAvg for {key} failed: {e}")
+            current.future.set_exception(e)
+            return
+        logging.info(f"FedAvg round for {key}: {len(current.contributions)} clients, "
+                     f"{sum(samples for samples, _ in current.contributions)} samples")
+        current.future.set_result(averaged)
@@ -0,0 +1,305 @@
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 배치 크기, 대기 시간 등의 분포를 누적하는 간단한 히스토그램
+class Histogram:
+    def __init__(self, name, buckets):
+        self.name = name
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.total
+            count = self.count
+        return {
+            'buckets': [(bound, counts[i]) for i, bound in enumerate(self.buckets)] + [('+Inf', counts[-1])],
+            'count': count,
+            'mean': total / count if count else 0.0,
+        }
+
+    def format(self):
+        snap = self.snapshot()
+        lines = [f"{self.name}: count={snap['count']} mean={snap['mean']:.4g}"]
+        for bound, count in snap['buckets']:
+            lines.append(f"  <= {bound}: {count}")
+        return '\n'.join(lines)
+
+
+# 인코딩별로 smashed data의 원본(float32 기준) 크기와 실제 전송 크기를 누적
+class CompressionStats:
+    def __init__(self):
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def observe(self, encoding, compression, raw_bytes, wire_bytes):
+        key = (encoding, compression)
+        with self._lock:
+            requests, raw_total, wire_total = self._totals.get(key, (0, 0, 0))
+            self._totals[key] = (requests + 1, raw_total + raw_bytes, wire_total + wire_bytes)
+
+    def snapshot(self):
+        with self._lock:
+            totals = dict(self._totals)
+        return {
+            f"{encoding}+{compression}": {
+                'requests': requests,
+                'raw_bytes': raw_total,
+                'wire_bytes': wire_total,
+                'ratio': raw_total / wire_total if wire_total else 0.0,
+            }
+            for (encoding, compression), (requests, raw_total, wire_total) in totals.items()
+        }
+
+    def format(self):
+        lines = ["compression_ratio:"]
+        for name, stats in sorted(self.snapshot().items()):
+            lines.append(f"  {name}: requests={stats['requests']} ratio={stats['ratio']:.2f}x "
+                         f"({stats['raw_bytes']} -> {stats['wire_bytes']} bytes)")
+        return '\n'.join(lines)
+
+
+# Prometheus 텍스트 형식으로 내보낼 수 있는 counter/gauge.
+# labelnames를 주면 inc(op='Predict')처럼 label 값마다 따로 센다
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help='', labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in sorted(values.items())]
+
+
+# function을 주면 내보낼 때마다 그 값을 읽는다 (대기열 길이, 로드된 모델 크기 등)
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help='', labelnames=(), function=None):
+        super(Gauge, self).__init__(name, help, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, {}, self.function())]
+        return super(Gauge, self).samples()
+
+
+def _histogram_samples(histogram, name, labels):
+    snap = histogram.snapshot()
+    samples = []
+    cumulative = 0
+    for bound, count in snap['buckets']:
+        cumulative += count
+        samples.append((f"{name}_bucket", dict(labels, le=str(bound)), cumulative))
+    samples.append((f"{name}_sum", dict(labels), snap['mean'] * snap['count']))
+    samples.append((f"{name}_count", dict(labels), snap['count']))
+    return samples
+
+
+# label 값마다 Histogram을 하나씩 두는 묶음
+class HistogramFamily:
+    kind = 'histogram'
+
+    def __init__(self, name, buckets, help='', labelnames=()):
+        self.name = name
+        self.buckets = buckets
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = Histogram(self.name, self.buckets)
+            return self._children[key]
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def samples(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        samples = []
+        for key, histogram in children:
+            samples.extend(_histogram_samples(histogram, self.name, dict(zip(self.labelnames, key))))
+        return samples
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class MetricsRegistry:
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._metrics = []
+
+    def register(self, *metrics):
+        self._metrics.extend(metrics)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            name = self.prefix + metric.name
+            if isinstance(metric, Histogram):
+                kind = 'histogram'
+                samples = _histogram_samples(metric, metric.name, {})
+            else:
+                kind = metric.kind
+                samples = metric.samples()
+            if getattr(metric, 'help', ''):
+                lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{self.prefix}{sample_name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Prometheus가 긁어 갈 수 있도록 http://host:port/metrics 로 내보낸다
+def start_metrics_server(registry, host='127.0.0.1', port=9100):
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
+
+
+STAGE_BUCKETS = [0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+
+# 요청 하나의 단계별(recv, deserialize, model_load, forward, serialize, send) 소요 시간.
+# finish()에서 단계별 histogram에 기록하고, DEBUG 레벨이면 한 줄짜리 JSON으로 로그에 남긴다
+class RequestTrace:
+    def __init__(self, metrics, op, request_id):
+        self.metrics = metrics
+        self.op = op
+        self.request_id = request_id
+        self.spans = {}
+        self.sent_bytes = 0
+        self.error = False
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - started
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def finish(self):
+        self.metrics.finish(self)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('trace ' + json.dumps({
+                'op': self.op,
+                'request_id': self.request_id,
+                'error': self.error,
+                'sent_bytes': self.sent_bytes,
+                'spans_ms': {name: round(seconds * 1000, 3) for name, seconds in self.spans.items()},
+            }))
+
+
+# 서버 엔진(스레드/asyncio)이 공통으로 쓰는 요청 단위 지표
+class ServerMetrics:
+    def __init__(self, prefix='split_'):
+        self.registry = MetricsRegistry(prefix)
+        self.requests = Counter('requests_total', 'Requests by operation', ('op',))
+        self.errors = Counter('request_errors_total', 'Requests answered with an error', ('op',))
+        self.received_bytes = Counter('received_bytes_total', 'Frame bytes received from clients')
+        self.sent_bytes = Counter('sent_bytes_total', 'Frame bytes sent to clients')
+        self.active_connections = Gauge('active_connections', 'Open client connections')
+        self.stages = HistogramFamily('request_stage_seconds', STAGE_BUCKETS, 'Time spent in each request stage',
+                                      ('op', 'stage'))
+        self.registry.register(self.requests, self.errors, self.received_bytes, self.sent_bytes,
+                               self.active_connections, self.stages)
+
+    def register(self, *metrics):
+        self.registry.register(*metrics)
+
+    def trace(self, op, request_id, received_bytes=0):
+        self.requests.inc(op=op)
+        self.received_bytes.inc(received_bytes)
+        return RequestTrace(self, op, request_id)
+
+    def finish(self, trace):
+        for name, seconds in trace.spans.items():
+            self.stages.observe(seconds, op=trace.op, stage=name)
+        self.sent_bytes.inc(trace.sent_bytes)
+        if trace.error:
+            self.errors.inc(op=trace.op)
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,76 @@
+import json
+import logging
+
+
+# 서버가 제공하는 모델 목록. 항목마다 이름, 버전, 구조, 분할 지점과 두 모델 파일 경로를 가진다
+class CatalogEntry:
+    def __init__(self, name, version, arch, split_point, client_model, server_model, optimized_model=None):
+        self.name = name
+        self.version = str(version)
+        self.arch = arch
+        self.split_point = split_point
+        self.client_model = client_model
+        self.server_model = server_model
+        # models/export.py로 만든 추론용 TorchScript 파일. 있으면 추론에는 server_model 대신 이 파일을 쓴다
+        self.optimized_model = optimized_model
+
+    @property
+    def key(self):
+        return f"{self.name}@{self.version}"
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'version': self.version,
+            'arch': self.arch,
+            'split_point': self.split_point,
+        }
+
+
+class UnknownModelError(Exception):
+    pass
+
+
+class ModelCatalog:
+    def __init__(self, entries, default=None):
+        self._entries = {}
+        self._latest = {}
+        for entry in entries:
+            self._entries[entry.key] = entry
+            # 버전 없이 이름만 주면 목록에서 마지막에 있는 버전을 쓴다
+            self._latest[entry.name] = entry
+        if not self._entries:
+            raise ValueError("Model catalog is empty")
+        self.default = default or entries[0].name
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            config = json.load(file)
+        entries = [CatalogEntry(**item) for item in config['models']]
+        logging.info(f"Loaded {len(entries)} models from {path}")
+        return cls(entries, config.get('default'))
+
+    def resolve(self, ref=''):
+        # ref: '' (기본 모델) | 'name' (최신 버전) | 'name@version'
+        ref = ref or self.default
+        if ref in self._entries:
+            return self._entries[ref]
+        if ref in self._latest:
+            return self._latest[ref]
+        raise UnknownModelError(f"Unknown model {ref}")
+
+    def entries(self):
+        return list(self._entries.values())
+
+    def register_all(self, registry, preload_default=True):
+        default_key = self.resolve().key
+        for entry in self._entries.values():
+            registry.register(entry.key, entry.optimized_model or entry.server_model,
+                              preload=preload_default and entry.key == default_key, eager_path=entry.server_model)
+
+    def describe(self):
+        return {
+            'default': self.resolve().key,
+            'models': [entry.describe() for entry in self._entries.values()],
+        }
@@ -0,0 +1,193 @@
+import os
+import copy
+import threading
+import logging
+from collections import OrderedDict
+
+import torch
+
+from models.splitter import load_half
+from models.export import load_server_model
+
+
+# 서버 측 분할 모델을 한 번만 로드해 모든 연결이 공유하도록 관리
+class ModelEntry:
+    def __init__(self, name, path, eager_path=None):
+        self.name = name
+        self.path = path
+        # path가 export된 TorchScript 파일이면 학습에는 원래 체크포인트(eager_path)를 쓴다
+        self.eager_path = eager_path or path
+        self.model = None
+        self.version = 0
+        self.mtime = None
+        self.nbytes = 0
+        # 학습으로 게시된 가중치를 저장한 체크포인트. 메모리에서 내린 뒤 다시 로드할 때 path 대신 읽는다
+        self.published_path = None
+        # 게시된 가중치가 메모리에만 있으면 메모리에서 내리지 않는다
+        self.unsaved = False
+        self.load_lock = threading.Lock()
+
+
+def model_nbytes(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+# max_bytes를 넘으면 가장 오래 쓰지 않은 모델부터 메모리에서 내리고, 다음 요청 때 다시 로드한다
+class ModelRegistry:
+    def __init__(self, poll_interval=2.0, max_bytes=None):
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+        self._entries = {}
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._reload_callbacks = []
+        self._watcher = None
+        self._stop_event = threading.Event()
+
+    def register(self, name, path, preload=True, eager_path=None):
+        entry = ModelEntry(name, path, eager_path)
+        with self._lock:
+            self._entries[name] = entry
+        if preload:
+            self.acquire(name)
+        return entry
+
+    def _prepare(self, model):
+        model.eval()
+        for param in model.parameters():
+            param.requires_grad_(False)
+        return model
+
+    def _load(self, entry):
+        # 기존 state dict 파일, Splitter로 나눈 임의 분할 지점 파일, export.py의 TorchScript 파일을 모두 읽을 수 있다
+        mtime = os.stat(entry.path).st_mtime
+        model = self._prepare(load_server_model(entry.published_path or entry.path))
+
+        # 새 모델을 완전히 만든 뒤 참조만 교체하므로, 실행 중인 요청은 이전 모델로 끝까지 진행된다
+        entry.model = model
+        entry.mtime = mtime
+        entry.version += 1
+        self._track(entry)
+        logging.info(f"Loaded {entry.name} from {entry.published_path or entry.path} (version {entry.version})")
+
+    def _track(self, entry):
+        with self._lock:
+            # freeze된 TorchScript 모델은 가중치가 상수로 들어가 parameters()가 비어 있으므로 파일 크기로 센다
+            entry.nbytes = model_nbytes(entry.model) or os.path.getsize(entry.path)
+            self._loaded[entry.name] = entry
+            self._loaded.move_to_end(entry.name)
+            self._evict(keep=entry.name)
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        while self._loaded_bytes() > self.max_bytes:
+            # 다시 읽을 파일이 없는 게시된 가중치는 내리면 학습 결과를 잃으므로 건너뛴다
+            name = next((name for name, entry in self._loaded.items() if name != keep and not entry.unsaved), None)
+            if name is None:
+                break
+            evicted = self._loaded.pop(name)
+            # 이미 이 모델로 실행 중인 요청은 자신이 가진 참조로 끝까지 진행된다
+            evicted.model = None
+            evicted.mtime = None
+            logging.info(f"Evicted {name} ({evicted.nbytes} bytes) from memory")
+
+    def _loaded_bytes(self):
+        return sum(entry.nbytes for entry in self._loaded.values())
+
+    def loaded_bytes(self):
+        # 지표 수집 스레드에서도 부르므로 _loaded가 바뀌는 중에 읽지 않도록 잠근다
+        with self._lock:
+            return self._loaded_bytes()
+
+    def acquire(self, name):
+        entry = self._entries[name]
+        model = entry.model
+        if model is None:
+            with entry.load_lock:
+                if entry.model is None:
+                    self._load(entry)
+                model = entry.model
+        else:
+            with self._lock:
+                if name in self._loaded:
+                    self._loaded.move_to_end(name)
+        return model
+
+    def eager(self, name):
+        # 학습과 가중치 교체에는 일반 nn.Module이 필요하므로 TorchScript 모델이면 원래 체크포인트를 읽는다
+        model = self.acquire(name)
+        if isinstance(model, torch.jit.ScriptModule):
+            model = self._prepare(load_half(self._entries[name].eager_path, 'server'))
+        return model
+
+    def publish(self, name, state_dict, path=None):
+        # 학습으로 갱신된 가중치를 파일을 거치지 않고 추론용 모델로 교체한다.
+        # export된 모델은 다시 export할 때까지 학습된 eager 모델로 대체된다.
+        # path: 같은 가중치를 저장한 체크포인트. 없으면 이 모델은 메모리에서 내리지 않는다
+        entry = self._entries[name]
+        model = copy.deepcopy(self.eager(name))
+        model.load_state_dict(state_dict)
+        # acquire나 파일 변경 감시가 동시에 모델을 다시 로드해 게시한 가중치를 덮어쓰지 않도록 load_lock을 잡는다
+        with entry.load_lock:
+            entry.model = self._prepare(model)
+            entry.version += 1
+            entry.published_path = path
+            entry.unsaved = path is None
+            self._track(entry)
+        logging.info(f"Published new weights for {name} (version {entry.version})")
+        for callback in self._reload_callbacks:
+            callback(entry)
+        return entry.version
+
+    def get(self, name):
+        return self._entries[name]
+
+    def predict(self, name, data):
+        model = self.acquire(name)
+        with torch.inference_mode():
+            return model(data)
+
+    def on_reload(self, callback):
+        self._reload_callbacks.append(callback)
+
+    def check_for_updates(self):
+        for entry in list(self._entries.values()):
+            if entry.model is None:
+                continue
+            try:
+                mtime = os.stat(entry.path).st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime == entry.mtime:
+                continue
+            # acquire가 같은 모델을 동시에 로드하지 않도록 load_lock을 잡고 다시 확인한다
+            with entry.load_lock:
+                if entry.model is None or mtime == entry.mtime:
+                    continue
+                # 파일이 새로 배포되면 학습으로 게시된 가중치 대신 새 파일을 쓴다
+                published_path, unsaved = entry.published_path, entry.unsaved
+                entry.published_path, entry.unsaved = None, False
+                try:
+                    self._load(entry)
+                except Exception as e:
+                    # 파일이 아직 쓰이는 중일 수 있으므로 다음 주기에 다시 시도
+                    entry.published_path, entry.unsaved = published_path, unsaved
+                    logging.warning(f"Failed to reload {entry.name}: {e}")
+                    continue
+            print(f"Reloaded {entry.name} (version {entry.version})")
+            for callback in self._reload_callbacks:
+                callback(entry)
+
+    def _watch(self):
+        while not self._stop_event.wait(self.poll_interval):
+            self.check_for_updates()
+
+    def start_watcher(self):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, daemon=True)
+            self._watcher.start()
+
+    def stop_watcher(self):
+        self._stop_event.set()
@@ -0,0 +1,171 @@
+# 서버 측 모델을 여러 워커 프로세스에서 실행해서 GIL 경합 없이 모든 코어를 쓰게 한다.
+#
+# - 모델 가중치는 share_memory()로 공유 메모리에 올려 워커에 handle만 넘긴다 (복사 없음).
+# - 입력/출력 텐서는 워커마다 미리 만들어 둔 공유 메모리 버퍼(slab)로 주고받는다.
+#   파이프로는 모양과 dtype 같은 작은 메시지만 오가며, 버퍼보다 큰 텐서만 공유 메모리 handle로 보낸다.
+# - 워커마다 torch.set_num_threads로 intra-op 스레드 수를 정해 코어를 나누어 쓴다.
+import io
+import os
+import sys
+import queue
+import logging
+
+import torch
+import torch.multiprocessing as mp
+
+
+SLAB_BYTES = 64 * 1024 * 1024
+
+
+def _view(slab, shape, dtype):
+    count = 1
+    for size in shape:
+        count *= size
+    nbytes = count * torch.empty((), dtype=dtype).element_size()
+    return slab[:nbytes].view(dtype).view(shape)
+
+
+def _fits(slab, tensor):
+    return tensor.numel() * tensor.element_size() <= slab.numel()
+
+
+def _worker_main(conn, input_slab, output_slab, num_threads):
+    torch.set_num_threads(num_threads)
+    models = {}
+    with torch.inference_mode():
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            kind = message[0]
+            if kind == 'stop':
+                break
+            if kind == 'model':
+                _, key, model = message
+                models[key] = model
+                continue
+            if kind == 'script':
+                _, key, data = message
+                models[key] = torch.jit.load(io.BytesIO(data))
+                continue
+            if kind == 'drop':
+                models.pop(message[1], None)
+                continue
+
+            _, key, data = message
+            try:
+                if not isinstance(data, torch.Tensor):
+                    data = _view(input_slab, *data)
+                output = models[key](data)
+                if _fits(output_slab, output):
+                    _view(output_slab, output.shape, output.dtype).copy_(output)
+                    conn.send(('ok', (tuple(output.shape), output.dtype)))
+                else:
+                    conn.send(('ok', output))
+            except Exception as e:
+                conn.send(('error', f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, context, index, num_threads, slab_bytes):
+        self.index = index
+        self.input_slab = torch.empty(slab_bytes, dtype=torch.uint8).share_memory_()
+        self.output_slab = torch.empty(slab_bytes, dtype=torch.uint8).share_memory_()
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, name=f'inference-{index}',
+                                       args=(child_conn, self.input_slab, self.output_slab, num_threads), daemon=True)
+        _start_without_main(self.process)
+        child_conn.close()
+        # 워커에 보낸 모델 버전. 버전이 바뀐(다시 로드되거나 학습 결과가 반영된) 모델만 다시 보낸다
+        self.versions = {}
+
+    def run(self, registry, key, data):
+        for stale in [name for name in self.versions if registry.get(name).model is None]:
+            # registry가 메모리에서 내린 모델은 워커에서도 내린다
+            self.conn.send(('drop', stale))
+            del self.versions[stale]
+
+        # 모델보다 버전을 먼저 읽어야 새 모델이 이전 버전 번호로 기록되는 일이 없다
+        version = registry.get(key).version
+        model = registry.acquire(key)
+        if self.versions.get(key) != version:
+            if isinstance(model, torch.jit.ScriptModule):
+                # TorchScript 모델은 pickle로 보낼 수 없으므로 저장한 바이트를 보내 워커에서 다시 로드한다
+                buffer = io.BytesIO()
+                torch.jit.save(model, buffer)
+                self.conn.send(('script', key, buffer.getvalue()))
+            else:
+                model.share_memory()
+                self.conn.send(('model', key, model))
+            self.versions[key] = version
+
+        if _fits(self.input_slab, data):
+            _view(self.input_slab, data.shape, data.dtype).copy_(data)
+            self.conn.send(('run', key, (tuple(data.shape), data.dtype)))
+        else:
+            self.conn.send(('run', key, data))
+
+        status, result = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError(f"Inference worker {self.index} failed: {result}")
+        if isinstance(result, torch.Tensor):
+            return result
+        # 출력 버퍼는 다음 요청에서 다시 쓰므로 복사해서 돌려준다
+        return _view(self.output_slab, *result).clone()
+
+    def stop(self):
+        try:
+            self.conn.send(('stop',))
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def _start_without_main(process):
+    # spawn으로 만든 프로세스는 시작할 때 __main__ 모듈(server.py)을 다시 실행하는데,
+    # 그러면 워커마다 모델을 로드하고 batcher와 감시 스레드를 띄우게 된다.
+    # 시작하는 동안만 __main__을 이 모듈로 바꿔 워커가 이 모듈만 import하게 한다.
+    main_module = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        process.start()
+    finally:
+        sys.modules['__main__'] = main_module
+
+
+# DynamicBatcher의 runner로 쓸 수 있는 프로세스 풀 (registry.predict와 같은 호출 방식).
+# 한 워커는 한 번에 하나의 batch만 실행하므로 batcher의 workers를 워커 수와 맞추어야 모두 쓰인다.
+class ProcessPoolRunner:
+    def __init__(self, registry, workers=2, threads_per_worker=None, slab_bytes=SLAB_BYTES):
+        self.registry = registry
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.slab_bytes = slab_bytes
+        self._context = mp.get_context('spawn')
+        self._idle = queue.Queue()
+        for index in range(workers):
+            self._idle.put(self._start_worker(index))
+        logging.info(f"Started {workers} inference processes with {self.threads_per_worker} threads each")
+
+    def _start_worker(self, index):
+        return _Worker(self._context, index, self.threads_per_worker, self.slab_bytes)
+
+    def __call__(self, key, data):
+        worker = self._idle.get()
+        try:
+            return worker.run(self.registry, key, data)
+        except (EOFError, BrokenPipeError, ConnectionResetError) as e:
+            # 워커 프로세스가 죽으면 새로 띄우고 이 요청은 실패로 처리한다
+            logging.error(f"Inference process {worker.index} died: {e}")
+            worker.stop()
+            worker = self._start_worker(worker.index)
+            raise RuntimeError(f"Inference process {worker.index} died")
+        finally:
+            self._idle.put(worker)
+
+    def stop(self):
+        for _ in range(self.workers):
+            self._idle.get().stop()
@@ -0,0 +1,142 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import torch
+
+
+# 같은 smashed data(같은 이미지)를 다시 보내면 서버 모델을 다시 실행하지 않고 저장해 둔 결과를 돌려준다.
+# 키는 (모델, 모델 버전, 샘플 내용의 해시)이고 batch 안의 샘플마다 따로 찾으므로,
+# 일부만 겹치는 요청은 캐시에 없는 샘플만 batcher로 보낸다.
+# 모델이 다시 로드되거나 학습 결과가 반영되면 그 모델의 결과는 모두 버린다.
+class ResultCache:
+    def __init__(self, batcher, registry, max_bytes=64 * 1024 * 1024, ttl=600.0):
+        self.batcher = batcher
+        self.registry = registry
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        registry.on_reload(self._on_reload)
+
+    def _digests(self, data):
+        rows = data.detach().contiguous().numpy()
+        return [hashlib.blake2b(row, digest_size=16).digest() for row in rows]
+
+    def _lookup(self, prefix, digests):
+        now = time.monotonic()
+        outputs = []
+        with self._lock:
+            for digest in digests:
+                key = prefix + (digest,)
+                item = self._entries.get(key)
+                if item is not None and item[1] < now:
+                    self._remove(key)
+                    item = None
+                if item is None:
+                    outputs.append(None)
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    outputs.append(item[0])
+                    self.hits += 1
+        return outputs
+
+    def _store(self, prefix, digests, rows):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for digest, row in zip(digests, rows):
+                key = prefix + (digest,)
+                if key in self._entries:
+                    self._remove(key)
+                # 결과 한 행만 복사해서 저장해야 batch 전체 출력이 메모리에 남지 않는다
+                row = row.clone()
+                self._entries[key] = (row, expires_at)
+                self._bytes += row.numel() * row.element_size()
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        row, _ = self._entries.pop(key)
+        self._bytes -= row.numel() * row.element_size()
+
+    def _on_reload(self, entry):
+        with self._lock:
+            stale = [key for key in self._entries if key[0] == entry.name]
+            for key in stale:
+                self._remove(key)
+            self.invalidations += len(stale)
+        if stale:
+            logging.info(f"Dropped {len(stale)} cached results of {entry.name} (version {entry.version})")
+
+    # DynamicBatcher.submit과 같은 방식으로 쓸 수 있다
+    def submit(self, key, data):
+        if data.dim() < 1 or data.shape[0] == 0:
+            # 빈 batch는 torch.stack([])에서 실패하므로 캐시를 찾기 전에 거절한다
+            result = Future()
+            result.set_exception(ValueError("Smashed data must have a non-empty batch dimension"))
+            return result
+        prefix = (key, self.registry.get(key).version, tuple(data.shape[1:]), data.dtype)
+        digests = self._digests(data)
+        outputs = self._lookup(prefix, digests)
+        missing = [index for index, output in enumerate(outputs) if output is None]
+
+        result = Future()
+        if not missing:
+            result.set_running_or_notify_cancel()
+            result.set_result(torch.stack(outputs))
+            return result
+
+        if len(missing) == len(outputs):
+            inner = self.batcher.submit(key, data)
+        else:
+            inner = self.batcher.submit(key, data[torch.tensor(missing)])
+
+        def complete(inner):
+            if not result.set_running_or_notify_cancel():
+                return
+            try:
+                computed = inner.result()
+            except BaseException as e:
+                result.set_exception(e)
+                return
+            self._store(prefix, [digests[index] for index in missing], computed)
+            if len(missing) == len(outputs):
+                result.set_result(computed)
+                return
+            for index, row in zip(missing, computed):
+                outputs[index] = row
+            result.set_result(torch.stack(outputs))
+
+        inner.add_done_callback(complete)
+        # 요청한 클라이언트가 끊어져 결과가 취소되면 아직 batch에 들어가지 않은 추론도 취소한다
+        result.add_done_callback(lambda result: result.cancelled() and inner.cancel())
+        return result
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def format(self):
+        stats = self.stats()
+        return (f"result_cache: hit_rate={stats['hit_rate']:.3f} (hits={stats['hits']} misses={stats['misses']}) "
+                f"entries={stats['entries']} bytes={stats['bytes']} evictions={stats['evictions']} "
+                f"invalidations={stats['invalidations']}")
@@ -0,0 +1,432 @@
+# 클라이언트 연결을 받아 Predict 요청을 여러 server.py 백엔드에 나누어 보내는 라우터.
+#
+# - Predict: 처리 중인 요청이 가장 적은 백엔드로 보낸다 (least outstanding requests).
+#   백엔드 연결이 실패하면 그 백엔드를 unhealthy로 표시하고 다른 백엔드로 다시 보낸다.
+# - PredictStream: 한 스트림의 프레임은 모두 같은 백엔드 연결로 보낸다.
+# - Train: 서버 측 학습 상태가 백엔드마다 따로 있으므로 항상 첫 번째로 사용 가능한 백엔드로 보낸다.
+# - Download, Capabilities, Catalog: 백엔드를 거치지 않고 라우터가 직접 응답한다.
+#
+# 백엔드에는 모든 요청이 라우터 주소에서 오므로 클라이언트별 한도(admission)는 실제 클라이언트 주소를 아는
+# 라우터가 적용하고, 백엔드는 클라이언트별 한도 없이(--max-in-flight 0 --client-rate 0) 띄운다.
+#
+# 로컬에서 시험할 때는 --spawn N으로 loopback 포트에 백엔드 N개를 띄운다.
+#   python router.py --spawn 3
+#   python router.py --backend 10.0.0.2:12345 --backend 10.0.0.3:12345
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import threading
+import subprocess
+
+current_script_path = os.path.abspath(__file__)
+current_directory = os.path.dirname(current_script_path)
+parent_directory = os.path.dirname(current_directory)
+
+sys.path.append(parent_directory)
+
+from common import protocol
+from admission import AdmissionController
+from async_server import AsyncServer
+from metrics import Gauge, start_metrics_server
+from model_catalog import ModelCatalog
+
+
+HOST = '127.0.0.1'
+PORT = 12345
+FIRST_BACKEND_PORT = 12346
+
+HEALTH_CHECK_INTERVAL = 2.0
+BACKEND_TIMEOUT = 5.0
+# 백엔드 응답을 기다리는 최대 시간. FedAvg는 다른 클라이언트를 기다리므로 백엔드의 FEDAVG_TIMEOUT보다 길어야 한다
+BACKEND_READ_TIMEOUT = 120.0
+MAX_IDLE_CONNECTIONS = 16
+
+# 클라이언트별 admission 한도. 기본값은 server.py와 같다
+MAX_PAYLOAD = 256 * 1024 * 1024
+MAX_IN_FLIGHT_PER_CLIENT = 64
+MAX_QUEUED_BYTES = 1024 * 1024 * 1024
+CLIENT_RATE = 1000.0
+CLIENT_BURST = 2000
+
+BACKEND_ERRORS = (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, protocol.ProtocolError)
+
+
+class Backend:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.healthy = False
+        self.draining = False
+        self.drained = False
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self._idle = []
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.port}"
+
+    @property
+    def available(self):
+        return self.healthy and not self.draining
+
+    async def connect(self):
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), BACKEND_TIMEOUT)
+
+    async def _checkout(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            # 오래 쉰 연결은 백엔드가 idle timeout으로 닫았을 수 있다
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+        return await self.connect()
+
+    def _checkin(self, connection):
+        if self.draining or len(self._idle) >= MAX_IDLE_CONNECTIONS:
+            connection[1].close()
+        else:
+            self._idle.append(connection)
+
+    async def request(self, frame, timeout=BACKEND_READ_TIMEOUT):
+        # 백엔드는 한 연결의 요청을 차례로 처리하므로 요청마다 쉬고 있는 연결 하나를 쓴다
+        reader, writer = await self._checkout()
+        try:
+            await protocol.write_frame(writer, frame.opcode, frame.request_id, frame.payload, flags=frame.flags,
+                                       timeout=timeout)
+            response = await asyncio.wait_for(protocol.read_frame(reader), timeout)
+            if response is None:
+                raise ConnectionError("Backend closed the connection")
+        except BaseException:
+            writer.close()
+            raise
+        self._checkin((reader, writer))
+        return response
+
+    def close_idle(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    def describe(self):
+        state = 'draining' if self.draining else ('up' if self.healthy else 'down')
+        return (f"{self.name}: {state} outstanding={self.outstanding} requests={self.requests} "
+                f"failures={self.failures}")
+
+
+class _Stream:
+    def __init__(self, backend, writer, relay):
+        self.backend = backend
+        self.writer = writer
+        self.relay = relay
+        self.closed = False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.relay.cancel()
+        self.writer.close()
+        self.backend.outstanding -= 1
+
+
+class Router(AsyncServer):
+    def __init__(self, backends, catalog, max_connections=10000, health_check_interval=HEALTH_CHECK_INTERVAL,
+                 admission=None):
+        # 다운로드 해시 계산에 쓰는 executor만 있으면 되므로 워커는 둘이면 충분하다
+        super(Router, self).__init__(None, catalog, None, None, max_connections=max_connections, inference_workers=2,
+                                     admission=admission)
+        self.backends = backends
+        self.health_check_interval = health_check_interval
+        self._next = 0
+        self._loop = None
+
+    def _pick(self, exclude=()):
+        candidates = [backend for backend in self.backends if backend.available and backend not in exclude]
+        if not candidates:
+            return None
+        # outstanding이 같으면 돌아가며 고른다
+        self._next += 1
+        offset = self._next % len(candidates)
+        candidates = candidates[offset:] + candidates[:offset]
+        return min(candidates, key=lambda backend: backend.outstanding)
+
+    def _mark_down(self, backend, error):
+        backend.failures += 1
+        backend.close_idle()
+        if backend.healthy:
+            backend.healthy = False
+            logging.warning(f"Backend {backend.name} is down: {error}")
+            print(f"Backend {backend.name} is down")
+
+    async def _forward(self, trace, frame, backend):
+        # 백엔드 왕복만 한다. 여기서 난 BACKEND_ERRORS만 백엔드의 문제다
+        backend.outstanding += 1
+        backend.requests += 1
+        try:
+            with trace.span('forward'):
+                return await backend.request(frame)
+        finally:
+            backend.outstanding -= 1
+
+    async def _reply(self, writer, trace, response):
+        # 클라이언트 쪽 오류(연결 끊김, 쓰기 timeout)는 handle_client가 처리하고 백엔드 상태에는 반영하지 않는다
+        trace.error = response.opcode == protocol.OP_ERROR
+        await self._write(writer, trace, response.opcode, response.request_id, response.payload, flags=response.flags)
+
+    async def _predict(self, writer, addr, frame, trace, model, offset):
+        # Predict는 다시 보내도 결과가 같으므로 실패하면 다른 백엔드로 재시도한다
+        tried = set()
+        while True:
+            backend = self._pick(tried)
+            if backend is None:
+                await self._write_error(writer, trace, frame.request_id, "No backend available")
+                return
+            try:
+                response = await self._forward(trace, frame, backend)
+            except BACKEND_ERRORS as e:
+                self._mark_down(backend, e)
+                tried.add(backend)
+                continue
+            await self._reply(writer, trace, response)
+            return
+
+    async def _train(self, writer, addr, frame, trace, model, offset):
+        # 학습하는 서버 모델과 FedAvg 라운드가 한 곳에 모이도록 항상 첫 번째로 사용 가능한 백엔드로 보낸다
+        backend = next((backend for backend in self.backends if backend.available), None)
+        if backend is None:
+            await self._write_error(writer, trace, frame.request_id, "No backend available")
+            return
+        try:
+            response = await self._forward(trace, frame, backend)
+        except BACKEND_ERRORS as e:
+            # 학습 단계는 이미 적용되었을 수 있으므로 다시 보내지 않는다
+            self._mark_down(backend, e)
+            await self._write_error(writer, trace, frame.request_id, "Training backend failed")
+            return
+        await self._reply(writer, trace, response)
+
+    async def _fedavg(self, writer, addr, frame, trace, model, offset):
+        await self._train(writer, addr, frame, trace, model, offset)
+
+    async def _relay_stream(self, writer, request_id, backend, reader):
+        while True:
+            try:
+                response = await asyncio.wait_for(protocol.read_frame(reader), BACKEND_READ_TIMEOUT)
+                if response is None:
+                    raise ConnectionError("Backend closed the connection")
+            except BACKEND_ERRORS as e:
+                self._mark_down(backend, e)
+                try:
+                    await asyncio.wait_for(protocol.write_error(writer, request_id, "Prediction backend failed"),
+                                           self.io_timeout)
+                except (OSError, asyncio.TimeoutError):
+                    pass
+                return False
+            try:
+                await protocol.write_frame(writer, response.opcode, response.request_id, response.payload,
+                                           flags=response.flags, timeout=self.io_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                # 클라이언트가 끊어졌거나 결과를 읽지 않는다. 백엔드는 정상이므로 스트림만 끝낸다
+                logging.warning(f"Stopped relaying prediction stream {request_id}: {e}")
+                return False
+            if response.opcode == protocol.OP_ERROR or not response.flags & protocol.FLAG_MORE:
+                return True
+
+    async def _predict_stream(self, writer, addr, frame, trace, model, offset, streams):
+        # 스트림 결과는 relay 태스크가 따로 전달하므로 trace에는 클라이언트 프레임을 넘긴 시간만 남는다
+        last = not frame.flags & protocol.FLAG_MORE
+        if frame.request_id not in streams:
+            backend = self._pick()
+            if backend is None:
+                await self._write_error(writer, trace, frame.request_id, "No backend available")
+                streams[frame.request_id] = None
+            else:
+                try:
+                    reader, backend_writer = await backend.connect()
+                except BACKEND_ERRORS as e:
+                    self._mark_down(backend, e)
+                    await self._write_error(writer, trace, frame.request_id, "No backend available")
+                    streams[frame.request_id] = None
+                else:
+                    backend.outstanding += 1
+                    backend.requests += 1
+                    relay = asyncio.ensure_future(self._relay_stream(writer, frame.request_id, backend, reader))
+                    stream = _Stream(backend, backend_writer, relay)
+                    streams[frame.request_id] = stream
+                    logging.info(f"Forwarding prediction stream {frame.request_id} from {addr} to {backend.name}")
+
+        stream = streams[frame.request_id]
+        if stream is not None:
+            if not stream.relay.done():
+                try:
+                    await protocol.write_frame(stream.writer, frame.opcode, frame.request_id, frame.payload,
+                                               flags=frame.flags, timeout=BACKEND_READ_TIMEOUT)
+                except BACKEND_ERRORS:
+                    # 연결 오류는 relay가 읽는 쪽에서 보고 클라이언트에 알린다
+                    pass
+            if last:
+                # 다음 요청을 읽기 전에 이 스트림의 결과를 모두 전달한다
+                await stream.relay
+                stream.close()
+        if last:
+            del streams[frame.request_id]
+
+    def _abandon_streams(self, streams):
+        # 클라이언트 연결이 스트림 도중에 끊겨도 백엔드 연결을 정리한다
+        for stream in streams.values():
+            if stream is not None:
+                stream.close()
+
+    async def _check(self, backend):
+        frame = protocol.Frame(protocol.OP_CAPABILITIES, 0, 0, b'')
+        try:
+            await backend.request(frame, BACKEND_TIMEOUT)
+        except BACKEND_ERRORS as e:
+            self._mark_down(backend, e)
+            return
+        if not backend.healthy:
+            backend.healthy = True
+            logging.info(f"Backend {backend.name} is up")
+            print(f"Backend {backend.name} is up")
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(backend) for backend in self.backends))
+            for backend in self.backends:
+                if backend.draining and backend.outstanding == 0 and not backend.drained:
+                    backend.drained = True
+                    backend.close_idle()
+                    logging.info(f"Backend {backend.name} drained")
+                    print(f"Backend {backend.name} drained")
+            await asyncio.sleep(self.health_check_interval)
+
+    def _find(self, name):
+        return next((backend for backend in self.backends if backend.name == name), None)
+
+    def drain(self, name, draining=True):
+        # 새 요청을 보내지 않고, 처리 중인 요청이 끝나면 연결을 닫는다
+        backend = self._find(name)
+        if backend is None:
+            return False
+        backend.draining = draining
+        backend.drained = False
+        logging.info(f"Backend {name} {'draining' if draining else 'back in rotation'}")
+        return True
+
+    def call_soon(self, callback, *args):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        self.call_soon(self._request_stop)
+
+    async def serve(self, host, port):
+        self._loop = asyncio.get_running_loop()
+        health = asyncio.ensure_future(self._health_loop())
+        try:
+            await super(Router, self).serve(host, port)
+        finally:
+            health.cancel()
+            for backend in self.backends:
+                backend.close_idle()
+
+
+def spawn_backends(count, host, first_port):
+    # 같은 디렉터리의 server.py를 asyncio 엔진으로 띄운다 (입력 대기 스레드가 없는 엔진).
+    # 백엔드에서는 모든 요청이 라우터 한 주소에서 오므로 클라이언트별 한도는 끄고 라우터가 적용한다
+    processes = []
+    for index in range(count):
+        port = first_port + index
+        command = [sys.executable, os.path.join(current_directory, 'server.py'),
+                   '--engine', 'asyncio', '--host', host, '--port', str(port), '--metrics-port', '0',
+                   '--max-in-flight', '0', '--client-rate', '0']
+        processes.append(subprocess.Popen(command, cwd=current_directory, stdin=subprocess.DEVNULL))
+        logging.info(f"Spawned backend {host}:{port} (pid {processes[-1].pid})")
+    return processes
+
+
+def stop_backends(processes):
+    for process in processes:
+        process.terminate()
+    deadline = time.monotonic() + 10
+    for process in processes:
+        try:
+            process.wait(timeout=max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def listen_for_commands(router):
+    while True:
+        try:
+            command = input("Enter 's' to stop, 'backends' to list backends, 'drain host:port' or 'undrain host:port'\n")
+        except EOFError:
+            break
+        words = command.split()
+        if not words:
+            continue
+        if words[0] == 's':
+            router.stop()
+            break
+        elif words[0] == 'backends':
+            for backend in router.backends:
+                print(backend.describe())
+        elif words[0] in ('drain', 'undrain') and len(words) == 2:
+            if not router.drain(words[1], words[0] == 'drain'):
+                print(f"Unknown backend {words[1]}")
+        else:
+            print("Invalid command.")
+
+
+def parse_backend(value):
+    host, _, port = value.rpartition(':')
+    return Backend(host or HOST, int(port))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='log_router.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--backend', action='append', default=[], help='host:port of a server.py backend')
+    parser.add_argument('--spawn', type=int, default=0, help='start this many local backends on loopback ports')
+    parser.add_argument('--first-backend-port', type=int, default=FIRST_BACKEND_PORT)
+    parser.add_argument('--catalog', default='catalog.json')
+    parser.add_argument('--max-connections', type=int, default=10000)
+    parser.add_argument('--max-payload', type=int, default=MAX_PAYLOAD, help='bytes (0: unlimited)')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT_PER_CLIENT,
+                        help='requests in flight per client address (0: unlimited)')
+    parser.add_argument('--max-queued-bytes', type=int, default=MAX_QUEUED_BYTES, help='0: unlimited')
+    parser.add_argument('--client-rate', type=float, default=CLIENT_RATE,
+                        help='requests per second per client address (0: unlimited)')
+    parser.add_argument('--client-burst', type=int, default=CLIENT_BURST)
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve Prometheus metrics on 127.0.0.1:PORT')
+    args = parser.parse_args()
+
+    backends = [parse_backend(value) for value in args.backend]
+    processes = spawn_backends(args.spawn, '127.0.0.1', args.first_backend_port) if args.spawn else []
+    backends += [Backend('127.0.0.1', args.first_backend_port + index) for index in range(args.spawn)]
+    if not backends:
+        parser.error('give at least one --backend or --spawn N')
+
+    admission = AdmissionController(args.max_payload, args.max_in_flight, args.max_queued_bytes, args.client_rate,
+                                    args.client_burst)
+    router = Router(backends, ModelCatalog.load(args.catalog), max_connections=args.max_connections,
+                    admission=admission)
+    router.metrics.register(
+        admission.rejected,
+        Gauge('admission_queued_bytes', 'Payload bytes of requests being processed',
+              function=lambda: admission.queued_bytes),
+    )
+    if args.metrics_port:
+        start_metrics_server(router.metrics.registry, '127.0.0.1', args.metrics_port)
+    threading.Thread(target=listen_for_commands, args=(router,), daemon=True).start()
+    try:
+        router.run(args.host, args.port)
+    finally:
+        stop_backends(processes)
@@ -1,8 +1,11 @@
-import io
+import json
+import time
+import concurrent.futures
+import argparse
+from collections import deque
 import socket
 import threading
 import logging
-import torch
 import sys
 import os
 
@@ -14,106 +17,475 @@ grand_parent_directory = os.path.dirname(parent_directory)
 sys.path.append(parent_directory)
 
 
-from models.resnet import ResNetServer
+from common import protocol, tensor_codec, encoding, download
+from model_registry import ModelRegistry
+from batcher import DynamicBatcher
+from result_cache import ResultCache
+from process_pool import ProcessPoolRunner
+from metrics import CompressionStats, ServerMetrics, Gauge, start_metrics_server
+from async_server import AsyncServer
+from split_trainer import SplitTrainer, decode_train_request
+from federation import FedAvgAggregator, decode_fedavg_request
+from admission import AdmissionController, PayloadTooLargeError, ServerBusyError
+from model_catalog import ModelCatalog, UnknownModelError
 
 
 # 로깅 설정
 logging.basicConfig(filename='log_server.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-valid_request_list = ['Download', 'Predict']
+# 제공할 모델 목록 (이름, 버전, 분할 지점, 클라이언트/서버 모델 파일)
+catalog_name = 'catalog.json'
+catalog = ModelCatalog.load(catalog_name)
+
+# 서버 모델은 처음 쓸 때 한 번만 로드하고, 파일이 바뀌면 자동으로 다시 로드한다.
+# 로드된 서버 모델의 합이 MODEL_MEMORY_BUDGET을 넘으면 가장 오래 쓰지 않은 모델부터 내린다
+MODEL_MEMORY_BUDGET = 512 * 1024 * 1024
+registry = ModelRegistry(max_bytes=MODEL_MEMORY_BUDGET)
+catalog.register_all(registry)
+registry.start_watcher()
+
+# 여러 클라이언트의 smashed data를 모아 한 번에 추론
+MAX_BATCH_SIZE = 256
+MAX_BATCH_WAIT = 0.005
+batcher = DynamicBatcher(registry.predict, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT)
+
+# 0보다 크면 서버 모델을 이 수만큼의 워커 프로세스에서 실행한다 (--inference-processes)
+INFERENCE_PROCESSES = 0
+process_pool = None
+
+
+def start_process_pool(workers):
+    global process_pool
+    process_pool = ProcessPoolRunner(registry, workers)
+    batcher.runner = process_pool
+    batcher.start_workers(workers)
+    print(f"Running inference in {workers} processes ({process_pool.threads_per_worker} threads each)")
+
+
+def stop_process_pool():
+    if process_pool is not None:
+        process_pool.stop()
+
+# 같은 smashed data에 대한 예측 결과 캐시 (0이면 사용하지 않음)
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_TTL = 600
+result_cache = ResultCache(batcher, registry, RESULT_CACHE_BYTES, RESULT_CACHE_TTL) if RESULT_CACHE_BYTES else None
+predictor = result_cache or batcher
+
+# 인코딩별 압축률
+compression_stats = CompressionStats()
+
+# 클라이언트 모델 파일 해시 (파일이 바뀔 때만 다시 계산)
+digest_cache = download.DigestCache()
+
+# Train 요청으로 서버 측 모델을 학습. TRAIN_PUBLISH_EVERY 스텝마다 추론 모델에 반영하고
+# '<서버 모델 이름>_trained.pt'로 저장한다
+TRAIN_PUBLISH_EVERY = 50
+# 여러 클라이언트가 동시에 학습하면 TRAIN_MAX_WAIT 동안 들어온 요청을 TRAIN_MAX_GROUP개까지 묶어 한 스텝으로 학습한다
+TRAIN_MAX_GROUP = 8
+TRAIN_MAX_WAIT = 0.005
+trainers = {}
+trainers_lock = threading.Lock()
+
+# SplitFed: FEDAVG_CLIENTS개의 클라이언트가 클라이언트 측 가중치를 보내면(또는 FEDAVG_TIMEOUT초 뒤) 평균해서 돌려준다
+FEDAVG_CLIENTS = 2
+FEDAVG_TIMEOUT = 60.0
+federation = FedAvgAggregator(FEDAVG_CLIENTS, FEDAVG_TIMEOUT)
+
+
+def get_trainer(model):
+    with trainers_lock:
+        if model.key not in trainers:
+            checkpoint_path = os.path.splitext(model.server_model)[0] + '_trained.pt'
+            trainers[model.key] = SplitTrainer(registry, model.key, publish_every=TRAIN_PUBLISH_EVERY,
+                                               checkpoint_path=checkpoint_path, arch=model.arch,
+                                               split_point=model.split_point, max_group=TRAIN_MAX_GROUP,
+                                               max_wait=TRAIN_MAX_WAIT)
+        return trainers[model.key]
+
+
+def publish_trainers():
+    for trainer in list(trainers.values()):
+        if trainer.steps:
+            trainer.publish()
+
+
+# 스트리밍 Predict에서 결과를 기다리지 않고 미리 받아 둘 micro-batch 수
+STREAM_WINDOW = 4
+
+# 모델을 지정하는 요청들 (payload 앞에 모델 지정자가 붙는다)
+MODEL_OPCODES = (protocol.OP_DOWNLOAD, protocol.OP_PREDICT, protocol.OP_PREDICT_STREAM, protocol.OP_TRAIN,
+                 protocol.OP_FEDAVG)
+
+# 요청 수, 전송량, 단계별 소요 시간 등. METRICS_PORT(--metrics-port)로 Prometheus 형식으로 내보낸다
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100
+server_metrics = ServerMetrics()
+server_metrics.register(
+    batcher.batch_size_histogram,
+    batcher.queue_wait_histogram,
+    Gauge('batcher_queue_depth', 'Requests waiting to be batched', function=batcher.queue_depth),
+    Gauge('loaded_model_bytes', 'Parameter bytes of loaded server models', function=registry.loaded_bytes),
+)
+if result_cache:
+    server_metrics.register(Gauge('result_cache_hit_ratio', 'Result cache hit ratio',
+                                  function=lambda: result_cache.stats()['hit_rate']))
+
+# payload를 읽기 전에 적용하는 제한 (admission.py). 클라이언트는 IP 주소로 구분한다
+MAX_PAYLOAD = 256 * 1024 * 1024
+MAX_IN_FLIGHT_PER_CLIENT = 64
+MAX_QUEUED_BYTES = 1024 * 1024 * 1024
+CLIENT_RATE = 1000.0  # 클라이언트마다 초당 요청 수
+CLIENT_BURST = 2000
+MAX_CONNECTIONS = 1000  # 스레드 엔진 (asyncio 엔진은 10000)
+connection_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+# 요청 사이에 IDLE_TIMEOUT초 동안 아무것도 보내지 않는 연결은 닫는다 (0이면 닫지 않음).
+# 헤더를 받은 뒤 payload 전체를 IO_TIMEOUT초 안에 받아야 하고, 응답 하나를 보내는 것도 시작부터 IO_TIMEOUT초 안에
+# 끝나야 한다. 조금씩 보내거나 조금씩 읽는 클라이언트도 이 시간이 지나면 연결을 닫는다.
+# 결과를 기다리는 동안 DISCONNECT_POLL초마다 클라이언트가 끊어졌는지 확인하고, 끊어졌으면 추론을 취소한다.
+# 상대 호스트가 응답 없이 사라진 연결은 TCP keepalive로 찾아낸다
+IDLE_TIMEOUT = 900.0
+IO_TIMEOUT = 60.0
+DISCONNECT_POLL = 0.1
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+admission = AdmissionController(MAX_PAYLOAD, MAX_IN_FLIGHT_PER_CLIENT, MAX_QUEUED_BYTES, CLIENT_RATE, CLIENT_BURST)
+server_metrics.register(
+    admission.rejected,
+    Gauge('admission_queued_bytes', 'Payload bytes of requests being processed', function=lambda: admission.queued_bytes),
+)
+
+
+def io_deadline():
+    return time.monotonic() + IO_TIMEOUT if IO_TIMEOUT else None
+
+
+def send(conn, trace, opcode, request_id, *parts, flags=protocol.FLAG_RESPONSE):
+    with trace.span('send'):
+        trace.sent_bytes += protocol.send_frame(conn, opcode, request_id, *parts, flags=flags,
+                                                deadline=io_deadline())
+
+
+def send_error(conn, trace, request_id, message):
+    trace.error = True
+    send(conn, trace, protocol.OP_ERROR, request_id, message.encode())
+
+
+def send_busy(conn, trace, request_id, error):
+    trace.error = True
+    send(conn, trace, protocol.OP_ERROR, request_id, protocol.pack_busy(error.retry_after, str(error)),
+         flags=protocol.FLAG_RESPONSE | protocol.FLAG_RETRY)
+
+
+class ClientDisconnected(ConnectionError):
+    pass
+
+
+# 연결 자체가 끊어졌거나 프레임 경계를 잃은 경우. 이때는 응답하지 않고 연결을 닫는다
+CONNECTION_ERRORS = (ConnectionError, socket.timeout, protocol.ProtocolError)
+
+
+def wait_for_result(conn, future, cancel=True):
+    # 결과를 기다리다가 클라이언트가 연결을 끊으면 더 기다리지 않는다.
+    # cancel이면 아직 batch에 들어가지 않은 요청을 취소해서 다른 클라이언트의 batch 자리를 비운다
+    while True:
+        done, _ = concurrent.futures.wait([future], timeout=DISCONNECT_POLL)
+        if done:
+            return future.result()
+        if protocol.peer_closed(conn):
+            if cancel:
+                future.cancel()
+            raise ClientDisconnected("Client disconnected while waiting for the result")
+
+
+def debug_tensor(name, tensor):
+    # 텐서 전체를 문자열로 만드는 것 자체가 비싸므로 DEBUG 레벨일 때만 만든다
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"{name}: {tensor}")
 
-client_model_name = 'client_model.pt'
-server_model_name = 'server_model.pt'
 
 # 클라이언트 처리 함수
 def handle_client(conn, addr):
     logging.info(f"Connected by {addr}")
     print((f"Connected by {addr}"))
-    while True:
-        request = conn.recv(1024)
-        if not request:
-            break
-
-        request = request.decode()
-        print(f"Received request for {request}")
-        logging.info(f"Received request for {request}")
-
-        if request not in valid_request_list:
-            print(f"Invalid request {request}")
-            logging.error(f"Invalid request {request}")
-            conn.sendall("Invalid request".encode())
-        
-
-        if request == 'Download':
+    server_metrics.active_connections.inc()
+    streams = {}
+    try:
+        while True:
+            conn.settimeout(IDLE_TIMEOUT or None)
+            try:
+                header = protocol.recv_header(conn)
+            except socket.timeout:
+                logging.info(f"Closing idle connection {addr}")
+                break
+            if header is None:
+                break
+            conn.settimeout(IO_TIMEOUT or None)
+            deadline = io_deadline()
+            opcode, flags, request_id, length = header
+            if opcode == protocol.OP_PREDICT_STREAM and request_id in streams and streams[request_id] is None:
+                # 이미 실패를 알린 스트림의 나머지 프레임은 admission 없이 읽어서 버린다
+                protocol.discard_exact(conn, length, deadline=deadline)
+                if not flags & protocol.FLAG_MORE:
+                    del streams[request_id]
+                continue
+            request = protocol.opcode_name(opcode)
+            trace = server_metrics.trace(request, request_id, protocol.HEADER_SIZE + length)
             try:
-                with open(client_model_name, 'rb') as file:
-                    while True:
-                        bytes_read = file.read(1024)
-                        if not bytes_read:
-                            break
-                        conn.sendall(bytes_read)
-                        print("Uploading...")
-
-                conn.sendall("Finish".encode())
-                logging.info(f"Sent {client_model_name} to {addr}")
-            except FileNotFoundError:
-                conn.sendall("File not found".encode())
-                logging.error(f"{request} not found")
-            except Exception as e:
-                conn.sendall("Unknown error".encode())
-                logging.error(f"Unknown error: {e}")
-
-        elif request == 'Predict':
-            print("Waiting size of smashed data...")
-
-            data_size = int.from_bytes(conn.recv(8), 'big')
-
-            print('size', data_size)
-
-            received_bytes = 0
-            received_smashed_data = bytearray()
-            while received_bytes < data_size:
-                chunk = conn.recv(1024*10)
-                if not chunk:
-                    raise Exception("Connection lost while receiving data")
-                received_smashed_data.extend(chunk)
-                received_bytes += len(chunk)
-                
-            buffer = io.BytesIO(received_smashed_data)
-            smashed_data = torch.load(buffer)
-            print("Smashed data received successfully.")
-            logging.info("Smashed data received successfully")
-
-            print(f"Received smashed data:{smashed_data}")
-
-            model = ResNetServer()
-            model.load_state_dict(torch.load(server_model_name))
-            model.eval()
-            print("Model loaded successfully.")
-            logging.info("Model loaded successfully")
-
-            print("Predicting...")
-            logging.info("Predicting...")
-            output = model(smashed_data)
-            print("Prediction finished.")
-            logging.info("Prediction finished")
-
-            print("Sending prediction result...")
-            logging.info("Sending prediction result...")
-            buff = io.BytesIO()
-            torch.save(output, buff)
-            buff.seek(0)
-
-            data_size = len(buff.getvalue())
-            conn.sendall(data_size.to_bytes(8, 'big'))
-
-            conn.sendall(buff.getvalue())
-            print("Prediction result sent successfully.")
+                ticket = admission.admit(addr[0], length)
+            except PayloadTooLargeError as e:
+                # payload를 읽지 않으면 다음 프레임 경계를 알 수 없으므로 오류를 보내고 연결을 닫는다
+                logging.warning(f"{e} from {addr}")
+                send_error(conn, trace, request_id, str(e))
+                trace.finish()
+                break
+            except ServerBusyError as e:
+                protocol.discard_exact(conn, length, deadline=deadline)
+                if opcode == protocol.OP_PREDICT_STREAM:
+                    # 중간의 micro-batch 하나만 빠지면 클라이언트와 결과 순서가 어긋나므로 스트림 전체를 실패시킨다
+                    abandon_stream(streams, request_id, flags)
+                send_busy(conn, trace, request_id, e)
+                trace.finish()
+                continue
 
+            try:
+                with trace.span('recv'):
+                    payload = protocol.recv_into_exact(conn, bytearray(length), deadline)
+                frame = protocol.Frame(opcode, flags, request_id, payload)
+                try:
+                    dispatch(conn, addr, frame, trace, streams)
+                except CONNECTION_ERRORS:
+                    raise
+                except Exception as e:
+                    fail_request(conn, addr, frame, trace, streams, e)
+            finally:
+                admission.release(ticket)
+                trace.finish()
+    except socket.timeout:
+        logging.warning(f"Connection with {addr} timed out after {IO_TIMEOUT}s")
+    except ClientDisconnected as e:
+        logging.info(f"{addr}: {e}")
+    except (ConnectionError, protocol.ProtocolError) as e:
+        logging.error(f"Connection with {addr} closed: {e}")
+    finally:
+        # 끝나지 않은 스트림의 micro-batch는 받을 클라이언트가 없으므로 취소한다
+        for pending in streams.values():
+            for future in pending or ():
+                future.cancel()
+        server_metrics.active_connections.dec()
+        connection_slots.release()
+        conn.close()
+
+
+def abandon_stream(streams, request_id, flags):
+    # 실패한 스트림의 나머지 프레임은 마지막 프레임까지 버린다
+    for future in streams.get(request_id) or ():
+        future.cancel()
+    if flags & protocol.FLAG_MORE:
+        streams[request_id] = None
+    else:
+        streams.pop(request_id, None)
+
+
+def fail_request(conn, addr, frame, trace, streams, error):
+    # 요청 하나의 실패(모델 오류, 잘못된 입력)는 그 요청 id로 오류를 보내고 연결은 유지한다
+    logging.exception(f"{trace.op} (id {frame.request_id}) from {addr} failed: {error}")
+    if frame.opcode == protocol.OP_PREDICT_STREAM:
+        abandon_stream(streams, frame.request_id, frame.flags)
+    send_error(conn, trace, frame.request_id, f"{trace.op} failed: {error}")
+
+
+def dispatch(conn, addr, frame, trace, streams):
+    if frame.opcode in MODEL_OPCODES:
+        ref, offset = protocol.unpack_model_ref(frame.payload)
+        try:
+            model = catalog.resolve(ref)
+        except UnknownModelError as e:
+            if frame.opcode == protocol.OP_PREDICT_STREAM:
+                abandon_stream(streams, frame.request_id, frame.flags)
+            send_error(conn, trace, frame.request_id, str(e))
+            logging.warning(f"{e} requested by {addr}")
+            return
+
+    if frame.opcode == protocol.OP_PREDICT_STREAM:
+        handle_predict_stream(conn, addr, frame, trace, model, offset, streams)
+        return
+
+    logging.info(f"Received request for {trace.op} (id {frame.request_id})")
+
+    if frame.opcode == protocol.OP_DOWNLOAD:
+        handle_download(conn, addr, frame, trace, model, offset)
+    elif frame.opcode == protocol.OP_PREDICT:
+        handle_predict(conn, addr, frame, trace, model, offset)
+    elif frame.opcode == protocol.OP_TRAIN:
+        handle_train(conn, addr, frame, trace, model, offset)
+    elif frame.opcode == protocol.OP_FEDAVG:
+        handle_fedavg(conn, addr, frame, trace, model, offset)
+    elif frame.opcode == protocol.OP_CAPABILITIES:
+        send(conn, trace, protocol.OP_CAPABILITIES, frame.request_id, json.dumps(encoding.capabilities()).encode())
+    elif frame.opcode == protocol.OP_CATALOG:
+        send(conn, trace, protocol.OP_CATALOG, frame.request_id, json.dumps(catalog.describe()).encode())
+    else:
+        print(f"Invalid request {trace.op}")
+        logging.warning(f"Invalid request {trace.op} from {addr}")
+        send_error(conn, trace, frame.request_id, "Invalid request")
+
+
+def handle_download(conn, addr, frame, trace, model, offset):
+    try:
+        file = open(model.client_model, 'rb')
+    except FileNotFoundError:
+        send_error(conn, trace, frame.request_id, "File not found")
+        logging.error(f"{model.client_model} not found")
+        return
+
+    with file:
+        # 크기와 해시를 먼저 보내고, 파일 내용은 sendfile로 커널에서 바로 전송한다
+        response, file_offset, count, not_modified = download.plan_response(file, frame.payload, digest_cache, offset)
+        if not_modified:
+            send(conn, trace, protocol.OP_DOWNLOAD, frame.request_id, response,
+                 flags=protocol.FLAG_RESPONSE | protocol.FLAG_NOT_MODIFIED)
+            logging.info(f"{addr} already has the latest {model.client_model}")
+            return
+        with trace.span('send'):
+            deadline = io_deadline()
+            protocol.set_deadline(conn, deadline)
+            conn.sendall(protocol.pack_header(protocol.OP_DOWNLOAD, frame.request_id, len(response) + count,
+                                              protocol.FLAG_RESPONSE) + response)
+            if count:
+                protocol.sendfile_exact(conn, file, file_offset, count, deadline)
+        trace.sent_bytes += protocol.HEADER_SIZE + len(response) + count
+    logging.info(f"Sent {model.client_model} to {addr} (offset {file_offset})")
+
+
+def decoded_limit():
+    # 압축이나 희소 표현을 풀면 payload보다 커지므로 복원한 크기에도 payload 한도를 적용한다
+    return admission.max_payload or encoding.MAX_DECODED_BYTES
+
+
+def decode_smashed_payload(payload, offset):
+    encoding_name, compression_name = encoding.read_envelope(payload, offset)
+    smashed_data = encoding.decode_smashed(payload, offset, decoded_limit())
+    compression_stats.observe(encoding_name, compression_name, smashed_data.numel() * 4, len(payload) - offset)
+    return smashed_data
+
+
+def submit(trace, model, smashed_data):
+    # 모델이 메모리에 없으면 여기서 로드되므로 로드 시간이 forward와 따로 기록된다
+    with trace.span('model_load'):
+        registry.acquire(model.key)
+    return predictor.submit(model.key, smashed_data)
+
+
+def handle_predict(conn, addr, frame, trace, model, offset):
+    try:
+        # 받은 버퍼를 그대로 감싸서 텐서를 만든다 (복사, unpickle 없음)
+        with trace.span('deserialize'):
+            smashed_data = decode_smashed_payload(frame.payload, offset)
+    except encoding.EncodingError as e:
+        send_error(conn, trace, frame.request_id, "Invalid smashed data")
+        logging.error(f"Invalid smashed data from {addr}: {e}")
+        return
+    debug_tensor("Received smashed data", smashed_data)
+
+    logging.info(f"Predicting with {model.key}...")
+    future = submit(trace, model, smashed_data)
+    with trace.span('forward'):
+        output = wait_for_result(conn, future)
+
+    with trace.span('serialize'):
+        parts = tensor_codec.encode(output)
+        if frame.flags & protocol.FLAG_TIMING:
+            server_seconds = sum(trace.spans[name] for name in ('deserialize', 'model_load', 'forward'))
+            parts = [*parts, protocol.pack_timing(trace.spans['deserialize'],
+                                                  server_seconds - trace.spans['deserialize'])]
+    send(conn, trace, protocol.OP_PREDICT, frame.request_id, *parts)
+    logging.info("Prediction result sent")
+
+
+def handle_train(conn, addr, frame, trace, model, offset):
+    try:
+        with trace.span('deserialize'):
+            smashed_data, labels = decode_train_request(frame.payload, offset, decoded_limit())
+    except ValueError as e:
+        send_error(conn, trace, frame.request_id, str(e))
+        logging.error(f"{e} from {addr}")
+        return
+
+    with trace.span('model_load'):
+        trainer = get_trainer(model)
+    try:
+        with trace.span('forward'):
+            grad, loss = wait_for_result(conn, trainer.submit(smashed_data, labels))
+    except (RuntimeError, ValueError, IndexError) as e:
+        send_error(conn, trace, frame.request_id, f"Training step failed: {e}")
+        logging.error(f"Training step failed for {addr}: {e}")
+        return
+    logging.info(f"Training step {trainer.steps} of {model.key} from {addr}, loss {loss.item():.4f}")
+    with trace.span('serialize'):
+        parts = tensor_codec.encode_many([loss, grad])
+    send(conn, trace, protocol.OP_TRAIN, frame.request_id, *parts)
+
+
+def handle_fedavg(conn, addr, frame, trace, model, offset):
+    try:
+        with trace.span('deserialize'):
+            samples, tensors = decode_fedavg_request(frame.payload, offset)
+        future = federation.submit(model.key, samples, tensors)
+    except ValueError as e:
+        send_error(conn, trace, frame.request_id, str(e))
+        logging.error(f"{e} from {addr}")
+        return
+
+    # 다른 클라이언트들이 라운드에 참여할 때까지 (최대 FEDAVG_TIMEOUT) 기다린다
+    logging.info(f"{addr} joined FedAvg round for {model.key} with {samples} samples")
+    # 라운드의 Future는 다른 클라이언트들과 공유하므로 끊어져도 취소하지 않는다
+    with trace.span('forward'):
+        averaged = wait_for_result(conn, future, cancel=False)
+    with trace.span('serialize'):
+        parts = tensor_codec.encode_many(averaged)
+    send(conn, trace, protocol.OP_FEDAVG, frame.request_id, *parts)
+
+
+def handle_predict_stream(conn, addr, frame, trace, model, offset, streams):
+    # micro-batch가 도착하는 대로 batcher에 넘기고, 다음 micro-batch를 받는 동안 추론이 진행된다.
+    # 결과를 기다리는 micro-batch는 STREAM_WINDOW개로 제한되므로 메모리 사용량이 일정하다.
+    if frame.request_id not in streams:
+        logging.info(f"Started prediction stream {frame.request_id} from {addr}")
+        streams[frame.request_id] = deque()
+    pending = streams[frame.request_id]
+
+    if pending is not None and len(frame.payload) > offset:
+        try:
+            with trace.span('deserialize'):
+                smashed_data = decode_smashed_payload(frame.payload, offset)
+        except encoding.EncodingError as e:
+            send_error(conn, trace, frame.request_id, "Invalid smashed data")
+            logging.error(f"Invalid smashed data from {addr}: {e}")
+            for future in pending:
+                future.cancel()
+            # 실패한 스트림의 나머지 프레임은 마지막 프레임까지 버린다
+            pending = streams[frame.request_id] = None
         else:
-            conn.sendall("Invalid request".encode())
-            logging.warning(f"Invalid request {request} from {addr}")
-    conn.close()
+            pending.append(submit(trace, model, smashed_data))
+
+    last = not frame.flags & protocol.FLAG_MORE
+    if pending is not None:
+        while pending and (last or len(pending) > STREAM_WINDOW or pending[0].done()):
+            with trace.span('forward'):
+                output = wait_for_result(conn, pending[0])
+                pending.popleft()
+            with trace.span('serialize'):
+                parts = tensor_codec.encode(output)
+            send(conn, trace, protocol.OP_PREDICT_STREAM, frame.request_id, *parts,
+                 flags=protocol.FLAG_RESPONSE | protocol.FLAG_MORE)
+        if last:
+            send(conn, trace, protocol.OP_PREDICT_STREAM, frame.request_id)
+            logging.info(f"Finished prediction stream {frame.request_id} from {addr}")
+    if last:
+        del streams[frame.request_id]
 
 # 서버 설정
 HOST = '127.0.0.1'
@@ -134,36 +506,135 @@ PORT = 12345
 shutdown_flag = False
 
 
+def print_batching_stats():
+    print(batcher.batch_size_histogram.format())
+    print(batcher.queue_wait_histogram.format())
+    print(compression_stats.format())
+    if result_cache:
+        print(result_cache.format())
+
+
 def listen_for_shutdown():
     global shutdown_flag
     while True:
-        command = input("Enter 's' to stop the server\n")
-        if command.lower() == 's':
+        command = input("Enter 's' to stop the server, 'stats' to show batching stats\n")
+        if command.lower() == 'stats':
+            print_batching_stats()
+        elif command.lower() == 's':
             shutdown_flag = True
             print("Shutting down server...")
             break
 
-def start_server():
-    global shutdown_flag
+def start_server(host=HOST, port=PORT):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        server_socket.bind((HOST, PORT))
+        server_socket.bind((host, port))
         server_socket.listen()
+        # accept()가 영원히 블록되지 않도록 해서 shutdown_flag를 주기적으로 확인
+        server_socket.settimeout(1.0)
 
-        logging.info(f"Server started at {HOST}:{PORT}")
-        print(f"Server started at {HOST}:{PORT}")
+        logging.info(f"Server started at {host}:{port}")
+        print(f"Server started at {host}:{port}")
 
         # Start the shutdown listener thread
         shutdown_thread = threading.Thread(target=listen_for_shutdown)
         shutdown_thread.start()
 
         while not shutdown_flag:
-            conn, addr = server_socket.accept()
+            try:
+                conn, addr = server_socket.accept()
+            except socket.timeout:
+                continue
+            protocol.enable_keepalive(conn, KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+            # 연결마다 스레드를 만들므로 연결 수를 제한한다
+            if not connection_slots.acquire(blocking=False):
+                logging.warning(f"Rejected {addr}: connection limit {MAX_CONNECTIONS} reached")
+                try:
+                    protocol.send_frame(conn, protocol.OP_ERROR, 0, protocol.pack_busy(1.0, "Server busy"),
+                                        flags=protocol.FLAG_RESPONSE | protocol.FLAG_RETRY, deadline=io_deadline())
+                except OSError:
+                    pass
+                conn.close()
+                continue
             client_thread = threading.Thread(target=handle_client, args=(conn, addr))
             client_thread.start()
 
         print("Shutting down server...")
+        publish_trainers()
+        registry.stop_watcher()
+        batcher.stop()
+        stop_process_pool()
+        print_batching_stats()
         server_socket.close()
         exit()
 
 
-start_server()
\ No newline at end of file
+def start_async_server(host=HOST, port=PORT, max_connections=10000, inference_workers=4):
+    server = AsyncServer(predictor, catalog, compression_stats, get_trainer, max_connections=max_connections,
+                         inference_workers=inference_workers, stream_window=STREAM_WINDOW,
+                         metrics=server_metrics, model_loader=registry.acquire, federation=federation,
+                         admission=admission, idle_timeout=IDLE_TIMEOUT, io_timeout=IO_TIMEOUT,
+                         disconnect_poll=DISCONNECT_POLL,
+                         keepalive=(KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_COUNT))
+    server.run(host, port)
+    publish_trainers()
+    registry.stop_watcher()
+    batcher.stop()
+    stop_process_pool()
+    print_batching_stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-connections', type=int, default=None,
+                        help=f'default: {MAX_CONNECTIONS} (thread engine), 10000 (asyncio engine)')
+    parser.add_argument('--max-payload', type=int, default=MAX_PAYLOAD, help='bytes (0: unlimited)')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT_PER_CLIENT,
+                        help='requests in flight per client address (0: unlimited)')
+    parser.add_argument('--max-queued-bytes', type=int, default=MAX_QUEUED_BYTES, help='0: unlimited')
+    parser.add_argument('--client-rate', type=float, default=CLIENT_RATE,
+                        help='requests per second per client address (0: unlimited)')
+    parser.add_argument('--client-burst', type=int, default=CLIENT_BURST)
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='close connections idle between requests for this many seconds (0: never)')
+    parser.add_argument('--io-timeout', type=float, default=IO_TIMEOUT,
+                        help='seconds to receive a request payload or send a response (0: no limit)')
+    parser.add_argument('--inference-workers', type=int, default=4)
+    parser.add_argument('--inference-processes', type=int, default=INFERENCE_PROCESSES,
+                        help='run the server model in this many worker processes (0: in this process)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help=f'serve Prometheus metrics on {METRICS_HOST}:PORT/metrics (0: disabled)')
+    parser.add_argument('--debug', action='store_true', help='log tensors and per-request traces')
+    parser.add_argument('--fedavg-clients', type=int, default=FEDAVG_CLIENTS,
+                        help='clients that must send weights before a FedAvg round closes')
+    args = parser.parse_args()
+
+    federation.clients = args.fedavg_clients
+    admission.max_payload = args.max_payload
+    admission.max_in_flight = args.max_in_flight
+    admission.max_queued_bytes = args.max_queued_bytes
+    admission.rate, admission.burst = args.client_rate, args.client_burst
+    IDLE_TIMEOUT, IO_TIMEOUT = args.idle_timeout, args.io_timeout
+    if args.max_connections:
+        MAX_CONNECTIONS = args.max_connections
+        connection_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    if args.inference_processes > 0:
+        start_process_pool(args.inference_processes)
+    if args.metrics_port:
+        try:
+            start_metrics_server(server_metrics.registry, METRICS_HOST, args.metrics_port)
+            print(f"Metrics at http://{METRICS_HOST}:{args.metrics_port}/metrics")
+        except OSError as e:
+            # 같은 머신에서 서버를 여러 개 띄우면 포트가 겹칠 수 있다. 지표 없이 계속 실행한다
+            logging.warning(f"Metrics endpoint disabled: {e}")
+            print(f"Metrics endpoint disabled: {e}")
+
+    if args.engine == 'asyncio':
+        start_async_server(args.host, args.port, args.max_connections or 10000, args.inference_workers)
+    else:
+        start_server(args.host, args.port)
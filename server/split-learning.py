@@ -1,7 +0,0 @@
-# Functions for splitting Pytorch model
-
-class Splitter:
-    def init(self, model):
-        pass
-    def split(self):
-        pass
\ No newline at end of file
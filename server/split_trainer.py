@@ -0,0 +1,194 @@
+import os
+import copy
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from common import tensor_codec, encoding
+from models.splitter import save_half, DEFAULT_ARCH, DEFAULT_SPLIT_POINT
+
+
+class _TrainRequest:
+    def __init__(self, smashed_data, labels):
+        self.smashed_data = smashed_data
+        self.labels = labels
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+# 클라이언트가 보낸 smashed data와 label로 서버 측 모델을 학습하고,
+# smashed data에 대한 gradient를 돌려준다.
+#
+# 여러 클라이언트가 동시에 학습하면(SplitFed) 학습 스레드가 max_wait 동안 들어온 요청을
+# max_group개까지 모아 하나의 batch로 forward/backward하고 optimizer step을 한 번만 한다.
+# loss는 요청별 평균 loss의 평균이고, 각 요청에는 자신의 평균 loss에 대한 gradient를 돌려준다.
+class SplitTrainer:
+    def __init__(self, registry, name, lr=0.001, publish_every=50, checkpoint_path=None,
+                 arch=DEFAULT_ARCH, split_point=DEFAULT_SPLIT_POINT, max_group=8, max_wait=0.005):
+        self.registry = registry
+        self.name = name
+        self.publish_every = publish_every
+        self.checkpoint_path = checkpoint_path
+        self.max_group = max_group
+        self.max_wait = max_wait
+        # 저장한 체크포인트를 load_half로 다시 불러올 수 있도록 모델 구조와 분할 지점을 함께 기록한다
+        self.arch = arch
+        self.split_point = split_point
+        self.steps = 0
+
+        self.model = copy.deepcopy(registry.eager(name))
+        for param in self.model.parameters():
+            param.requires_grad_(True)
+        self.model.train()
+        self.criterion = nn.CrossEntropyLoss(reduction='none')
+        self.optimizer = optim.Adam(self.model.parameters(), lr=lr)
+        # label 범위 검사에 쓴다. 마지막 Linear 층으로 알 수 없으면 검사하지 않는다
+        linears = [module for module in self.model.modules() if isinstance(module, nn.Linear)]
+        self.num_classes = linears[-1].out_features if linears else None
+        self._publishing = False
+
+        # 공유 모델에 대한 업데이트는 한 번에 하나씩만 적용한다
+        self._lock = threading.Lock()
+        registry.on_reload(self._on_reload)
+
+        self._queue = queue.Queue()
+        self._pending = []
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _on_reload(self, entry):
+        # 다른 곳에서 모델 파일이 바뀌면 학습 중인 가중치도 그 파일로 맞춘다
+        if entry.name != self.name or self._publishing:
+            return
+        with self._lock:
+            self.model.load_state_dict(self.registry.eager(self.name).state_dict())
+            self.optimizer.state.clear()
+        logging.info(f"Training model {self.name} reset to reloaded version {entry.version}")
+
+    def submit(self, smashed_data, labels):
+        # (smashed data에 대한 gradient, loss)를 결과로 갖는 Future.
+        # 잘못된 요청은 다른 클라이언트의 요청과 묶이기 전에 그 요청의 Future만 실패한다
+        request = _TrainRequest(smashed_data, labels)
+        try:
+            self._validate(smashed_data, labels)
+        except ValueError as e:
+            request.future.set_exception(e)
+            return request.future
+        self._queue.put(request)
+        return request.future
+
+    def _validate(self, smashed_data, labels):
+        if smashed_data.dim() < 1 or smashed_data.shape[0] == 0:
+            raise ValueError("Smashed data must have a non-empty batch dimension")
+        if labels.dim() != 1 or labels.shape[0] != smashed_data.shape[0]:
+            raise ValueError("Labels must have one label per sample")
+        if self.num_classes is not None and (int(labels.min()) < 0 or int(labels.max()) >= self.num_classes):
+            raise ValueError(f"Labels must be in [0, {self.num_classes})")
+
+    def _collect(self):
+        if not self._pending:
+            self._pending.append(self._queue.get())
+        first = self._pending[0]
+        shape = first.smashed_data.shape[1:]
+        group = [request for request in self._pending if request.smashed_data.shape[1:] == shape]
+        self._pending = [request for request in self._pending if request.smashed_data.shape[1:] != shape]
+
+        deadline = first.enqueued_at + self.max_wait
+        while len(group) < self.max_group:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request.smashed_data.shape[1:] == shape:
+                group.append(request)
+            else:
+                self._pending.append(request)
+        return group
+
+    def _run(self):
+        while True:
+            group = [request for request in self._collect() if request.future.set_running_or_notify_cancel()]
+            if not group:
+                continue
+            try:
+                results = self._step(group)
+            except Exception as e:
+                logging.error(f"Training step for {self.name} failed: {e}")
+                if len(group) == 1:
+                    group[0].future.set_exception(e)
+                    continue
+                # _step은 optimizer step 전에만 실패하므로 가중치는 그대로다.
+                # 어느 요청 때문인지 모르므로 하나씩 다시 학습해서 문제가 있는 요청만 실패시킨다
+                for request in group:
+                    try:
+                        result, = self._step([request])
+                    except Exception as e:
+                        request.future.set_exception(e)
+                    else:
+                        request.future.set_result(result)
+                continue
+            for request, result in zip(group, results):
+                request.future.set_result(result)
+
+    def _step(self, group):
+        inputs = [request.smashed_data.detach().requires_grad_() for request in group]
+        sizes = [request.labels.shape[0] for request in group]
+        with self._lock:
+            self.optimizer.zero_grad()
+            output = self.model(torch.cat(inputs) if len(inputs) > 1 else inputs[0])
+            losses = self.criterion(output, torch.cat([request.labels for request in group]))
+            request_losses = [chunk.mean() for chunk in losses.split(sizes)]
+            torch.stack(request_losses).mean().backward()
+            self.optimizer.step()
+            self.steps += 1
+            if self.publish_every and self.steps % self.publish_every == 0:
+                # optimizer step은 이미 적용되었으므로 게시 실패(디스크 부족 등)로 요청을 실패시키거나
+                # 다시 학습하지 않는다. 다음 게시 주기에 다시 시도한다
+                try:
+                    self._publish()
+                except Exception as e:
+                    logging.error(f"Publishing {self.name} failed: {e}")
+        # 평균을 내며 1/len(group)배가 된 gradient를 요청 하나의 loss에 대한 gradient로 되돌린다
+        return [(smashed_data.grad * len(group), loss.detach())
+                for smashed_data, loss in zip(inputs, request_losses)]
+
+    def publish(self):
+        with self._lock:
+            self._publish()
+
+    def _publish(self):
+        # 추론용 모델은 복사본으로 교체하므로 학습이 진행되어도 추론 결과가 섞이지 않는다
+        state_dict = {key: value.detach().clone() for key, value in self.model.state_dict().items()}
+        if self.checkpoint_path:
+            temp_path = self.checkpoint_path + '.tmp'
+            save_half(temp_path, state_dict, 'server', self.arch, self.split_point)
+            os.replace(temp_path, self.checkpoint_path)
+        self._publishing = True
+        try:
+            version = self.registry.publish(self.name, state_dict, self.checkpoint_path)
+        finally:
+            self._publishing = False
+        logging.info(f"Published {self.name} after {self.steps} training steps (version {version})")
+
+
+def decode_train_request(payload, offset=0, max_bytes=encoding.MAX_DECODED_BYTES):
+    # payload: labels(tensor_codec) | smashed data(encoding envelope)
+    try:
+        labels, offset = tensor_codec.decode(payload, offset)
+        smashed_data = encoding.decode_smashed(payload, offset, max_bytes)
+    except (tensor_codec.CodecError, encoding.EncodingError) as e:
+        raise ValueError(f"Invalid training data: {e}")
+    if smashed_data.dim() < 1:
+        raise ValueError("Smashed data must have a batch dimension")
+    if labels.dtype != torch.int64 or labels.dim() != 1 or labels.shape[0] != smashed_data.shape[0]:
+        raise ValueError("Labels must be an int64 vector with one label per sample")
+    return smashed_data, labels
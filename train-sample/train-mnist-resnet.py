@@ -1,62 +1,60 @@
 import os
 import sys
+import argparse
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))) # 상위 경로 import 가능
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
 from models.resnet import ResNet
+from models.training import ensure_memmap, MemmapDataset, make_loader, Trainer
 
 # TODO
-# 1. 기능별로 코드 분리 (모델 정의 (완), 데이터셋 정의, 학습, 테스트, 저장)
+# 1. 기능별로 코드 분리 (모델 정의 (완), 데이터셋 정의 (완), 학습 (완), 테스트 (완), 저장)
 # 2. 모델 Split 코드 추가
 
-# Check if GPU is available
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    
-
-train_data, train_labels = torch.load('dataset/mnist/training.pt')
-test_data, test_labels = torch.load('dataset/mnist/test.pt')
-
-train_dataset = TensorDataset(train_data.unsqueeze(1).float(), train_labels)
-test_dataset = TensorDataset(test_data.unsqueeze(1).float(), test_labels)
-
-train_loader = DataLoader(train_dataset, batch_size=128, shuffle=True)
-test_loader = DataLoader(test_dataset, batch_size=128, shuffle=False)
-
-
-# Initialize model, loss, and optimizer
-model = ResNet().to(device)  # Move model to GPU
-criterion = nn.CrossEntropyLoss()
-optimizer = optim.Adam(model.parameters(), lr=0.001)
-
-# Training
-for epoch in range(10):
-    model.train()
-    for i, (data, labels) in enumerate(train_loader):
-        data, labels = data.to(device), labels.to(device)  # Move data and labels to GPU
-        optimizer.zero_grad()
-        outputs = model(data)
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-        if (i + 1) % 100 == 0:
-            print(f"Epoch [{epoch + 1}/10], Step [{i + 1}/{len(train_loader)}], Loss: {loss.item():.4f}")
-
-# Testing
-model.eval()
-correct = 0
-total = 0
-with torch.no_grad():
-    for data, labels in test_loader:
-        data, labels = data.to(device), labels.to(device)  # Move data and labels to GPU
-        outputs = model(data)
-        _, predicted = torch.max(outputs.data, 1)
-        total += labels.size(0)
-        correct += (predicted == labels).sum().item()
-
-print(f"Test Accuracy: {100 * correct / total}%")
-
-# Save model
-torch.save(model.state_dict(), '../models/mnist-resnet.pt')
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='dataset/mnist')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=128)
+    # 평가는 역전파가 없어 메모리를 덜 쓰므로 더 큰 batch로 돌린다
+    parser.add_argument('--eval-batch-size', type=int, default=1024)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--prefetch', type=int, default=4, help='batches prefetched per worker')
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--bf16', action='store_true', help='bf16 mixed precision (CPU or GPU)')
+    parser.add_argument('--output', default='../models/mnist-resnet.pt')
+    args = parser.parse_args()
+
+    # Check if GPU is available
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    pin_memory = device.type == 'cuda'
+
+    train_dataset = MemmapDataset(ensure_memmap(os.path.join(args.data_dir, 'training.pt')))
+    test_dataset = MemmapDataset(ensure_memmap(os.path.join(args.data_dir, 'test.pt')))
+
+    train_loader = make_loader(train_dataset, args.batch_size, shuffle=True, workers=args.workers,
+                               pin_memory=pin_memory, prefetch=args.prefetch)
+    test_loader = make_loader(test_dataset, args.eval_batch_size, workers=args.workers,
+                              pin_memory=pin_memory, prefetch=args.prefetch)
+
+    # Initialize model, loss, and optimizer
+    model = ResNet()
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    trainer = Trainer(model, optimizer, nn.CrossEntropyLoss(), device, args.channels_last, args.bf16)
+
+    # Training
+    for epoch in range(args.epochs):
+        stats = trainer.train_epoch(train_loader, epoch=f"{epoch + 1}/{args.epochs}")
+        print(f"Epoch [{epoch + 1}/{args.epochs}] loss {stats['loss']:.4f}, {stats['seconds']:.1f}s, "
+              f"{stats['samples_per_second']:.0f} samples/s")
+
+    # Testing
+    result = trainer.evaluate(test_loader)
+    print(f"Test Accuracy: {result['accuracy']}% ({result['samples_per_second']:.0f} samples/s)")
+
+    # Save model
+    torch.save(trainer.state_dict(), args.output)